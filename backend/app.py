@@ -1,26 +1,36 @@
 from fastapi import FastAPI, Depends, HTTPException, Request, Query
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session, joinedload
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, joinedload, selectinload
 from sqlalchemy import func, or_, and_, text
 from typing import List, Optional
 from datetime import datetime, timezone
-from collections import Counter
-import uuid
 import os
-import mimetypes
-import models, schemas
-from lakebase_connector import get_db
+import logging
+import models, schemas, results, export, ballot_import, participants, serialization, fieldsets, bundle, query_stats, metrics, profiling, slow_queries, structured_logging, synthetic_data, static_files, sql_warehouse_connector, h3_tiles
+from compression import CompressionMiddleware
+from lakebase_connector import get_db, start_schema_initialization, wait_for_schema, SessionLocal, postgres_pool
+from voter_identity import get_client_ip, get_or_create_session, same_voter
+from results import calculate_like_stats
+from expiry_scheduler import scheduler as expiry_scheduler, is_expired
+import partitioning
+from partitioning import survey_rows
 
 # Import models with lakebase schema
-# Schema initialization is handled by lakebase_connector
+# Schema initialization is handled by lakebase_connector (in background, all'avvio)
+
+# Log su stdout tramite coda (LOG_LEVEL, LOG_FORMAT=json|text)
+structured_logging.setup()
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Web Democracy API (Databricks)", version="2.1.0")
 
 # Get static directory path (for serving React frontend)
 static_dir = os.path.join(os.path.dirname(__file__), "static")
-print(f"Static directory: {static_dir}")
-print(f"Static directory exists: {os.path.exists(static_dir)}")
+logger.info("Static directory: %s (exists: %s)", static_dir, os.path.exists(static_dir))
+# Manifest dei file statici (metadati, ETag, file piccoli in memoria), caricato all'avvio
+static_manifest = static_files.StaticManifest(static_dir)
 
 # Configurazione CORS - Allow all origins for Databricks Apps
 app.add_middleware(
@@ -31,6 +41,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compressione gzip/brotli delle risposte sopra COMPRESSION_MIN_SIZE (JSON, GeoJSON, export)
+app.add_middleware(CompressionMiddleware)
+
+# Metriche Prometheus per route (dentro QueryCounterMiddleware: legge il tempo SQL della richiesta)
+metrics.register_pool(postgres_pool, "postgres_pool")
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Profilazione su richiesta (X-Profile: 1 da un admin), anch'essa dentro QueryCounterMiddleware per i tempi SQL
+app.add_middleware(profiling.ProfilingMiddleware, session_factory=SessionLocal, email_header="x-forwarded-email")
+
+# Conteggio delle query SQL per richiesta (log degli N+1, header X-DB-* con QUERY_DEBUG_HEADERS=1)
+query_stats.install(postgres_pool)
+# Query oltre SLOW_QUERY_MS con EXPLAIN ANALYZE a campione (GET /api/debug/slow-queries)
+slow_queries.install(postgres_pool)
+app.add_middleware(query_stats.QueryCounterMiddleware)
+
+# Request id (X-Request-ID) nei log e nella risposta: registrato per ultimo, è il più esterno
+app.add_middleware(structured_logging.RequestIdMiddleware)
+
+@app.on_event("startup")
+def start_background_initialization():
+    """Avvia l'inizializzazione dello schema Lakebase senza bloccare l'avvio dell'app"""
+    static_manifest.load()
+    start_schema_initialization()
+    # Partizioni dei mesi successivi create ogni giorno (il bootstrap crea solo i primi mesi)
+    if partitioning.VOTES_PARTITIONING != "none":
+        expiry_scheduler.add_periodic(lambda: partitioning.maintain(postgres_pool), partitioning.PARTITION_MAINTENANCE_INTERVAL)
+    # Lo scheduler delle scadenze parte quando lo schema è pronto
+    expiry_scheduler.start(SessionLocal, wait_ready=wait_for_schema)
+
+@app.on_event("shutdown")
+def stop_background_tasks():
+    expiry_scheduler.stop()
+    sql_warehouse_connector.shutdown()
+
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint for monitoring"""
@@ -62,33 +107,75 @@ async def get_config_urls():
 
 @app.get("/api/debug/static-files")
 async def debug_static_files():
-    """Debug endpoint to list available static files"""
-    import os
-    static_files = []
-    for root, dirs, files in os.walk(static_dir):
-        for file in files:
-            full_path = os.path.join(root, file)
-            rel_path = os.path.relpath(full_path, static_dir)
-            static_files.append(rel_path)
-    
+    """Debug endpoint to list available static files (dal manifest caricato all'avvio)"""
+    files = sorted(static_manifest.entries)
     return {
         "static_dir": static_dir,
-        "total_files": len(static_files),
-        "files": sorted(static_files)[:100],  # First 100 files
+        "total_files": len(files),
+        "files": [
+            {
+                "path": path,
+                "media_type": static_manifest.entries[path].media_type,
+                "cache_control": static_manifest.entries[path].cache_control,
+                "encodings": [coding or "identity" for coding in static_manifest.entries[path].variants],
+                "in_memory": static_manifest.entries[path].variants[None].content is not None,
+            }
+            for path in files[:100]  # First 100 files
+        ],
         "note": "Only showing first 100 files"
     }
 
+@app.get("/api/debug/queries")
+async def debug_queries(request: Request, db: Session = Depends(get_db)):
+    """Query SQL per route (numero e tempo sul database) dall'avvio del processo - Solo per admin"""
+    user_id = await get_current_user_id(request, db)
+    user_db = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user_db or user_db.user_role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono vedere le statistiche delle query")
+    return query_stats.route_stats()
+
+@app.get("/api/debug/profiles")
+async def debug_profiles(request: Request, db: Session = Depends(get_db)):
+    """Profili delle richieste inviate con X-Profile: 1 (ultimi PROFILE_KEEP) - Solo per admin"""
+    user_id = await get_current_user_id(request, db)
+    user_db = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user_db or user_db.user_role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono vedere i profili")
+    return profiling.list_profiles()
+
+@app.get("/api/debug/profiles/{profile_id}")
+async def debug_profile(profile_id: str, request: Request, format: str = "json", db: Session = Depends(get_db)):
+    """Profilo di una richiesta: JSON con i tempi SQL oppure format=folded per il flamegraph - Solo per admin"""
+    user_id = await get_current_user_id(request, db)
+    user_db = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user_db or user_db.user_role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono vedere i profili")
+    profile = profiling.get_profile(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    if format == "folded":
+        return Response(content=profile["folded"], media_type="text/plain; charset=utf-8")
+    return profile
+
+@app.get("/api/debug/slow-queries")
+async def debug_slow_queries(
+    request: Request,
+    limit: int = Query(50, ge=1, le=500),
+    route: Optional[str] = None,
+    survey_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Query lente recenti con parametri, route, sondaggio e piano EXPLAIN (a campione) - Solo per admin"""
+    user_id = await get_current_user_id(request, db)
+    user_db = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user_db or user_db.user_role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono vedere le query lente")
+    return slow_queries.recent(limit, route, survey_id)
+
 @app.get("/api/debug/database")
 async def debug_database(db: Session = Depends(get_db)):
     """Debug endpoint to verify database schema"""
-    import os
-    
-    # Raccogli variabili d'ambiente relative al database
-    env_vars = {}
-    for key in os.environ:
-        if any(x in key.upper() for x in ['PG', 'DB', 'DATABASE', 'WEBDEMOCRACY']):
-            env_vars[key] = os.environ[key]
-    
+    # Niente variabili d'ambiente nella risposta: contengono credenziali
     try:
         # Verifica schema
         result = db.execute(text("""
@@ -114,7 +201,6 @@ async def debug_database(db: Session = Depends(get_db)):
             user_count = result.scalar()
         
         return {
-            "environment_variables": env_vars,
             "schema_exists": schema_exists,
             "tables_count": len(tables),
             "tables": tables,
@@ -123,16 +209,16 @@ async def debug_database(db: Session = Depends(get_db)):
         }
     except Exception as e:
         return {
-            "environment_variables": env_vars,
             "error": str(e),
             "error_type": type(e).__name__,
             "database_ok": False
         }
 
 @app.get("/metrics")
-async def metrics():
-    """Metrics endpoint for Databricks Apps monitoring"""
-    return {"status": "ok"}
+async def get_metrics():
+    """Metriche Prometheus (formato di testo) per il monitoraggio"""
+    body, content_type = metrics.exposition()
+    return Response(content=body, media_type=content_type)
 
 # Helper function to get current user ID
 async def get_current_user_id(request: Request, db: Session = Depends(get_db)) -> int:
@@ -434,6 +520,46 @@ async def create_test_surveys(request: Request, db: Session = Depends(get_db)):
     
     return {"message": f"Creati {len(created_surveys)} sondaggi di test", "surveys": created_surveys}
 
+@app.post("/api/surveys/synthetic-data")
+async def create_synthetic_data(
+    request: Request,
+    users: int = Query(1000, ge=1, le=100_000),
+    surveys: int = Query(200, ge=1, le=10_000),
+    votes: int = Query(100_000, ge=0, le=5_000_000),
+    open_responses: int = Query(10_000, ge=0, le=1_000_000),
+    likes: int = Query(20_000, ge=0, le=1_000_000),
+    tags: int = Query(12, ge=0, le=200),
+    groups: int = Query(10, ge=0, le=200),
+    news: int = Query(100, ge=0, le=10_000),
+    days: int = Query(180, ge=1, le=3650),
+    skew: float = Query(1.1, gt=0, le=3),
+    seed: int = Query(42),
+    db: Session = Depends(get_db)
+):
+    """Genera un dataset sintetico con volumi realistici (sostituisce i dati sintetici esistenti) - Admin only"""
+    user_id = await get_current_user_id(request, db)
+    user_db = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user_db or user_db.user_role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono gestire i dati sintetici")
+    try:
+        return await run_in_threadpool(
+            synthetic_data.generate, db,
+            users=users, surveys=surveys, votes=votes, open_responses=open_responses, likes=likes,
+            tags=tags, groups=groups, news=news, days=days, skew=skew, seed=seed
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.delete("/api/surveys/synthetic-data")
+async def delete_synthetic_data(request: Request, db: Session = Depends(get_db)):
+    """Elimina tutti i dati sintetici - Admin only"""
+    user_id = await get_current_user_id(request, db)
+    user_db = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user_db or user_db.user_role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono gestire i dati sintetici")
+    return {"removed": await run_in_threadpool(synthetic_data.clear, db)}
+
 # ===== ENDPOINTS PER I TAG =====
 
 @app.get("/tags", response_model=List[schemas.Tag])
@@ -523,13 +649,29 @@ async def get_surveys(
     include_expired: bool = False,
     my_surveys: bool = False,
     voted_status: Optional[str] = None,  # 'voted' o 'not_voted'
+    fields: Optional[str] = None,  # Sparse fieldset, es. fields=id,title,total_votes
     db: Session = Depends(get_db)
 ):
     """Ottieni tutti i sondaggi con filtri opzionali"""
+    selected = fieldsets.parse_fields(fields, fieldsets.SURVEY_LIST_FIELDS)
+    
+    def wants(name):
+        return selected is None or name in selected
+    
     # Get current user ID
     user_id = await get_current_user_id(request, db)
     
-    query = db.query(models.Survey).options(joinedload(models.Survey.creator))
+    query = db.query(models.Survey)
+    if selected is not None:
+        # Proiezione SQL: solo le colonne richieste (più quelle usate per filtri e conteggi)
+        query = query.options(fieldsets.survey_columns(selected))
+    if wants("creator"):
+        query = query.options(joinedload(models.Survey.creator))
+    # Opzioni e tag in una query ciascuno per tutta la lista, solo se richiesti
+    if wants("options"):
+        query = query.options(selectinload(models.Survey.options))
+    if wants("tags"):
+        query = query.options(selectinload(models.Survey.tags))
     
     # Filtro per tag
     if tag_ids:
@@ -562,42 +704,42 @@ async def get_surveys(
     surveys = query.all()
     
     # Ottieni IP e session per tracciare voti anonimi
-    client_ip = request.client.host if request.client else None
+    client_ip = get_client_ip(request)
     session_id = get_or_create_session(request)
     
-    # Ottieni tutti i survey_ids votati dall'utente (per filtro e has_user_voted)
-    # Include sia voti autenticati (user_id) che anonimi (IP/session)
-    voted_survey_ids_from_votes = set(
-        db.query(models.Vote.survey_id)
-        .filter(
-            or_(
-                models.Vote.user_id == user_id,           # Voti autenticati
-                models.Vote.voter_ip == client_ip,        # Voti anonimi via IP
-                models.Vote.voter_session == session_id   # Voti anonimi via session
+    voted_survey_ids = set()
+    if voted_status or wants("has_user_voted"):
+        # Ottieni tutti i survey_ids votati dall'utente (per filtro e has_user_voted)
+        # Include sia voti autenticati (user_id) che anonimi (IP/session)
+        voted_survey_ids_from_votes = set(
+            db.query(models.Vote.survey_id)
+            .filter(
+                or_(
+                    models.Vote.user_id == user_id,           # Voti autenticati
+                    same_voter(models.Vote.voter_ip, models.Vote.voter_session, client_ip, session_id)   # Voti anonimi via IP o session
+                )
             )
+            .distinct()
+            .all()
         )
-        .distinct()
-        .all()
-    )
-    voted_survey_ids_from_votes = {sid[0] for sid in voted_survey_ids_from_votes}
-    
-    # Aggiungi anche survey_ids da open_responses (per sondaggi OPEN_TEXT)
-    voted_survey_ids_from_responses = set(
-        db.query(models.OpenResponse.survey_id)
-        .filter(
-            or_(
-                models.OpenResponse.user_id == user_id,
-                models.OpenResponse.voter_ip == client_ip,
-                models.OpenResponse.voter_session == session_id
+        voted_survey_ids_from_votes = {sid[0] for sid in voted_survey_ids_from_votes}
+        
+        # Aggiungi anche survey_ids da open_responses (per sondaggi OPEN_TEXT)
+        voted_survey_ids_from_responses = set(
+            db.query(models.OpenResponse.survey_id)
+            .filter(
+                or_(
+                    models.OpenResponse.user_id == user_id,
+                    same_voter(models.OpenResponse.voter_ip, models.OpenResponse.voter_session, client_ip, session_id)
+                )
             )
+            .distinct()
+            .all()
         )
-        .distinct()
-        .all()
-    )
-    voted_survey_ids_from_responses = {sid[0] for sid in voted_survey_ids_from_responses}
-    
-    # Unisci i due set
-    voted_survey_ids = voted_survey_ids_from_votes | voted_survey_ids_from_responses
+        voted_survey_ids_from_responses = {sid[0] for sid in voted_survey_ids_from_responses}
+        
+        # Unisci i due set
+        voted_survey_ids = voted_survey_ids_from_votes | voted_survey_ids_from_responses
     
     # Filtro per status votato/non votato (applicato dopo il query per efficienza)
     if voted_status:
@@ -606,129 +748,90 @@ async def get_surveys(
         elif voted_status == 'not_voted':
             surveys = [s for s in surveys if s.id not in voted_survey_ids]
     
-    # Aggiungi statistiche a ogni sondaggio
+    # Partecipanti unici dagli sketch HyperLogLog (una query per tutti i sondaggi)
+    participant_counts = participants.count_participants_many(surveys, db) if wants("unique_participants") else {}
+    
+    # Aggiungi statistiche a ogni sondaggio (solo quelle richieste con fields)
     result = []
     for survey in surveys:
-        survey_dict = schemas.Survey.from_orm(survey).dict()
+        survey_dict = serialization.survey_dict(survey, selected)
         
-        # Calcola average_like_rating
-        likes = db.query(models.SurveyLike).filter(
-            models.SurveyLike.survey_id == survey.id
-        ).all()
+        if wants("average_like_rating"):
+            # Calcola average_like_rating
+            # Solo la colonna rating: servita dall'indice (survey_id, rating) senza leggere la tabella
+            average_like_rating = db.query(func.avg(models.SurveyLike.rating)).filter(
+                models.SurveyLike.survey_id == survey.id
+            ).scalar()
+            
+            if average_like_rating is not None:
+                average_like_rating = round(float(average_like_rating), 2)
+            survey_dict['average_like_rating'] = average_like_rating
         
-        if likes:
-            ratings = [like.rating for like in likes]
-            average_like_rating = round(sum(ratings) / len(ratings), 2)
-        else:
-            average_like_rating = None
+        if wants("user_like_rating"):
+            # Recupera il gradimento personale dell'utente
+            user_like_rating = None
+            if user_id or client_ip or session_id:
+                user_like = db.query(models.SurveyLike).filter(
+                    models.SurveyLike.survey_id == survey.id,
+                    same_voter(models.SurveyLike.user_ip, models.SurveyLike.user_session, client_ip, session_id)
+                ).first()
+                if user_like:
+                    user_like_rating = user_like.rating
+            survey_dict['user_like_rating'] = user_like_rating
         
-        # Recupera il gradimento personale dell'utente
-        user_like_rating = None
-        if user_id or client_ip or session_id:
-            user_like = db.query(models.SurveyLike).filter(
-                models.SurveyLike.survey_id == survey.id,
-                or_(
-                    models.SurveyLike.user_ip == client_ip,
-                    models.SurveyLike.user_session == session_id
-                )
-            ).first()
-            if user_like:
-                user_like_rating = user_like.rating
+        # Per OPEN_TEXT conta le risposte in open_responses, per gli altri tipi usa votes
+        rows_model = models.OpenResponse if survey.question_type == models.QuestionType.OPEN_TEXT else models.Vote
         
-        # Calcola total_votes (numero totale di voti ricevuti)
-        if survey.question_type == models.QuestionType.OPEN_TEXT:
-            # Per OPEN_TEXT, conta le risposte in open_responses
-            total_votes = db.query(models.OpenResponse).filter(
-                models.OpenResponse.survey_id == survey.id
-            ).count()
-            
-            # Calcola partecipazioni distinguendo tra anonimi e non anonimi
-            if survey.is_anonymous:
-                # Per sondaggi anonimi, conta distinct voter_session
-                unique_participants = db.query(func.count(func.distinct(models.OpenResponse.voter_session))).filter(
-                    models.OpenResponse.survey_id == survey.id,
-                    models.OpenResponse.voter_session.isnot(None)
-                ).scalar() or 0
-            else:
-                # Per sondaggi NON anonimi, conta distinct user_id
-                unique_participants = db.query(func.count(func.distinct(models.OpenResponse.user_id))).filter(
-                    models.OpenResponse.survey_id == survey.id,
-                    models.OpenResponse.user_id.isnot(None)
-                ).scalar() or 0
-            
-            # Ottieni gli user_ids dei partecipanti (solo per non anonimi)
-            if survey.is_anonymous:
-                participant_user_ids = []
-            else:
-                participant_user_ids = [
-                    uid[0] for uid in db.query(models.OpenResponse.user_id).filter(
-                        models.OpenResponse.survey_id == survey.id,
-                        models.OpenResponse.user_id.isnot(None)
-                    ).distinct().all()
-                ]
-        else:
-            # Per altri tipi, usa votes
-            total_votes = db.query(models.Vote).filter(
-                models.Vote.survey_id == survey.id
+        if wants("total_votes") or wants("total_responses"):
+            # Calcola total_votes (numero totale di voti ricevuti)
+            total_votes = db.query(rows_model).filter(
+                rows_model.survey_id == survey.id
             ).count()
-            
-            # Calcola partecipazioni distinguendo tra anonimi e non anonimi
-            if survey.is_anonymous:
-                # Per sondaggi anonimi, conta distinct voter_session
-                unique_participants = db.query(func.count(func.distinct(models.Vote.voter_session))).filter(
-                    models.Vote.survey_id == survey.id,
-                    models.Vote.voter_session.isnot(None)
-                ).scalar() or 0
-            else:
-                # Per sondaggi NON anonimi, conta distinct user_id
-                unique_participants = db.query(func.count(func.distinct(models.Vote.user_id))).filter(
-                    models.Vote.survey_id == survey.id,
-                    models.Vote.user_id.isnot(None)
-                ).scalar() or 0
-            
+            survey_dict['total_votes'] = total_votes
+            survey_dict['total_responses'] = total_votes  # Per compatibilità
+        
+        if wants("participant_user_ids"):
             # Ottieni gli user_ids dei partecipanti per calcolare utenti unici globali (solo per non anonimi)
             if survey.is_anonymous:
                 participant_user_ids = []
             else:
                 participant_user_ids = [
-                    uid[0] for uid in db.query(models.Vote.user_id).filter(
-                        models.Vote.survey_id == survey.id,
-                        models.Vote.user_id.isnot(None)
+                    uid[0] for uid in db.query(rows_model.user_id).filter(
+                        rows_model.survey_id == survey.id,
+                        rows_model.user_id.isnot(None)
                     ).distinct().all()
                 ]
+            survey_dict['participant_user_ids'] = participant_user_ids
         
-        # Verifica se l'utente ha votato questo sondaggio
-        has_user_voted = survey.id in voted_survey_ids
+        if wants("unique_participants"):
+            survey_dict['unique_participants'] = participant_counts[survey.id]
         
-        survey_dict['average_like_rating'] = average_like_rating
-        survey_dict['user_like_rating'] = user_like_rating
-        survey_dict['total_votes'] = total_votes
-        survey_dict['total_responses'] = total_votes  # Per compatibilità
-        survey_dict['unique_participants'] = unique_participants
-        survey_dict['participant_user_ids'] = participant_user_ids
-        survey_dict['has_user_voted'] = has_user_voted
+        if wants("has_user_voted"):
+            # Verifica se l'utente ha votato questo sondaggio
+            survey_dict['has_user_voted'] = survey.id in voted_survey_ids
         
-        result.append(schemas.SurveyWithStats(**survey_dict))
+        result.append(fieldsets.project(survey_dict, selected))
     
-    return result
+    # Dict già completi: niente seconda validazione pydantic, codifica diretta con orjson
+    return serialization.json_response(result)
 
 @app.get("/surveys/{survey_id}", response_model=schemas.Survey)
-def get_survey(survey_id: int, db: Session = Depends(get_db)):
-    """Ottieni un singolo sondaggio"""
-    survey = db.query(models.Survey).filter(models.Survey.id == survey_id).first()
+def get_survey(survey_id: int, fields: Optional[str] = None, db: Session = Depends(get_db)):
+    """Ottieni un singolo sondaggio (fields=id,title,... per un sottoinsieme dei campi)"""
+    selected = fieldsets.parse_fields(fields, fieldsets.SURVEY_FIELDS)
+    query = db.query(models.Survey)
+    if selected is not None:
+        query = query.options(fieldsets.survey_columns(selected))
+    survey = query.filter(models.Survey.id == survey_id).first()
     if not survey:
         raise HTTPException(status_code=404, detail="Sondaggio non trovato")
     
-    # Verifica scadenza
-    if survey.expires_at:
-        # Normalizza datetime per il confronto (rimuovi timezone se presente)
-        expires_naive = survey.expires_at.replace(tzinfo=None) if survey.expires_at.tzinfo else survey.expires_at
-        now_naive = datetime.utcnow()
-        if expires_naive < now_naive:
-            survey.is_active = False
-            db.commit()
-            db.refresh(survey)
+    # Scaduto ma non ancora chiuso: la chiusura spetta allo scheduler, non alla richiesta GET
+    if survey.is_active and is_expired(survey):
+        expiry_scheduler.schedule(survey.id, survey.expires_at)
     
+    if selected is not None:
+        return serialization.json_response(serialization.survey_dict(survey, selected))
     return survey
 
 @app.post("/surveys", response_model=schemas.Survey)
@@ -778,6 +881,7 @@ async def create_survey(request: Request, survey: schemas.SurveyCreate, db: Sess
     
     db.commit()
     db.refresh(db_survey)
+    expiry_scheduler.schedule(db_survey.id, db_survey.expires_at)
     return db_survey
 
 @app.patch("/surveys/{survey_id}", response_model=schemas.Survey)
@@ -797,8 +901,15 @@ def update_survey(survey_id: int, survey_update: schemas.SurveyUpdate, db: Sessi
         tags = db.query(models.Tag).filter(models.Tag.id.in_(survey_update.tag_ids)).all()
         db_survey.tags = tags
     
+    # Stato o scadenza modificati: aggiorna lo snapshot dei risultati finali
+    if update_data.keys() & {'is_active', 'expires_at', 'closure_type'}:
+        db.flush()
+        results.on_status_change(db_survey, db)
+    
     db.commit()
     db.refresh(db_survey)
+    if db_survey.is_active:
+        expiry_scheduler.schedule(db_survey.id, db_survey.expires_at)
     return db_survey
 
 @app.post("/api/surveys/{survey_id}/toggle-status")
@@ -817,6 +928,8 @@ async def toggle_survey_status(survey_id: int, request: Request, db: Session = D
     
     # Toggle dello stato
     survey.is_active = not survey.is_active
+    # Chiusura: congela i risultati finali; riapertura: scarta lo snapshot
+    results.on_status_change(survey, db)
     db.commit()
     db.refresh(survey)
     
@@ -830,6 +943,12 @@ def delete_survey(survey_id: int, db: Session = Depends(get_db)):
     if not survey:
         raise HTTPException(status_code=404, detail="Sondaggio non trovato")
     
+    # Eliminazione bulk delle risposte (una DELETE per tabella, limitata alle partizioni del sondaggio)
+    # invece di caricare e cancellare le righe una per una via ORM
+    for model in (models.Vote, models.OpenResponse):
+        db.query(model).filter(*survey_rows(model, survey)).delete(synchronize_session=False)
+    db.query(models.SurveyLike).filter(models.SurveyLike.survey_id == survey_id).delete(synchronize_session=False)
+    
     db.delete(survey)
     db.commit()
     return {"message": f"Sondaggio '{survey.title}' eliminato con successo"}
@@ -848,13 +967,6 @@ def delete_all_surveys(db: Session = Depends(get_db)):
 
 # ===== ENDPOINTS PER VOTARE =====
 
-def get_or_create_session(request: Request) -> str:
-    """Ottieni o crea una session ID per il votante"""
-    session_id = request.cookies.get("session_id")
-    if not session_id:
-        session_id = str(uuid.uuid4())
-    return session_id
-
 @app.post("/surveys/{survey_id}/vote")
 async def vote_survey(
     survey_id: int,
@@ -879,19 +991,13 @@ async def vote_survey(
     if not survey.is_active:
         raise HTTPException(status_code=400, detail="Sondaggio non più attivo")
     
-    # Verifica scadenza
-    if survey.expires_at:
-        # Normalizza datetime per il confronto (rimuovi timezone se presente)
-        expires_naive = survey.expires_at.replace(tzinfo=None) if survey.expires_at.tzinfo else survey.expires_at
-        now_naive = datetime.utcnow()
-        if expires_naive < now_naive:
-            survey.is_active = False
-            db.commit()
-            db.refresh(survey)
-            raise HTTPException(status_code=400, detail="Sondaggio scaduto")
+    # Verifica scadenza (senza scrivere: la chiusura e lo snapshot li gestisce lo scheduler)
+    if is_expired(survey):
+        expiry_scheduler.schedule(survey.id, survey.expires_at)
+        raise HTTPException(status_code=400, detail="Sondaggio scaduto")
     
     # Ottieni session
-    client_ip = request.client.host
+    client_ip = get_client_ip(request)
     session_id = get_or_create_session(request)
     
     # Verifica se ha già votato (se non permessi voti multipli)
@@ -900,10 +1006,7 @@ async def vote_survey(
         if survey.question_type == models.QuestionType.OPEN_TEXT:
             existing = db.query(models.OpenResponse).filter(
                 models.OpenResponse.survey_id == survey_id,
-                or_(
-                    models.OpenResponse.voter_ip == client_ip,
-                    models.OpenResponse.voter_session == session_id
-                )
+                same_voter(models.OpenResponse.voter_ip, models.OpenResponse.voter_session, client_ip, session_id)
             ).first()
             if existing:
                 raise HTTPException(status_code=400, detail="Hai già votato in questo sondaggio")
@@ -911,10 +1014,7 @@ async def vote_survey(
             # Per altri tipi, verifica votes
             existing = db.query(models.Vote).filter(
                 models.Vote.survey_id == survey_id,
-                or_(
-                    models.Vote.voter_ip == client_ip,
-                    models.Vote.voter_session == session_id
-                )
+                same_voter(models.Vote.voter_ip, models.Vote.voter_session, client_ip, session_id)
             ).first()
         if existing:
             raise HTTPException(status_code=400, detail="Hai già votato in questo sondaggio")
@@ -1252,10 +1352,7 @@ async def vote_survey(
         # Cerca se esiste già un like per questo utente
         existing_like = db.query(models.SurveyLike).filter(
             models.SurveyLike.survey_id == survey_id,
-            or_(
-                models.SurveyLike.user_ip == client_ip,
-                models.SurveyLike.user_session == session_id
-            )
+            same_voter(models.SurveyLike.user_ip, models.SurveyLike.user_session, client_ip, session_id)
         ).first()
         
         if existing_like:
@@ -1282,309 +1379,128 @@ async def vote_survey(
             )
             db.add(db_like)
     
+    # Sketch dei partecipanti unici (stessa transazione del voto)
+    participants.record_participant(survey, user_id, session_id, db)
+    
     db.commit()
+    metrics.BALLOTS.labels(question_type=models.QuestionType(survey.question_type).value, source="vote").inc()
     return {"message": "Voto registrato con successo", "session_id": session_id}
 
 # ===== ENDPOINTS PER RISULTATI =====
 
 @app.get("/surveys/{survey_id}/results", response_model=schemas.SurveyResultsResponse)
-async def get_survey_results(survey_id: int, request: Request, db: Session = Depends(get_db)):
-    """Ottieni i risultati di un sondaggio"""
+async def get_survey_results(survey_id: int, request: Request, fields: Optional[str] = None, db: Session = Depends(get_db)):
+    """Ottieni i risultati di un sondaggio (fields=... per un sottoinsieme dei campi)"""
+    selected = fieldsets.parse_fields(fields, fieldsets.RESULTS_FIELDS, always=("survey_id",))
     survey = db.query(models.Survey).filter(models.Survey.id == survey_id).first()
     if not survey:
         raise HTTPException(status_code=404, detail="Sondaggio non trovato")
     
-    results = []
-    numeric_stats = None
-    value_distribution = None
-    open_responses = []
-    most_common_date = None
-    total_votes = 0
-    total_responses = 0
-    
-    if survey.question_type in [models.QuestionType.SINGLE_CHOICE, models.QuestionType.MULTIPLE_CHOICE]:
-        # Risultati per choice
-        result_query = db.query(
-            models.SurveyOption.id,
-            models.SurveyOption.option_text,
-            func.count(models.Vote.id).label('vote_count')
-        ).outerjoin(models.Vote).filter(
-            models.SurveyOption.survey_id == survey_id
-        ).group_by(models.SurveyOption.id).all()
-        
-        total_votes = sum(r.vote_count for r in result_query)
+    # Sondaggi chiusi: snapshot dei risultati finali (una lettura), altrimenti calcolo dai voti
+    payload = results.get_survey_results_payload(survey, db, selected)
+    
+    if selected is None or selected & fieldsets.USER_RESULT_FIELDS:
+        # Campi specifici dell'utente corrente (solo per sondaggi non anonimi)
+        user_id = None
+        if not survey.is_anonymous:
+            try:
+                user_id = await get_current_user_id(request, db)
+            except Exception as e:
+                # Utente non autenticato o errore
+                pass
         
-        results = [
-            schemas.SurveyResult(
-                option_id=r.id,
-                option_text=r.option_text,
-                vote_count=r.vote_count,
-                percentage=round((r.vote_count / total_votes * 100), 2) if total_votes > 0 else 0
+        payload.update(results.user_result_fields(survey, user_id, db))
+    return serialization.json_response(fieldsets.project(payload, selected))
+
+@app.get("/surveys/{survey_id}/export")
+async def export_survey(
+    survey_id: int,
+    request: Request,
+    format: str = "csv",
+    dataset: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Export in streaming dei dati del sondaggio (format=csv|ndjson|parquet).
+    dataset=votes|open_responses|likes (righe grezze, solo creatore o admin) oppure results (aggregati).
+    """
+    survey = db.query(models.Survey).filter(models.Survey.id == survey_id).first()
+    if not survey:
+        raise HTTPException(status_code=404, detail="Sondaggio non trovato")
+    
+    if dataset != "results":
+        user_id = await get_current_user_id(request, db)
+        user_db = db.query(models.User).filter(models.User.id == user_id).first()
+        if not user_db or (user_db.user_role != "admin" and survey.user_id != user_id):
+            raise HTTPException(
+                status_code=403,
+                detail="Solo il creatore del sondaggio o un amministratore può esportare i dati grezzi"
             )
-            for r in result_query
-        ]
-        
-        # Per multiple choice, conta risposte uniche
-        total_responses = db.query(models.Vote.voter_session).filter(
-            models.Vote.survey_id == survey_id
-        ).distinct().count()
     
-    elif survey.question_type == models.QuestionType.OPEN_TEXT:
-        # Risposte aperte
-        # Controlla se ci sono opzioni nel sondaggio
-        survey_options = db.query(models.SurveyOption).filter(
-            models.SurveyOption.survey_id == survey_id
-        ).all()
-        
-        open_responses_query = db.query(models.OpenResponse).filter(
-            models.OpenResponse.survey_id == survey_id
-        ).all()
-        
-        open_responses = [schemas.OpenResponse.from_orm(r) for r in open_responses_query]
-        total_votes = len(open_responses)
-        total_responses = total_votes
-        
-        # Se ci sono opzioni, crea anche un conteggio per opzione
-        if survey_options:
-            for option in survey_options:
-                option_responses_count = sum(1 for r in open_responses_query if r.option_id == option.id)
-                results.append(schemas.SurveyResult(
-                    option_id=option.id,
-                    option_text=option.option_text,
-                    vote_count=option_responses_count
-                ))
+    return export.stream_export(survey, dataset, format, SessionLocal)
+
+@app.post("/api/surveys/{survey_id}/import-ballots", response_model=schemas.BallotImportResponse)
+async def import_survey_ballots(
+    survey_id: int,
+    request: Request,
+    format: Optional[str] = None,
+    on_error: str = "skip",
+    dry_run: bool = False,
+    db: Session = Depends(get_db)
+):
+    """
+    Import massivo di schede (CSV o NDJSON nel body della richiesta) - Solo per admin.
+    Le righe valide vengono caricate con COPY, quelle scartate riportate con il numero di riga.
+    """
+    user_id = await get_current_user_id(request, db)
+    user_db = db.query(models.User).filter(models.User.id == user_id).first()
+    if not user_db or user_db.user_role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono importare schede")
     
-    elif survey.question_type in [models.QuestionType.SCALE, models.QuestionType.RATING]:
-        # Statistiche numeriche
-        # Controlla se ci sono opzioni nel sondaggio
-        survey_options = db.query(models.SurveyOption).filter(
-            models.SurveyOption.survey_id == survey_id
-        ).all()
-        
-        if survey_options:
-            # Con opzioni: mostra risultati per ogni opzione
-            for option in survey_options:
-                option_votes = db.query(models.Vote.numeric_value).filter(
-                    models.Vote.survey_id == survey_id,
-                    models.Vote.option_id == option.id,
-                    models.Vote.numeric_value.isnot(None)
-                ).all()
-                
-                if option_votes:
-                    values = [v[0] for v in option_votes]
-                    values_sorted = sorted(values)
-                    median = values_sorted[len(values_sorted) // 2] if values_sorted else 0
-                    
-                    # Calcola la distribuzione dei valori per questa opzione (per bubble chart)
-                    value_counts = Counter(values)
-                    distribution = []
-                    for val in range(survey.min_value, survey.max_value + 1):
-                        distribution.append(schemas.ValueDistribution(
-                            value=float(val),
-                            count=value_counts.get(float(val), 0)
-                        ))
-                    
-                    results.append(schemas.SurveyResult(
-                        option_id=option.id,
-                        option_text=option.option_text,
-                        vote_count=len(values),
-                        numeric_average=round(sum(values) / len(values), 2),
-                        numeric_median=median,
-                        numeric_min=min(values),
-                        numeric_max=max(values),
-                        value_distribution=distribution
-                    ))
-                    total_votes += len(values)
-                else:
-                    # Crea una distribuzione vuota se non ci sono voti
-                    distribution = []
-                    for val in range(survey.min_value, survey.max_value + 1):
-                        distribution.append(schemas.ValueDistribution(
-                            value=float(val),
-                            count=0
-                        ))
-                    
-                    results.append(schemas.SurveyResult(
-                        option_id=option.id,
-                        option_text=option.option_text,
-                        vote_count=0,
-                        value_distribution=distribution
-                    ))
-            
-            total_responses = total_votes
-        else:
-            # Backward compatibility: statistiche senza opzioni
-            numeric_values = db.query(models.Vote.numeric_value).filter(
-                models.Vote.survey_id == survey_id,
-                models.Vote.numeric_value.isnot(None)
-            ).all()
-            
-            if numeric_values:
-                values = [v[0] for v in numeric_values]
-                total_votes = len(values)
-                total_responses = total_votes
-                
-                values_sorted = sorted(values)
-                median = values_sorted[len(values_sorted) // 2] if values_sorted else 0
-                
-                numeric_stats = schemas.NumericResultStats(
-                    average=round(sum(values) / len(values), 2),
-                    min_value=min(values),
-                    max_value=max(values),
-                    median=median,
-                    count=len(values)
-                )
-                
-                # Per RATING e SCALE, calcola la distribuzione dei valori
-                if survey.question_type in [models.QuestionType.SCALE, models.QuestionType.RATING]:
-                    # Conta le occorrenze per ogni valore
-                    value_counts = Counter(values)
-                    
-                    # Crea una lista con tutti i valori possibili da min_value a max_value
-                    distribution = []
-                    for val in range(survey.min_value, survey.max_value + 1):
-                        distribution.append(schemas.ValueDistribution(
-                            value=float(val),
-                            count=value_counts.get(float(val), 0)
-                        ))
-                    
-                    value_distribution = distribution
+    survey = db.query(models.Survey).filter(models.Survey.id == survey_id).first()
+    if not survey:
+        raise HTTPException(status_code=404, detail="Sondaggio non trovato")
     
-    elif survey.question_type == models.QuestionType.DATE:
-        # Date - controlla se ci sono opzioni
-        survey_options = db.query(models.SurveyOption).filter(
-            models.SurveyOption.survey_id == survey_id
-        ).all()
-        
-        if survey_options:
-            # Con opzioni: mostra risultati come per SINGLE_CHOICE
-            result_query = db.query(
-                models.SurveyOption.id,
-                models.SurveyOption.option_text,
-                func.count(models.Vote.id).label('vote_count')
-            ).outerjoin(models.Vote).filter(
-                models.SurveyOption.survey_id == survey_id
-            ).group_by(models.SurveyOption.id).all()
-            
-            total_votes = sum(r.vote_count for r in result_query)
-            
-            results = [
-                schemas.SurveyResult(
-                    option_id=r.id,
-                    option_text=r.option_text,
-                    vote_count=r.vote_count,
-                    percentage=round((r.vote_count / total_votes * 100), 2) if total_votes > 0 else 0
-                )
-                for r in result_query
-            ]
-            
-            total_responses = total_votes
-        else:
-            # Backward compatibility: date senza opzioni
-            date_query = db.query(
-                models.Vote.date_value,
-                func.count(models.Vote.id).label('count')
-            ).filter(
-                models.Vote.survey_id == survey_id,
-                models.Vote.date_value.isnot(None)
-            ).group_by(models.Vote.date_value).order_by(func.count(models.Vote.id).desc()).first()
-            
-            if date_query:
-                most_common_date = date_query[0]
-                total_votes = db.query(models.Vote).filter(
-                    models.Vote.survey_id == survey_id,
-                    models.Vote.date_value.isnot(None)
-                ).count()
-                total_responses = total_votes
-    
-    # Recupera tutti i commenti dai gradimenti (i commenti ora sono in survey_likes)
-    comments_from_likes = db.query(models.SurveyLike).filter(
-        models.SurveyLike.survey_id == survey_id,
-        models.SurveyLike.comment.isnot(None),
-        models.SurveyLike.comment != ''
-    ).order_by(models.SurveyLike.created_at.desc()).all()
-    
-    # Costruisci i commenti del gradimento con informazioni utente (se non anonimo)
-    like_comments = []
-    for like in comments_from_likes:
-        comment_dict = {
-            'id': like.id,
-            'survey_id': like.survey_id,
-            'rating': like.rating,
-            'comment': like.comment,
-            'created_at': like.created_at,
-            'user_id': like.user_id
-        }
-        # Se il sondaggio non è anonimo e c'è un user_id, recupera i dati utente
-        if not survey.is_anonymous and like.user_id:
-            user = db.query(models.User).filter(models.User.id == like.user_id).first()
-            if user:
-                comment_dict['user_name'] = user.name
-                comment_dict['user_email'] = user.email
-        like_comments.append(schemas.SurveyLikeComment(**comment_dict))
-    
-    # Calcola statistiche gradimento
-    like_stats = calculate_like_stats(survey_id, db)
-    
-    # Ottieni le opzioni votate dall'utente corrente (solo per sondaggi non anonimi)
-    user_voted_option_ids = []
-    user_response_ids = []
-    user_numeric_votes = None
-    if not survey.is_anonymous:
-        try:
-            user_id = await get_current_user_id(request, db)
-            if user_id:
-                # Opzioni votate per sondaggi a scelta/data
-                if survey.question_type in [models.QuestionType.SINGLE_CHOICE, models.QuestionType.MULTIPLE_CHOICE, models.QuestionType.DATE]:
-                    user_votes = db.query(models.Vote).filter(
-                    models.Vote.survey_id == survey_id,
-                    models.Vote.user_id == user_id
-                    ).all()
-                    user_voted_option_ids = [vote.option_id for vote in user_votes if vote.option_id]
-                
-                # Voti numerici per sondaggi SCALE/RATING
-                if survey.question_type in [models.QuestionType.SCALE, models.QuestionType.RATING]:
-                    user_votes = db.query(models.Vote).filter(
-                        models.Vote.survey_id == survey_id,
-                        models.Vote.user_id == user_id
-                    ).all()
-                    # Dizionario {option_id: numeric_value} con chiavi intere
-                    user_numeric_votes = {
-                        int(vote.option_id): int(vote.numeric_value)
-                        for vote in user_votes 
-                        if vote.option_id and vote.numeric_value is not None
-                    }
-                
-                # Risposte aperte dell'utente per sondaggi a risposta aperta
-                if survey.question_type == models.QuestionType.OPEN_TEXT:
-                    user_open_responses = db.query(models.OpenResponse).filter(
-                        models.OpenResponse.survey_id == survey_id,
-                        models.OpenResponse.user_id == user_id
-                    ).all()
-                    user_response_ids = [resp.id for resp in user_open_responses]
-        except Exception as e:
-            # Utente non autenticato o errore
-            pass
-    
-    return schemas.SurveyResultsResponse(
-        survey_id=survey_id,
-        survey_title=survey.title,
-        question_type=survey.question_type,
-        total_votes=total_votes,
-        total_responses=total_responses,
-        results=results,
-        numeric_stats=numeric_stats,
-        value_distribution=value_distribution,
-        rating_icon=survey.rating_icon if survey.question_type in [models.QuestionType.RATING, models.QuestionType.SCALE] else None,
-        min_value=survey.min_value if survey.question_type in [models.QuestionType.RATING, models.QuestionType.SCALE] else None,
-        max_value=survey.max_value if survey.question_type in [models.QuestionType.RATING, models.QuestionType.SCALE] else None,
-        like_stats=like_stats,
-        like_comments=like_comments,
-        open_responses=open_responses,
-        most_common_date=most_common_date,
-        user_voted_option_ids=user_voted_option_ids,
-        user_response_ids=user_response_ids,
-        user_numeric_votes=user_numeric_votes
+    fmt = ballot_import.detect_format(format, request.headers.get("content-type"))
+    source = await ballot_import.spool_request_body(request)
+    try:
+        # Validazione e COPY sono sincrone: fuori dall'event loop
+        return await run_in_threadpool(ballot_import.import_ballots, db, survey, source, fmt, on_error, dry_run)
+    finally:
+        source.close()
+
+@app.get("/surveys/{survey_id}/bundle")
+async def get_survey_bundle(
+    survey_id: int,
+    request: Request,
+    include: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Dati della pagina di dettaglio in una sola richiesta: survey, stats, results, like, like_stats
+    (include=... per un sottoinsieme). Ogni parte ha la forma dell'endpoint corrispondente.
+    """
+    parts = bundle.parse_include(include)
+    # Un solo caricamento del sondaggio, con opzioni, tag e creatore
+    survey = db.query(models.Survey).options(
+        joinedload(models.Survey.creator),
+        selectinload(models.Survey.options),
+        selectinload(models.Survey.tags)
+    ).filter(models.Survey.id == survey_id).first()
+    if not survey:
+        raise HTTPException(status_code=404, detail="Sondaggio non trovato")
+    
+    if survey.is_active and is_expired(survey):
+        expiry_scheduler.schedule(survey.id, survey.expires_at)
+    
+    user_id = None
+    if parts & {"stats", "results"}:
+        user_id = await get_current_user_id(request, db)
+    client_ip = get_client_ip(request)
+    session_id = get_or_create_session(request)
+    
+    return serialization.json_response(
+        bundle.build_bundle(survey, db, parts, user_id, client_ip, session_id)
     )
 
 @app.get("/surveys/{survey_id}/stats", response_model=schemas.SurveyStats)
@@ -1596,106 +1512,13 @@ async def get_survey_stats(survey_id: int, request: Request, db: Session = Depen
     
     # Get current user ID per verificare se ha votato
     user_id = await get_current_user_id(request, db)
-    client_ip = request.client.host if request.client else None
+    client_ip = get_client_ip(request)
     session_id = get_or_create_session(request)
     
-    # Calcola total_votes e total_participants in base al tipo di sondaggio
-    if survey.question_type == models.QuestionType.OPEN_TEXT:
-        # Per OPEN_TEXT, usa open_responses
-        total_votes = db.query(models.OpenResponse).filter(
-            models.OpenResponse.survey_id == survey_id
-        ).count()
-        
-        # Calcola partecipanti distinguendo tra anonimi e non anonimi
-        if survey.is_anonymous:
-            total_participants = db.query(func.count(func.distinct(models.OpenResponse.voter_session))).filter(
-                models.OpenResponse.survey_id == survey_id,
-                models.OpenResponse.voter_session.isnot(None)
-            ).scalar() or 0
-        else:
-            total_participants = db.query(func.count(func.distinct(models.OpenResponse.user_id))).filter(
-                models.OpenResponse.survey_id == survey_id,
-                models.OpenResponse.user_id.isnot(None)
-            ).scalar() or 0
-    else:
-        # Per altri tipi, usa votes
-        total_votes = db.query(models.Vote).filter(models.Vote.survey_id == survey_id).count()
-        
-        # Calcola partecipanti distinguendo tra anonimi e non anonimi
-        if survey.is_anonymous:
-            total_participants = db.query(func.count(func.distinct(models.Vote.voter_session))).filter(
-                models.Vote.survey_id == survey_id,
-                models.Vote.voter_session.isnot(None)
-            ).scalar() or 0
-        else:
-            total_participants = db.query(func.count(func.distinct(models.Vote.user_id))).filter(
-                models.Vote.survey_id == survey_id,
-                models.Vote.user_id.isnot(None)
-            ).scalar() or 0
-    
-    last_vote = db.query(models.Vote.voted_at).filter(
-        models.Vote.survey_id == survey_id
-    ).order_by(models.Vote.voted_at.desc()).first()
-    
-    options_count = db.query(models.SurveyOption).filter(
-        models.SurveyOption.survey_id == survey_id
-    ).count()
-    
-    # Calcola statistiche gradimento
-    like_stats = calculate_like_stats(survey_id, db)
-    
-    # Recupera il gradimento personale dell'utente
-    user_like_rating = None
-    if user_id or client_ip or session_id:
-        user_like = db.query(models.SurveyLike).filter(
-            models.SurveyLike.survey_id == survey_id,
-            or_(
-                models.SurveyLike.user_ip == client_ip,
-                models.SurveyLike.user_session == session_id
-            )
-        ).first()
-        if user_like:
-            user_like_rating = user_like.rating
-    
-    # Verifica se l'utente ha votato questo sondaggio (sia autenticato che anonimo)
-    if survey.question_type == models.QuestionType.OPEN_TEXT:
-        # Per OPEN_TEXT, verifica open_responses
-        has_user_voted = db.query(models.OpenResponse).filter(
-            models.OpenResponse.survey_id == survey_id,
-            or_(
-                models.OpenResponse.user_id == user_id,
-                models.OpenResponse.voter_ip == client_ip,
-                models.OpenResponse.voter_session == session_id
-            )
-        ).first() is not None
-    else:
-        # Per altri tipi, verifica votes
-        has_user_voted = db.query(models.Vote).filter(
-            models.Vote.survey_id == survey_id,
-            or_(
-                models.Vote.user_id == user_id,
-                models.Vote.voter_ip == client_ip,
-                models.Vote.voter_session == session_id
-            )
-        ).first() is not None
-    
-    return schemas.SurveyStats(
-        survey_id=survey.id,
-        survey_title=survey.title,
-        survey_description=survey.description,
-        question_type=survey.question_type,
-        closure_type=survey.closure_type,
-        created_at=survey.created_at,
-        expires_at=survey.expires_at,
-        is_active=survey.is_active,
-        total_participants=total_participants,
-        total_votes=total_votes,
-        last_vote_at=last_vote[0] if last_vote else None,
-        options_count=options_count,
-        like_stats=like_stats,
-        user_like_rating=user_like_rating,
-        tags=survey.tags,
-        has_user_voted=has_user_voted
+    return bundle.survey_stats(
+        survey, db, user_id, client_ip, session_id,
+        like_stats=calculate_like_stats(survey_id, db),
+        user_like=bundle.find_user_like(survey_id, db, client_ip, session_id)
     )
 
 @app.get("/surveys/{survey_id}/votes-timeline")
@@ -1705,240 +1528,49 @@ def get_votes_timeline(survey_id: int, db: Session = Depends(get_db)):
     if not survey:
         raise HTTPException(status_code=404, detail="Sondaggio non trovato")
     
-    from datetime import datetime, timedelta, date as date_type
-    
-    # Calcola se sono passate meno di 48 ore dalla creazione
-    now = datetime.now(survey.created_at.tzinfo)
-    hours_since_creation = (now - survey.created_at).total_seconds() / 3600
-    use_hourly = hours_since_creation < 48
-    
-    # Determina quale tabella usare in base al tipo di domanda
-    if survey.question_type == models.QuestionType.OPEN_TEXT:
-        table = models.OpenResponse
-        timestamp_field = models.OpenResponse.responded_at
-    else:
-        table = models.Vote
-        timestamp_field = models.Vote.voted_at
-    
-    timeline = []
+    # Granularità oraria nelle prime 48 ore dalla creazione, poi giornaliera (bucket UTC)
+    now = datetime.now(timezone.utc)
+    created_at = survey.created_at.astimezone(timezone.utc)
+    use_hourly = (now - created_at).total_seconds() / 3600 < participants.HOURLY_TIMELINE_HOURS
     
     if use_hourly:
-        # Granularità oraria - conta partecipanti unici per periodo
-        if survey.is_anonymous:
-            # Per sondaggi anonimi, conta distinct voter_session
-            participants = db.query(
-                func.date_trunc('hour', timestamp_field).label('hour'),
-                func.count(func.distinct(table.voter_session)).label('count')
-            ).filter(
-                table.survey_id == survey_id
-            ).group_by(
-                func.date_trunc('hour', timestamp_field)
-            ).order_by(
-                func.date_trunc('hour', timestamp_field)
-            ).all()
-        else:
-            # Per sondaggi NON anonimi, conta distinct user_id
-            participants = db.query(
-                func.date_trunc('hour', timestamp_field).label('hour'),
-                func.count(func.distinct(table.user_id)).label('count')
-            ).filter(
-                table.survey_id == survey_id,
-                table.user_id.isnot(None)
-            ).group_by(
-                func.date_trunc('hour', timestamp_field)
-            ).order_by(
-                func.date_trunc('hour', timestamp_field)
-            ).all()
-        
-        # Aggiungi sempre un punto iniziale all'ora di creazione con 0 partecipanti
-        created_hour = survey.created_at.replace(minute=0, second=0, microsecond=0)
-        timeline.append({
-            'timestamp': created_hour.isoformat(),
-            'votes': 0,
-            'period_votes': 0
-        })
-        
-        # Calcola cumulativo considerando partecipanti unici totali fino a quel momento
-        cumulative_participants = set()
-        last_vote_hour = created_hour
-        
-        for participant in participants:
-            participant_hour = participant.hour
-            last_vote_hour = participant_hour
-            
-            # Query per ottenere partecipanti unici fino a questo momento
-            if survey.is_anonymous:
-                total_until_now = db.query(func.count(func.distinct(table.voter_session))).filter(
-                    table.survey_id == survey_id,
-                    timestamp_field <= participant_hour + timedelta(hours=1)
-                ).scalar()
-            else:
-                total_until_now = db.query(func.count(func.distinct(table.user_id))).filter(
-                    table.survey_id == survey_id,
-                    table.user_id.isnot(None),
-                    timestamp_field <= participant_hour + timedelta(hours=1)
-                ).scalar()
-            
-            # Non duplicare se il voto è nella stessa ora di creazione
-            if participant_hour != created_hour:
-                timeline.append({
-                    'timestamp': participant_hour.isoformat(),
-                    'votes': total_until_now,
-                    'period_votes': participant.count
-                })
-            else:
-                # Aggiorna il punto iniziale
-                timeline[-1] = {
-                    'timestamp': participant_hour.isoformat(),
-                    'votes': total_until_now,
-                    'period_votes': participant.count
-                }
-        
-        # Aggiungi un punto "ora corrente" se diverso dall'ultimo voto
-        current_hour = now.replace(minute=0, second=0, microsecond=0)
-        if last_vote_hour != current_hour:
-            # Calcola totale partecipanti fino ad ora
-            if survey.is_anonymous:
-                total_now = db.query(func.count(func.distinct(table.voter_session))).filter(
-                    table.survey_id == survey_id
-                ).scalar()
-            else:
-                total_now = db.query(func.count(func.distinct(table.user_id))).filter(
-                    table.survey_id == survey_id,
-                    table.user_id.isnot(None)
-                ).scalar()
-            
-            timeline.append({
-                'timestamp': current_hour.isoformat(),
-                'votes': total_now,
-                'period_votes': 0
-            })
+        start = created_at.replace(minute=0, second=0, microsecond=0)
+        current = now.replace(minute=0, second=0, microsecond=0)
     else:
-        # Granularità giornaliera - conta partecipanti unici per periodo
-        if survey.is_anonymous:
-            # Per sondaggi anonimi, conta distinct voter_session
-            participants = db.query(
-                func.date(timestamp_field).label('date'),
-                func.count(func.distinct(table.voter_session)).label('count')
-            ).filter(
-                table.survey_id == survey_id
-            ).group_by(
-                func.date(timestamp_field)
-            ).order_by(
-                func.date(timestamp_field)
-            ).all()
-        else:
-            # Per sondaggi NON anonimi, conta distinct user_id
-            participants = db.query(
-                func.date(timestamp_field).label('date'),
-                func.count(func.distinct(table.user_id)).label('count')
-            ).filter(
-                table.survey_id == survey_id,
-                table.user_id.isnot(None)
-            ).group_by(
-                func.date(timestamp_field)
-            ).order_by(
-                func.date(timestamp_field)
-            ).all()
-        
-        # Aggiungi sempre un punto iniziale alla data di creazione con 0 partecipanti
-        created_date = survey.created_at.date()
-        timeline.append({
-            'timestamp': created_date.isoformat(),
-            'votes': 0,
-            'period_votes': 0
-        })
-        
-        last_vote_date = created_date
-        
-        for participant in participants:
-            participant_date = participant.date
-            last_vote_date = participant_date
-            
-            # Query per ottenere partecipanti unici fino a questo momento
-            if survey.is_anonymous:
-                total_until_now = db.query(func.count(func.distinct(table.voter_session))).filter(
-                    table.survey_id == survey_id,
-                    func.date(timestamp_field) <= participant_date
-                ).scalar()
-            else:
-                total_until_now = db.query(func.count(func.distinct(table.user_id))).filter(
-                    table.survey_id == survey_id,
-                    table.user_id.isnot(None),
-                    func.date(timestamp_field) <= participant_date
-                ).scalar()
-            
-            # Non duplicare se il voto è nella stessa data di creazione
-            if participant_date != created_date:
-                timeline.append({
-                    'timestamp': participant_date.isoformat(),
-                    'votes': total_until_now,
-                    'period_votes': participant.count
-                })
-            else:
-                # Aggiorna il punto iniziale
-                timeline[-1] = {
-                    'timestamp': participant_date.isoformat(),
-                    'votes': total_until_now,
-                    'period_votes': participant.count
-                }
-        
-        # Aggiungi un punto "oggi" se diverso dall'ultimo voto
-        today = date_type.today()
-        if last_vote_date != today:
-            # Calcola totale partecipanti fino ad oggi
-            if survey.is_anonymous:
-                total_now = db.query(func.count(func.distinct(table.voter_session))).filter(
-                    table.survey_id == survey_id
-                ).scalar()
-            else:
-                total_now = db.query(func.count(func.distinct(table.user_id))).filter(
-                    table.survey_id == survey_id,
-                    table.user_id.isnot(None)
-                ).scalar()
-            
-            timeline.append({
-                'timestamp': today.isoformat(),
-                'votes': total_now,
-                'period_votes': 0
-            })
+        start = created_at.date()
+        current = now.date()
+    
+    # (periodo, partecipanti unici nel periodo, partecipanti unici fino al periodo):
+    # una query esatta per i sondaggi piccoli, unione degli sketch HyperLogLog per quelli grandi
+    counts = participants.timeline_counts(survey, db, 'hour' if use_hourly else 'day')
     
     return {
         'survey_id': survey_id,
         'created_at': survey.created_at.isoformat(),
         'granularity': 'hourly' if use_hourly else 'daily',
-        'timeline': timeline
+        'timeline': participants.timeline_points(start, current, counts)
     }
 
-# ===== ENDPOINTS PER I GRADIMENTI =====
+@app.get("/api/analytics/participants")
+def get_participants_union(survey_ids: str, db: Session = Depends(get_db)):
+    """
+    Partecipanti unici complessivi su più sondaggi (?survey_ids=1,2,3).
+    Stima HyperLogLog dall'unione degli sketch: costo indipendente dal numero di voti.
+    """
+    try:
+        ids = sorted({int(x) for x in survey_ids.split(",") if x.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="survey_ids deve essere una lista di interi separati da virgola")
+    if not ids:
+        raise HTTPException(status_code=400, detail="Specificare almeno un sondaggio")
+    
+    return {
+        'survey_ids': ids,
+        'unique_participants': participants.union_count(ids, db),
+        'approximate': True
+    }
 
-def calculate_like_stats(survey_id: int, db: Session) -> Optional[schemas.SurveyLikeStats]:
-    """Calcola le statistiche dei gradimenti per un sondaggio"""
-    likes = db.query(models.SurveyLike).filter(
-        models.SurveyLike.survey_id == survey_id
-    ).all()
-    
-    if not likes:
-        return None
-    
-    ratings = [like.rating for like in likes]
-    total_likes = len(ratings)
-    average_rating = sum(ratings) / total_likes
-    
-    # Calcola la distribuzione (1-5)
-    rating_counts = Counter(ratings)
-    distribution = []
-    for val in range(1, 6):
-        distribution.append(schemas.ValueDistribution(
-            value=float(val),
-            count=rating_counts.get(val, 0)
-        ))
-    
-    return schemas.SurveyLikeStats(
-        average_rating=round(average_rating, 2),
-        total_likes=total_likes,
-        rating_distribution=distribution
-    )
+# ===== ENDPOINTS PER I GRADIMENTI =====
 
 @app.post("/surveys/{survey_id}/like")
 async def like_survey(
@@ -1961,16 +1593,17 @@ async def like_survey(
         user_id = None
     
     # Ottieni session
-    client_ip = request.client.host
+    client_ip = get_client_ip(request)
     session_id = get_or_create_session(request)
     
+    # I gradimenti fanno parte dei risultati finali: su un sondaggio chiuso lo snapshot va ricalcolato
+    if results.is_closed(survey):
+        results.invalidate_snapshot(survey_id, db)
+    
     # Verifica se ha già valutato
     existing = db.query(models.SurveyLike).filter(
         models.SurveyLike.survey_id == survey_id,
-        or_(
-            models.SurveyLike.user_ip == client_ip,
-            models.SurveyLike.user_session == session_id
-        )
+        same_voter(models.SurveyLike.user_ip, models.SurveyLike.user_session, client_ip, session_id)
     ).first()
     
     if existing:
@@ -2007,15 +1640,12 @@ def get_user_like(
     if not survey:
         raise HTTPException(status_code=404, detail="Sondaggio non trovato")
     
-    client_ip = request.client.host
+    client_ip = get_client_ip(request)
     session_id = get_or_create_session(request)
     
     existing = db.query(models.SurveyLike).filter(
         models.SurveyLike.survey_id == survey_id,
-        or_(
-            models.SurveyLike.user_ip == client_ip,
-            models.SurveyLike.user_session == session_id
-        )
+        same_voter(models.SurveyLike.user_ip, models.SurveyLike.user_session, client_ip, session_id)
     ).first()
     
     return existing
@@ -2102,52 +1732,39 @@ async def reset_setting(key: str, request: Request, db: Session = Depends(get_db
 
 # ===== STATIC FILE SERVING FOR REACT FRONTEND =====
 
+# File serviti dal manifest in memoria (static_files): ETag, 304 e Cache-Control immutable
+# per i file con hash nel nome, fratello .br/.gz se il client lo accetta
+
 @app.get("/favicon.svg")
-async def serve_favicon():
+async def serve_favicon(request: Request):
     """Serve favicon.svg from root"""
-    full_path = os.path.join(static_dir, "favicon.svg")
-    if os.path.exists(full_path):
-        return FileResponse(full_path, media_type="image/svg+xml")
+    entry = static_manifest.get("favicon.svg")
+    if entry:
+        return static_manifest.response(entry, request)
     raise HTTPException(status_code=404, detail="Favicon not found")
 
 
 @app.get("/assets/{file_path:path}")
-async def serve_assets(file_path: str):
+async def serve_assets(file_path: str, request: Request):
     """Serve asset files (logos, images, etc.)"""
-    full_path = os.path.join(static_dir, "assets", file_path)
-    if os.path.exists(full_path) and os.path.isfile(full_path):
-        # Use mimetypes to get correct Content-Type
-        media_type, _ = mimetypes.guess_type(full_path)
-        return FileResponse(full_path, media_type=media_type)
+    entry = static_manifest.get("assets/" + file_path)
+    if entry:
+        return static_manifest.response(entry, request)
     raise HTTPException(status_code=404, detail=f"Asset not found: {file_path}")
 
 
 @app.get("/static/{file_path:path}")
-async def serve_static_files(file_path: str):
+async def serve_static_files(file_path: str, request: Request):
     """Serve static files (JS, CSS, images, etc.) - handles all nested paths"""
-    # React build mette le immagini in static/static/media/
-    # Prima prova il path diretto, poi prova con static/ prefisso
-    full_path = os.path.join(static_dir, file_path)
-    
-    if not os.path.exists(full_path) or not os.path.isfile(full_path):
-        # Se il file non esiste nel path diretto e inizia con "media/", 
-        # prova in static/media/ (React build structure)
-        if file_path.startswith("media/"):
-            full_path = os.path.join(static_dir, "static", file_path)
-    
-    if os.path.exists(full_path) and os.path.isfile(full_path):
-        # Use mimetypes to get correct Content-Type for all file types
-        media_type, _ = mimetypes.guess_type(full_path)
-        if file_path.endswith('.svg') and not media_type:
-            media_type = "image/svg+xml"
-        elif file_path.endswith('.png') and not media_type:
-            media_type = "image/png"
-        elif file_path.endswith('.jpg') and not media_type:
-            media_type = "image/jpeg"
-        return FileResponse(full_path, media_type=media_type)
-    
-    # Log only 404s for debugging
-    print(f"❌ Static file not found: /static/{file_path}")
+    # React build mette le immagini in static/static/media/: prima il path diretto, poi con static/ prefisso
+    entry = static_manifest.get(file_path)
+    if entry is None and file_path.startswith("media/"):
+        entry = static_manifest.get("static/" + file_path)
+    if entry:
+        return static_manifest.response(entry, request)
+    
+    # 404 campionati: un client con cache vecchia ne genera a raffica
+    logger.warning("Static file not found: /static/%s", file_path, extra={"sample_rate": 0.1})
     raise HTTPException(status_code=404, detail=f"File not found: {file_path}")
 
 
@@ -2180,89 +1797,43 @@ async def get_h3_map_data(
     Returns:
         List of hexagons with GeoJSON boundaries and counts
     """
-    import json
-    import asyncio
-    from concurrent.futures import ThreadPoolExecutor
-    from shapely.geometry import Polygon
-    from sql_warehouse_connector import execute_sql_warehouse_query
-    
     # Use parameters from request (dynamic table selection)
     # Resolution is used as the second parameter in h3_toparent(column, resolution)
+    bounds = None
+    if all([min_lat is not None, max_lat is not None, min_lng is not None, max_lng is not None]):
+        bounds = (min_lat, max_lat, min_lng, max_lng)
     
     try:
-        # Build bounds filter if provided
-        bounds_filter = ""
-        if all([min_lat is not None, max_lat is not None, min_lng is not None, max_lng is not None]):
-            # Create WKT polygon for bounds
-            polygon_coords = [
-                (min_lng, min_lat),  # lower left
-                (min_lng, max_lat),  # upper left
-                (max_lng, max_lat),  # upper right
-                (max_lng, min_lat),  # lower right
-                (min_lng, min_lat)   # close polygon
-            ]
-            poly = Polygon(polygon_coords)
-            bounds_wkt = poly.wkt
-            bounds_filter = f"AND h3_toparent({column}, {resolution}) IN (SELECT EXPLODE(H3_COVERASH3('{bounds_wkt}', {resolution})))"
-        
-        # Query for H3 data using SQL Warehouse
-        query = f"""
-            WITH cell_agg AS (
-                SELECT
-                    h3_toparent({column}, {resolution}) as h3_cell_id,
-                    count(*) as count
-                FROM {catalog}.{schema}.{table}
-                WHERE 1=1 {bounds_filter}
-                GROUP BY h3_cell_id
+        # Viewport scomposto in tile (h3_tiles): solo le tile non in cache vanno al SQL Warehouse
+        # (client ed executor condivisi, timeout WAREHOUSE_QUERY_TIMEOUT: il warehouse può impiegare 2-3 minuti ad avviarsi)
+        try:
+            data, tiles = await h3_tiles.get_hexagons(catalog, schema, table, column, resolution, bounds)
+        except sql_warehouse_connector.WarehouseUnavailable as e:
+            # Circuit breaker aperto (warehouse fermo o in avvio) o troppe query in coda: risposta immediata
+            raise HTTPException(
+                status_code=503,
+                detail="SQL Warehouse temporarily unavailable. It may be starting up. Please try again shortly.",
+                headers={"Retry-After": str(max(1, int(e.retry_after)))}
+            )
+        except sql_warehouse_connector.WarehouseTimeout:
+            logger.error("H3 query timed out", extra={"resolution": resolution})
+            raise HTTPException(
+                status_code=504, 
+                detail="Query timeout: SQL Warehouse took too long to respond. It may be starting up. Please try again in 1-2 minutes."
             )
-            SELECT h3_boundaryasgeojson(h3_cell_id) as hex_boundary,
-                   count
-            FROM cell_agg
-            ORDER BY count DESC
-        """
-        
-        # Execute query on SQL Warehouse (not Lakebase) with timeout
-        # SQL Warehouse may take 2-3 minutes to start if stopped
-        print("Starting query execution with 180s timeout...")
-        
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as pool:
-            try:
-                # Run the blocking SQL query in a thread with 3 minute timeout
-                df = await asyncio.wait_for(
-                    loop.run_in_executor(pool, execute_sql_warehouse_query, query, request),
-                    timeout=180.0  # 3 minutes for warehouse to start and execute query
-                )
-                print(f"Query completed successfully, processing {len(df)} rows")
-            except asyncio.TimeoutError:
-                print("ERROR: Query timed out after 180 seconds")
-                raise HTTPException(
-                    status_code=504, 
-                    detail="Query timeout: SQL Warehouse took too long to respond. It may be starting up. Please try again in 1-2 minutes."
-                )
-        
-        # Process results
-        data = []
-        for _, row in df.iterrows():
-            hex_boundary = json.loads(row['hex_boundary']) if isinstance(row['hex_boundary'], str) else row['hex_boundary']
-            data.append({
-                "hex_boundary": hex_boundary,
-                "count": int(row['count'])
-            })
         
-        print(f"Returning {len(data)} hexagons")
-        return {
+        logger.info("Returning %d hexagons", len(data), extra={"resolution": resolution})
+        return serialization.json_response({
             "data": data,
             "resolution": resolution,
-            "total_hexagons": len(data)
-        }
+            "total_hexagons": len(data),
+            "tiles": tiles
+        })
         
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        print(f"Error fetching H3 data: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error fetching H3 data")
         raise HTTPException(status_code=500, detail=f"Error fetching H3 data: {str(e)}")
 
 
@@ -2284,7 +1855,7 @@ async def get_map_config():
 
 
 @app.get("/{full_path:path}", response_class=HTMLResponse)
-async def serve_spa_routes(full_path: str):
+async def serve_spa_routes(full_path: str, request: Request):
     """Serve the React app for all other routes (SPA routing)"""
     # Don't intercept API, metrics, static, assets, media, tags, surveys, or settings routes
     if (full_path.startswith("api/") or 
@@ -2296,11 +1867,10 @@ async def serve_spa_routes(full_path: str):
         full_path.startswith("settings")):
         raise HTTPException(status_code=404, detail="Route not found")
     
-    # Serve index.html for all other routes (React Router will handle them)
-    index_file = os.path.join(static_dir, "index.html")
-    if os.path.exists(index_file):
-        with open(index_file, 'r') as f:
-            return HTMLResponse(content=f.read(), status_code=200)
+    # Serve index.html for all other routes (React Router will handle them), dalla memoria
+    entry = static_manifest.get("index.html")
+    if entry:
+        return static_manifest.response(entry, request)
     
     return HTMLResponse(
         content="<html><body><h1>Frontend not built</h1><p>Run ./build.sh to build the frontend</p></body></html>",
@@ -0,0 +1,148 @@
+"""
+Bundle della pagina di dettaglio di un sondaggio (GET /surveys/{id}/bundle)
+
+La pagina di un sondaggio chiamava /surveys/{id}, /stats, /results, /like e
+/like/stats: cinque richieste che ricaricano ogni volta il sondaggio e l'utente.
+Il bundle le restituisce in una sola risposta condividendo il caricamento del
+sondaggio (con opzioni, tag e creatore), l'utente corrente, il gradimento
+dell'utente e le statistiche di gradimento.
+
+?include=survey,stats,... sceglie le parti (default: tutte); ogni parte ha la
+stessa forma della risposta dell'endpoint corrispondente.
+"""
+from typing import Optional, Set
+
+from fastapi import HTTPException
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+import models, schemas, results, participants, serialization
+from voter_identity import same_voter
+
+BUNDLE_PARTS = ("survey", "stats", "results", "like", "like_stats")
+
+
+def parse_include(include: Optional[str]) -> Set[str]:
+    if not include:
+        return set(BUNDLE_PARTS)
+    parts = {part.strip() for part in include.split(",") if part.strip()}
+    unknown = parts - set(BUNDLE_PARTS)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Parti non valide: {', '.join(sorted(unknown))} (ammesse: {', '.join(BUNDLE_PARTS)})"
+        )
+    return parts
+
+
+def find_user_like(survey_id: int, db: Session, client_ip: Optional[str], session_id: Optional[str]) -> Optional[models.SurveyLike]:
+    """Gradimento dato dal votante corrente (IP o sessione)"""
+    return db.query(models.SurveyLike).filter(
+        models.SurveyLike.survey_id == survey_id,
+        same_voter(models.SurveyLike.user_ip, models.SurveyLike.user_session, client_ip, session_id)
+    ).first()
+
+
+def survey_stats(
+    survey: models.Survey,
+    db: Session,
+    user_id: Optional[int],
+    client_ip: Optional[str],
+    session_id: Optional[str],
+    like_stats: Optional[schemas.SurveyLikeStats],
+    user_like: Optional[models.SurveyLike]
+) -> schemas.SurveyStats:
+    """Statistiche di /surveys/{id}/stats; gradimenti già calcolati dal chiamante"""
+    survey_id = survey.id
+
+    # Calcola total_votes in base al tipo di sondaggio (i partecipanti arrivano dagli sketch HLL)
+    if survey.question_type == models.QuestionType.OPEN_TEXT:
+        # Per OPEN_TEXT, usa open_responses
+        total_votes = db.query(models.OpenResponse).filter(
+            models.OpenResponse.survey_id == survey_id
+        ).count()
+    else:
+        # Per altri tipi, usa votes
+        total_votes = db.query(models.Vote).filter(models.Vote.survey_id == survey_id).count()
+
+    last_vote = db.query(models.Vote.voted_at).filter(
+        models.Vote.survey_id == survey_id
+    ).order_by(models.Vote.voted_at.desc()).first()
+
+    # Verifica se l'utente ha votato questo sondaggio (sia autenticato che anonimo)
+    rows_model = models.OpenResponse if survey.question_type == models.QuestionType.OPEN_TEXT else models.Vote
+    has_user_voted = db.query(rows_model.id).filter(
+        rows_model.survey_id == survey_id,
+        or_(
+            rows_model.user_id == user_id,
+            same_voter(rows_model.voter_ip, rows_model.voter_session, client_ip, session_id)
+        )
+    ).first() is not None
+
+    return schemas.SurveyStats(
+        survey_id=survey.id,
+        survey_title=survey.title,
+        survey_description=survey.description,
+        question_type=survey.question_type,
+        closure_type=survey.closure_type,
+        created_at=survey.created_at,
+        expires_at=survey.expires_at,
+        is_active=survey.is_active,
+        total_participants=participants.count_participants(survey, db),
+        total_votes=total_votes,
+        last_vote_at=last_vote[0] if last_vote else None,
+        # Le opzioni sono già caricate con il sondaggio
+        options_count=len(survey.options),
+        like_stats=like_stats,
+        user_like_rating=user_like.rating if user_like else None,
+        tags=survey.tags,
+        has_user_voted=has_user_voted
+    )
+
+
+def build_bundle(
+    survey: models.Survey,
+    db: Session,
+    parts: Set[str],
+    user_id: Optional[int],
+    client_ip: Optional[str],
+    session_id: Optional[str]
+) -> dict:
+    """Parti richieste del bundle, con i dati condivisi calcolati una sola volta"""
+    bundle = {}
+
+    # Le statistiche di gradimento servono anche ai risultati dei sondaggi aperti (quelli chiusi hanno lo snapshot)
+    like_stats = None
+    if parts & {"stats", "like_stats"} or ("results" in parts and not results.is_closed(survey)):
+        like_stats = results.calculate_like_stats(survey.id, db)
+    user_like = None
+    if parts & {"stats", "like"}:
+        user_like = find_user_like(survey.id, db, client_ip, session_id)
+
+    if "survey" in parts:
+        bundle["survey"] = serialization.survey_dict(survey)
+
+    if "stats" in parts:
+        bundle["stats"] = survey_stats(
+            survey, db, user_id, client_ip, session_id, like_stats, user_like
+        ).model_dump()
+
+    if "results" in parts:
+        if results.is_closed(survey):
+            payload = results.get_survey_results_payload(survey, db)
+        else:
+            # Le statistiche di gradimento sono già calcolate: non rileggerle
+            fields = set(schemas.SurveyResultsResponse.model_fields) - {"like_stats"}
+            payload = results.get_survey_results_payload(survey, db, fields)
+            payload["like_stats"] = like_stats.model_dump() if like_stats else None
+        # Campi utente solo per sondaggi non anonimi (come /surveys/{id}/results)
+        payload.update(results.user_result_fields(survey, None if survey.is_anonymous else user_id, db))
+        bundle["results"] = payload
+
+    if "like" in parts:
+        bundle["like"] = schemas.SurveyLike.model_validate(user_like).model_dump() if user_like else None
+
+    if "like_stats" in parts:
+        bundle["like_stats"] = like_stats.model_dump() if like_stats else None
+
+    return bundle
@@ -0,0 +1,211 @@
+"""
+Compressione delle risposte (gzip / brotli) e file statici precompressi
+
+CompressionMiddleware comprime le risposte sopra COMPRESSION_MIN_SIZE byte
+scegliendo la codifica dall'header Accept-Encoding (brotli se il modulo è
+installato, altrimenti gzip). Le risposte in streaming (export, StreamingResponse)
+vengono compresse blocco per blocco, con un flush per blocco: il client riceve
+i dati man mano senza attendere la fine della risposta.
+
+Non vengono ricompresse le risposte che hanno già un Content-Encoding (file
+statici precompressi), i tipi già compressi (immagini, Parquet, zip) e le
+risposte con Cache-Control: no-transform.
+
+I file del bundle React vengono precompressi al build (build.sh):
+    python backend/compression.py precompress backend/static
+e static_files serve il fratello .br/.gz accettato dal client.
+"""
+import gzip
+import os
+import sys
+import zlib
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # brotli è opzionale: senza il modulo si usa solo gzip
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+# Qualità bassa per le risposte dinamiche: il massimo (11) si usa solo al build
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/geo+json", "application/x-ndjson",
+    "application/javascript", "application/xml", "image/svg+xml",
+)
+PRECOMPRESS_EXTENSIONS = (".js", ".css", ".html", ".json", ".svg", ".map", ".txt", ".ico")
+
+
+def accepted_encodings(header: Optional[str]) -> Dict[str, float]:
+    """Codifiche dell'header Accept-Encoding con il loro q-value (q=0 = rifiutata)"""
+    accepted = {}
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def accepts(accepted: Dict[str, float], coding: str) -> bool:
+    return accepted.get(coding, accepted.get("*", 0.0)) > 0
+
+
+def choose_encoding(header: Optional[str]) -> Optional[str]:
+    accepted = accepted_encodings(header)
+    if brotli is not None and accepts(accepted, "br"):
+        return "br"
+    if accepts(accepted, "gzip"):
+        return "gzip"
+    return None
+
+
+def _compressible(headers: Headers) -> bool:
+    if "content-encoding" in headers:
+        return False
+    if "no-transform" in headers.get("cache-control", ""):
+        return False
+    content_type = headers.get("content-type", "")
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            # wbits=31: stream zlib con header e trailer gzip
+            self._zlib = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        """Comprime un blocco e fa flush: i byte sono subito decodificabili dal client"""
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_FINISH)
+
+
+def _weaken_etag(headers: MutableHeaders):
+    """
+    La risposta compressa al volo è una rappresentazione diversa dall'originale:
+    un ETag forte condiviso violerebbe RFC 9110. Lo rende debole (W/"..."), che
+    il confronto di If-None-Match (debole) continua ad accettare.
+    """
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["ETag"] = f"W/{etag}"
+
+
+class CompressionMiddleware:
+    """Middleware ASGI: gzip/brotli sopra COMPRESSION_MIN_SIZE, con supporto allo streaming"""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+        passthrough = False
+        # Il client rivalida una risposta compressa qui (ETag debole)
+        weak_validator = "W/" in (Headers(scope=scope).get("if-none-match") or "")
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                if message["status"] == 304 and weak_validator:
+                    # Il 200 sarebbe stato compresso: stesso ETag debole della risposta in cache
+                    _weaken_etag(MutableHeaders(raw=message["headers"]))
+                # Rimandato al primo blocco del body: serve per decidere se comprimere
+                start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                if start_message is not None:
+                    await send(start_message)
+                    start_message = None
+                passthrough = True
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                if not _compressible(headers) or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(start_message)
+                    start_message = None
+                    await send(message)
+                    return
+                compressor = _Compressor(encoding)
+                headers["Content-Encoding"] = encoding
+                _weaken_etag(headers)
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    # Lunghezza finale non nota: chunked transfer
+                    del headers["Content-Length"]
+                    body = compressor.compress(body)
+                else:
+                    body = compressor.finish(body)
+                    headers["Content-Length"] = str(len(body))
+                await send(start_message)
+                start_message = None
+            else:
+                body = compressor.compress(body) if more_body else compressor.finish(body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def precompress_directory(directory: str) -> int:
+    """Scrive i fratelli .gz (e .br se brotli è installato) dei file testuali del bundle"""
+    count = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            if len(data) < COMPRESSION_MIN_SIZE:
+                continue
+            with open(path + ".gz", "wb") as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(path + ".br", "wb") as f:
+                    f.write(brotli.compress(data, quality=11))
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "precompress":
+        print("Uso: python compression.py precompress <directory>")
+        sys.exit(1)
+    if brotli is None:
+        print("⚠️  Modulo brotli non installato: genero solo i file .gz")
+    print(f"✅ Precompressi {precompress_directory(sys.argv[2])} file in {sys.argv[2]}")
@@ -13,6 +13,7 @@ from sqlalchemy.orm import sessionmaker
 import os
 from pathlib import Path
 from dotenv import load_dotenv
+from metrics import TimedQueuePool
 
 # Carica variabili d'ambiente dal file .env.lakebase se esiste
 env_path = Path(__file__).parent.parent / '.env.lakebase'
@@ -71,6 +72,7 @@ if USE_LAKEBASE:
         DATABASE_URL,
         pool_pre_ping=True,  # Verifica connessione prima dell'uso
         echo=False,  # Set True per debug SQL
+        poolclass=TimedQueuePool,  # Misura l'attesa del checkout (/metrics)
         pool_size=5,
         max_overflow=10,
         connect_args={
@@ -101,6 +103,7 @@ else:
     # Engine per PostgreSQL locale con schema webdemocracy
     engine = create_engine(
         DATABASE_URL,
+        poolclass=TimedQueuePool,  # Misura l'attesa del checkout (/metrics)
         connect_args={
             "options": f"-c search_path={local_schema},public"
         }
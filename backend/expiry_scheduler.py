@@ -0,0 +1,199 @@
+"""
+Scheduler in-process per la scadenza dei sondaggi (ClosureType.SCHEDULED)
+
+Mantiene un min-heap (expires_at, survey_id) delle prossime scadenze e chiude in
+batch i sondaggi scaduti con un unico UPDATE ... RETURNING, fuori dal percorso
+delle richieste. Per ogni sondaggio chiuso esegue gli hook on_close (snapshot dei
+risultati, invalidazione cache).
+
+Con più istanze dell'app ogni processo ha il proprio scheduler: l'UPDATE filtra
+su is_active, quindi ogni sondaggio viene chiuso (e i suoi hook eseguiti) una sola volta.
+Il heap viene ricaricato periodicamente dal database per intercettare i sondaggi
+creati o modificati da altre istanze.
+
+Lo stesso thread esegue anche i job periodici registrati con add_periodic()
+(es. la creazione delle partizioni mensili di votes/open_responses).
+"""
+import heapq
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+from sqlalchemy import update
+
+import models
+import results
+
+logger = logging.getLogger(__name__)
+
+# Secondi tra due ricariche complete delle scadenze dal database
+EXPIRY_RELOAD_INTERVAL = float(os.getenv("EXPIRY_RELOAD_INTERVAL", "300"))
+# Le scadenze entro questa finestra vengono chiuse nello stesso batch
+EXPIRY_BATCH_WINDOW = float(os.getenv("EXPIRY_BATCH_WINDOW", "1.0"))
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def is_expired(survey: models.Survey) -> bool:
+    """True se la scadenza del sondaggio è passata (anche se lo scheduler non l'ha ancora chiuso)"""
+    return survey.expires_at is not None and _as_utc(survey.expires_at) <= datetime.now(timezone.utc)
+
+
+# Hook eseguiti nella stessa transazione della chiusura: fn(survey, db)
+_on_close_hooks: List[Callable] = [results.freeze_results]
+
+
+def register_on_close(hook: Callable):
+    """Registra un hook da eseguire alla chiusura automatica di un sondaggio"""
+    if hook not in _on_close_hooks:
+        _on_close_hooks.append(hook)
+
+
+class ExpiryScheduler:
+    def __init__(self):
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._session_factory = None
+        self._wait_ready = None
+        # Job periodici: [fn, intervallo in secondi, prossima esecuzione (timestamp)]
+        self._periodic = []
+
+    def add_periodic(self, fn: Callable, interval: float):
+        """Esegue fn() ogni interval secondi nel thread dello scheduler (la prima volta all'avvio)"""
+        with self._condition:
+            self._periodic.append([fn, interval, 0.0])
+            self._condition.notify()
+
+    def start(self, session_factory, wait_ready: Optional[Callable] = None):
+        """Avvia il thread dello scheduler (idempotente)"""
+        with self._condition:
+            if self._thread and self._thread.is_alive():
+                return
+            self._session_factory = session_factory
+            self._wait_ready = wait_ready
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="survey-expiry-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def schedule(self, survey_id: int, expires_at: Optional[datetime]):
+        """Aggiunge una scadenza al heap (le voci obsolete vengono scartate alla chiusura)"""
+        if expires_at is None:
+            return
+        with self._condition:
+            heapq.heappush(self._heap, (_as_utc(expires_at), survey_id))
+            self._condition.notify()
+
+    def reload(self):
+        """Ricarica dal database tutte le scadenze dei sondaggi attivi (indice parziale idx_surveys_active_expiry)"""
+        db = self._session_factory()
+        try:
+            rows = db.query(models.Survey.expires_at, models.Survey.id).filter(
+                models.Survey.is_active == True,
+                models.Survey.expires_at.isnot(None)
+            ).all()
+        finally:
+            db.close()
+        with self._condition:
+            loaded_ids = {survey_id for _, survey_id in rows}
+            # Mantiene le voci aggiunte con schedule() per sondaggi non ancora visti dalla query
+            self._heap = [(_as_utc(expires_at), survey_id) for expires_at, survey_id in rows] + [
+                entry for entry in self._heap if entry[1] not in loaded_ids
+            ]
+            heapq.heapify(self._heap)
+            self._condition.notify()
+        return len(rows)
+
+    def close_due(self, survey_ids: List[int]) -> List[int]:
+        """Chiude in batch i sondaggi ancora attivi e scaduti ed esegue gli hook on_close"""
+        db = self._session_factory()
+        try:
+            closed_ids = db.execute(
+                update(models.Survey)
+                .where(
+                    models.Survey.id.in_(survey_ids),
+                    models.Survey.is_active == True,
+                    models.Survey.expires_at <= datetime.now(timezone.utc)
+                )
+                .values(is_active=False)
+                .returning(models.Survey.id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            if closed_ids:
+                for survey in db.query(models.Survey).filter(models.Survey.id.in_(closed_ids)).all():
+                    for hook in _on_close_hooks:
+                        hook(survey, db)
+            db.commit()
+            return closed_ids
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _pop_due(self) -> List[int]:
+        horizon = datetime.now(timezone.utc).timestamp() + EXPIRY_BATCH_WINDOW
+        due = set()
+        while self._heap and self._heap[0][0].timestamp() <= horizon:
+            due.add(heapq.heappop(self._heap)[1])
+        return sorted(due)
+
+    def _run(self):
+        if self._wait_ready:
+            self._wait_ready()
+        next_reload = 0.0
+        while True:
+            now = datetime.now(timezone.utc).timestamp()
+            if now >= next_reload:
+                try:
+                    count = self.reload()
+                    logger.info("⏰ Expiry scheduler: %d scheduled surveys loaded", count)
+                except Exception:
+                    logger.exception("Expiry scheduler reload failed")
+                next_reload = now + EXPIRY_RELOAD_INTERVAL
+
+            for job in self._periodic:
+                if now >= job[2]:
+                    try:
+                        job[0]()
+                    except Exception:
+                        logger.exception("Periodic job %s failed", getattr(job[0], "__name__", job[0]))
+                    job[2] = now + job[1]
+
+            with self._condition:
+                if self._stopping:
+                    return
+                due = self._pop_due()
+                if not due:
+                    timeout = min([next_reload] + [job[2] for job in self._periodic]) - now
+                    if self._heap:
+                        timeout = min(timeout, self._heap[0][0].timestamp() - now)
+                    self._condition.wait(max(timeout, 0.05))
+                    continue
+
+            try:
+                closed = self.close_due(due)
+                if closed:
+                    logger.info("⏰ Expiry scheduler: closed surveys %s", closed)
+            except Exception:
+                logger.exception("Expiry scheduler failed to close %s", due)
+                # Riprova al prossimo giro
+                with self._condition:
+                    retry_at = datetime.now(timezone.utc).timestamp() + 30
+                    for survey_id in due:
+                        heapq.heappush(self._heap, (datetime.fromtimestamp(retry_at, timezone.utc), survey_id))
+
+
+scheduler = ExpiryScheduler()
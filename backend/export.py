@@ -0,0 +1,262 @@
+"""
+Export in streaming dei dati di un sondaggio (CSV, NDJSON, Parquet)
+
+Le righe vengono lette con un cursore lato server (yield_per) e scritte nella
+risposta a blocchi di EXPORT_BATCH_SIZE: la memoria resta costante anche per
+sondaggi con centinaia di migliaia di voti.
+
+Dataset disponibili:
+- votes / open_responses / likes: righe grezze
+- results: risultati aggregati (gli stessi di /surveys/{id}/results)
+
+Anonimato: IP e sessione del votante non vengono mai esportati; user_id
+solo per i sondaggi non anonimi.
+Il formato Parquet richiede pyarrow (opzionale).
+"""
+import csv
+import io
+import json
+import os
+from datetime import date, datetime
+from itertools import islice
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+import models
+import results
+from partitioning import survey_rows
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# dataset -> [(colonna, tipo)] con tipo in int | float | str | datetime
+DATASET_COLUMNS = {
+    "votes": [
+        ("vote_id", "int"), ("survey_id", "int"), ("option_id", "int"), ("option_text", "str"),
+        ("numeric_value", "float"), ("date_value", "datetime"), ("voted_at", "datetime"), ("user_id", "int"),
+    ],
+    "open_responses": [
+        ("response_id", "int"), ("survey_id", "int"), ("option_id", "int"), ("option_text", "str"),
+        ("response_text", "str"), ("responded_at", "datetime"), ("user_id", "int"),
+    ],
+    "likes": [
+        ("like_id", "int"), ("survey_id", "int"), ("rating", "int"), ("comment", "str"),
+        ("created_at", "datetime"), ("user_id", "int"),
+    ],
+    "results": [
+        ("survey_id", "int"), ("option_id", "int"), ("option_text", "str"), ("value", "float"),
+        ("vote_count", "int"), ("percentage", "float"), ("numeric_average", "float"),
+        ("numeric_median", "float"), ("numeric_min", "float"), ("numeric_max", "float"),
+    ],
+}
+
+def default_dataset(survey: models.Survey) -> str:
+    """Dataset grezzo naturale per il tipo di domanda"""
+    return "open_responses" if survey.question_type == models.QuestionType.OPEN_TEXT else "votes"
+
+
+def export_columns(dataset: str, survey: models.Survey) -> List[Tuple[str, str]]:
+    """Colonne esportate: senza user_id se il sondaggio è anonimo"""
+    columns = DATASET_COLUMNS[dataset]
+    if survey.is_anonymous:
+        columns = [c for c in columns if c[0] != "user_id"]
+    return columns
+
+
+def _raw_query(db, dataset: str, survey: models.Survey):
+    if dataset == "votes":
+        model = models.Vote
+        query = db.query(
+            model.id, model.survey_id, model.option_id, model.numeric_value,
+            model.date_value, model.voted_at, model.user_id
+        ).filter(*survey_rows(model, survey)).order_by(model.voted_at)
+    elif dataset == "open_responses":
+        model = models.OpenResponse
+        query = db.query(
+            model.id, model.survey_id, model.option_id, model.response_text,
+            model.responded_at, model.user_id
+        ).filter(*survey_rows(model, survey)).order_by(model.responded_at)
+    else:
+        model = models.SurveyLike
+        query = db.query(
+            model.id, model.survey_id, model.rating, model.comment, model.created_at, model.user_id
+        ).filter(model.survey_id == survey.id).order_by(model.id)
+    # yield_per abilita stream_results: psycopg2 usa un cursore lato server
+    return query.yield_per(EXPORT_BATCH_SIZE)
+
+
+def _raw_batches(db, dataset: str, survey: models.Survey) -> Iterator[List[tuple]]:
+    """Blocchi di righe (già nell'ordine di export_columns)"""
+    option_texts = {}
+    if dataset != "likes":
+        # Le opzioni sono poche: dizionario in memoria invece di una JOIN sulla tabella dei voti
+        option_texts = dict(db.query(models.SurveyOption.id, models.SurveyOption.option_text).filter(
+            models.SurveyOption.survey_id == survey.id
+        ).all())
+    keep_user = not survey.is_anonymous
+
+    rows = iter(_raw_query(db, dataset, survey))
+    while True:
+        partition = list(islice(rows, EXPORT_BATCH_SIZE))
+        if not partition:
+            break
+        batch = []
+        for row in partition:
+            if dataset == "votes":
+                values = (row[0], row[1], row[2], option_texts.get(row[2]), row[3], row[4], row[5])
+            elif dataset == "open_responses":
+                values = (row[0], row[1], row[2], option_texts.get(row[2]), row[3], row[4])
+            else:
+                values = tuple(row[:5])
+            batch.append(values + (row[-1],) if keep_user else values)
+        yield batch
+
+
+def _results_batches(db, survey: models.Survey) -> Iterator[List[tuple]]:
+    """Risultati aggregati: una riga per opzione, più la distribuzione dei valori se presente"""
+    response = results.get_survey_results(survey, db)
+    rows = [
+        (survey.id, r.option_id, r.option_text, None, r.vote_count, r.percentage,
+         r.numeric_average, r.numeric_median, r.numeric_min, r.numeric_max)
+        for r in response.results
+    ]
+    for d in response.value_distribution or []:
+        rows.append((survey.id, None, None, d.value, d.count, None, None, None, None, None))
+    yield rows
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _csv_chunks(columns, batches) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    for batch in batches:
+        writer.writerows([_json_value(v) for v in row] for row in batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _ndjson_chunks(columns, batches) -> Iterator[bytes]:
+    names = [name for name, _ in columns]
+    for batch in batches:
+        lines = [
+            json.dumps({n: _json_value(v) for n, v in zip(names, row)}, ensure_ascii=False)
+            for row in batch
+        ]
+        if lines:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _ChunkSink:
+    """File-like minimale per pyarrow: accumula i byte scritti, svuotati dopo ogni row group"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _parquet_chunks(columns, batches) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string(), "datetime": pa.timestamp("us", tz="UTC")}
+    schema = pa.schema([(name, arrow_types[kind]) for name, kind in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for batch in batches:
+            if not batch:
+                continue
+            # Un row group per blocco: trasposizione righe -> colonne
+            arrays = [pa.array(list(values), type=field.type) for values, field in zip(zip(*batch), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+_WRITERS = {"csv": _csv_chunks, "ndjson": _ndjson_chunks, "parquet": _parquet_chunks}
+
+
+def check_format(fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato non supportato: {fmt} (csv, ndjson, parquet)")
+    if fmt == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Export Parquet non disponibile: installare pyarrow")
+
+
+def stream_export(survey: models.Survey, dataset: Optional[str], fmt: str, session_factory: Callable) -> StreamingResponse:
+    """
+    StreamingResponse con l'export del sondaggio.
+    Usa una sessione propria: la sessione della richiesta (Depends) viene chiusa
+    prima che la risposta in streaming sia completata.
+    """
+    check_format(fmt)
+    dataset = dataset or default_dataset(survey)
+    if dataset not in DATASET_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Dataset non valido: {dataset} ({', '.join(DATASET_COLUMNS)})")
+
+    columns = export_columns(dataset, survey)
+    survey_id = survey.id
+
+    def body() -> Iterator[bytes]:
+        db = session_factory()
+        try:
+            export_survey = db.query(models.Survey).filter(models.Survey.id == survey_id).first()
+            if dataset == "results":
+                batches = _results_batches(db, export_survey)
+            else:
+                batches = _raw_batches(db, dataset, export_survey)
+            yield from _WRITERS[fmt](columns, batches)
+        finally:
+            db.close()
+
+    media_type, extension = EXPORT_FORMATS[fmt]
+    filename = f"survey_{survey_id}_{dataset}.{extension}"
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
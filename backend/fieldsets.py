@@ -0,0 +1,59 @@
+"""
+Sparse fieldsets: parametro ?fields= degli endpoint di lettura
+
+fields=id,title,is_active restituisce solo i campi richiesti e li proietta già
+nella query: le colonne non richieste non vengono lette (load_only), le relazioni
+(creator, options, tags) vengono caricate solo se richieste e le statistiche
+calcolate (voti, partecipanti, gradimento) vengono saltate.
+Senza fields la risposta resta quella completa.
+"""
+from typing import Iterable, Optional, Set
+
+from fastapi import HTTPException
+from sqlalchemy.orm import load_only
+
+import models, schemas
+
+SURVEY_FIELDS = frozenset(schemas.Survey.model_fields)
+SURVEY_LIST_FIELDS = frozenset(schemas.SurveyWithStats.model_fields)
+RESULTS_FIELDS = frozenset(schemas.SurveyResultsResponse.model_fields)
+NEWS_FIELDS = frozenset(schemas.News.model_fields)
+
+SURVEY_RELATIONSHIPS = ("creator", "options", "tags")
+# Colonne sempre lette: servono ai filtri e ai calcoli interni (scadenza, partizioni, anonimato)
+SURVEY_CORE_COLUMNS = ("id", "question_type", "is_anonymous", "is_active", "expires_at", "created_at")
+# Campi di SurveyResultsResponse specifici dell'utente corrente (results.user_result_fields)
+USER_RESULT_FIELDS = frozenset(("user_voted_option_ids", "user_response_ids", "user_numeric_votes"))
+
+
+def parse_fields(fields: Optional[str], allowed: Iterable[str], always: Iterable[str] = ("id",)) -> Optional[Set[str]]:
+    """Insieme dei campi richiesti (più quelli sempre presenti), None se fields non è indicato"""
+    if not fields:
+        return None
+    allowed = set(allowed)
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - allowed
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Campi non validi: {', '.join(sorted(unknown))} (ammessi: {', '.join(sorted(allowed))})"
+        )
+    return requested | set(always)
+
+
+def load_columns(model, fields: Set[str], extra: Iterable[str] = ()):
+    """Opzione load_only con le sole colonne richieste (i nomi che non sono colonne vengono ignorati)"""
+    columns = model.__table__.columns
+    names = sorted((set(fields) | set(extra)) & set(columns.keys()))
+    return load_only(*[getattr(model, name) for name in names])
+
+
+def survey_columns(fields: Set[str]):
+    return load_columns(models.Survey, fields, SURVEY_CORE_COLUMNS)
+
+
+def project(data: dict, fields: Optional[Set[str]]) -> dict:
+    """Solo le chiavi richieste (tutte se fields è None)"""
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
@@ -0,0 +1,383 @@
+"""
+Cache a tile per la mappa H3 (GET /api/map/h3-data)
+
+Il viewport viene scomposto in tile fisse di una griglia lat/lng per
+risoluzione (lato in gradi potenza di due, dimensionato per contenere circa
+H3_TILE_HEXAGONS esagoni). Gli aggregati per esagono di ogni tile vengono
+messi in cache e solo le tile mancanti vanno al SQL Warehouse, tutte in un
+solo statement; gli esagoni sul bordo tra due tile vengono unificati per
+h3_cell_id nel merge, che restituisce solo gli esagoni che toccano il
+viewport (le tile coprono un'area più ampia). Spostarsi su una zona già vista
+non interroga il warehouse finché la TTL non scade.
+
+- memoria: LRU con al massimo H3_CACHE_MEMORY_HEXAGONS esagoni in totale
+- disco: le tile espulse dalla memoria finiscono in H3_CACHE_DIR (LRU per
+  mtime, al massimo H3_CACHE_DISK_MAX_MB; 0 disattiva il disco) e tornano in
+  memoria alla lettura successiva
+- TTL: H3_CACHE_TTL secondi, per tabella con
+  H3_CACHE_TTLS="catalog.schema.table=300,..." (dataset che cambiano spesso)
+- richieste concorrenti sulle stesse tile attendono la stessa query
+
+Senza viewport (mondo intero) l'aggregazione completa è un'unica voce di
+cache; un viewport con più di H3_TILE_MAX_TILES tile (zoom lontano con
+risoluzione fine) viene interrogato direttamente, senza cache.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from fastapi.concurrency import run_in_threadpool
+
+import metrics
+import serialization
+import sql_warehouse_connector
+
+H3_TILE_HEXAGONS = int(os.getenv("H3_TILE_HEXAGONS", "2048"))
+H3_TILE_MAX_TILES = int(os.getenv("H3_TILE_MAX_TILES", "64"))
+H3_CACHE_TTL = float(os.getenv("H3_CACHE_TTL", "3600"))
+H3_CACHE_TTLS = os.getenv("H3_CACHE_TTLS", "")
+H3_CACHE_MEMORY_HEXAGONS = int(os.getenv("H3_CACHE_MEMORY_HEXAGONS", "500000"))
+H3_CACHE_DIR = os.getenv("H3_CACHE_DIR", os.path.join(tempfile.gettempdir(), "webdemocracy-h3-tiles"))
+H3_CACHE_DISK_MAX_MB = float(os.getenv("H3_CACHE_DISK_MAX_MB", "512"))
+
+# Lato della tile in gradi: potenze di due tra 1/256 e 64
+MIN_TILE_DEGREES = 2.0 ** -8
+MAX_TILE_DEGREES = 64.0
+KM_PER_DEGREE = 111.32
+
+logger = logging.getLogger(__name__)
+
+# Righe di una tile: [h3_cell_id, hex_boundary (GeoJSON decodificato), count]
+Rows = List[list]
+
+
+@lru_cache(maxsize=16)
+def tile_degrees(resolution: int) -> float:
+    """Lato della tile per la risoluzione: circa H3_TILE_HEXAGONS esagoni all'equatore"""
+    import h3
+
+    side_km = math.sqrt(H3_TILE_HEXAGONS * h3.average_hexagon_area(resolution, unit="km^2"))
+    degrees = 2.0 ** math.floor(math.log2(side_km / KM_PER_DEGREE))
+    return min(MAX_TILE_DEGREES, max(MIN_TILE_DEGREES, degrees))
+
+
+def tiles_for_bounds(resolution: int, min_lat: float, max_lat: float, min_lng: float, max_lng: float) -> Tuple[range, range]:
+    """
+    Indici x e y delle tile che coprono il viewport (limitato a lat ±90, lng ±180).
+    Restituisce i range e non la lista: alle risoluzioni fini il prodotto può
+    arrivare a miliardi di tile, va controllato prima di materializzarle.
+    """
+    size = tile_degrees(resolution)
+    max_x = math.ceil(360 / size) - 1
+    max_y = math.ceil(180 / size) - 1
+
+    def index(value: float, offset: float, last: int) -> int:
+        return min(last, max(0, math.floor((value + offset) / size)))
+
+    xs = range(index(min(min_lng, max_lng), 180, max_x), index(max(min_lng, max_lng), 180, max_x) + 1)
+    ys = range(index(min(min_lat, max_lat), 90, max_y), index(max(min_lat, max_lat), 90, max_y) + 1)
+    return xs, ys
+
+
+def _polygon_wkt(min_lng: float, min_lat: float, max_lng: float, max_lat: float) -> str:
+    return (
+        f"POLYGON(({min_lng} {min_lat}, {min_lng} {max_lat}, {max_lng} {max_lat}, "
+        f"{max_lng} {min_lat}, {min_lng} {min_lat}))"
+    )
+
+
+def tile_wkt(resolution: int, x: int, y: int) -> str:
+    size = tile_degrees(resolution)
+    min_lng, min_lat = x * size - 180, y * size - 90
+    return _polygon_wkt(min_lng, min_lat, min(min_lng + size, 180.0), min(min_lat + size, 90.0))
+
+
+def build_query(source: str, column: str, resolution: int, polygons: Optional[Dict[str, str]]) -> str:
+    """
+    Aggregato per esagono con l'id della tile di appartenenza.
+    polygons = {tile_id: WKT}; None = nessun filtro (tile_id 'world').
+    """
+    if polygons is None:
+        return f"""
+            WITH cell_agg AS (
+                SELECT h3_toparent({column}, {resolution}) as h3_cell_id, count(*) as count
+                FROM {source}
+                GROUP BY h3_cell_id
+            )
+            SELECT 'world' as tile_id, h3_cell_id, h3_boundaryasgeojson(h3_cell_id) as hex_boundary, count
+            FROM cell_agg
+        """
+    values = ", ".join(f"('{tile_id}', '{wkt}')" for tile_id, wkt in polygons.items())
+    return f"""
+        WITH tiles AS (
+            SELECT tile_id, EXPLODE(H3_COVERASH3(wkt, {resolution})) as h3_cell_id
+            FROM VALUES {values} AS t(tile_id, wkt)
+        ),
+        cell_agg AS (
+            SELECT h3_toparent({column}, {resolution}) as h3_cell_id, count(*) as count
+            FROM {source}
+            WHERE h3_toparent({column}, {resolution}) IN (SELECT h3_cell_id FROM tiles)
+            GROUP BY h3_cell_id
+        )
+        SELECT tiles.tile_id, cell_agg.h3_cell_id, h3_boundaryasgeojson(cell_agg.h3_cell_id) as hex_boundary, cell_agg.count
+        FROM cell_agg JOIN tiles ON tiles.h3_cell_id = cell_agg.h3_cell_id
+    """
+
+
+def _split_rows(df, tile_ids: Iterable[str]) -> Dict[str, Rows]:
+    """Righe del DataFrame raggruppate per tile (le tile senza esagoni restano vuote)"""
+    rows: Dict[str, Rows] = {tile_id: [] for tile_id in tile_ids}
+    if df.empty:
+        return rows
+    hexagons = serialization.h3_hexagons(df["hex_boundary"].tolist(), df["count"].tolist())
+    for tile_id, cell_id, hexagon in zip(df["tile_id"].tolist(), df["h3_cell_id"].tolist(), hexagons):
+        rows[tile_id].append([str(cell_id), hexagon["hex_boundary"], hexagon["count"]])
+    return rows
+
+
+def _ttls() -> Dict[str, float]:
+    ttls = {}
+    for item in H3_CACHE_TTLS.split(","):
+        source, _, seconds = item.partition("=")
+        if source.strip() and seconds.strip():
+            ttls[source.strip()] = float(seconds)
+    return ttls
+
+
+_TTLS = _ttls()
+
+
+class TileCache:
+    """LRU in memoria (limite in esagoni) con TTL e spill su disco delle voci espulse"""
+
+    def __init__(self, max_hexagons: int, directory: Optional[str], disk_max_bytes: int):
+        self.max_hexagons = max_hexagons
+        self.directory = directory if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[float, Rows]]" = OrderedDict()
+        self._hexagons = 0
+        self._disk: Optional["OrderedDict[str, int]"] = None  # file -> byte, dal meno recente
+        self._disk_bytes = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def _disk_index(self) -> "OrderedDict[str, int]":
+        # Indice dei file esistenti (anche da un processo precedente), in ordine di mtime
+        if self._disk is None:
+            os.makedirs(self.directory, exist_ok=True)
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+            self._disk = OrderedDict((path, size) for _, path, size in sorted(files))
+            self._disk_bytes = sum(self._disk.values())
+        return self._disk
+
+    def _disk_remove(self, path: str):
+        self._disk_bytes -= self._disk.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _spill(self, key: str, expires_at: float, rows: Rows):
+        if self.directory is None or expires_at <= time.time():
+            return
+        disk = self._disk_index()
+        path = self._path(key)
+        data = orjson.dumps({"key": key, "expires_at": expires_at, "rows": rows})
+        with open(path, "wb") as f:
+            f.write(data)
+        self._disk_bytes += len(data) - disk.pop(path, 0)
+        disk[path] = len(data)
+        while self._disk_bytes > self.disk_max_bytes and disk:
+            self._disk_remove(next(iter(disk)))
+
+    def _load(self, key: str) -> Optional[Tuple[float, Rows]]:
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        if path not in self._disk_index():
+            return None
+        try:
+            with open(path, "rb") as f:
+                entry = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            self._disk_remove(path)
+            return None
+        # Torna in memoria: il file viene rimosso, verrà riscritto se espulso di nuovo
+        self._disk_remove(path)
+        if entry.get("key") != key or entry["expires_at"] <= time.time():
+            return None
+        return entry["expires_at"], entry["rows"]
+
+    def _store(self, key: str, expires_at: float, rows: Rows):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._hexagons -= len(old[1])
+        self._memory[key] = (expires_at, rows)
+        self._hexagons += len(rows)
+        while self._hexagons > self.max_hexagons and len(self._memory) > 1:
+            evicted_key, (evicted_expires, evicted_rows) = self._memory.popitem(last=False)
+            self._hexagons -= len(evicted_rows)
+            self._spill(evicted_key, evicted_expires, evicted_rows)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Rows]:
+        """Voci valide tra keys (dalla memoria o dal disco)"""
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._memory.get(key)
+                if entry is not None and entry[0] <= now:
+                    self._hexagons -= len(self._memory.pop(key)[1])
+                    entry = None
+                if entry is None:
+                    entry = self._load(key)
+                    if entry is None:
+                        continue
+                    self._store(key, *entry)
+                self._memory.move_to_end(key)
+                found[key] = entry[1]
+        return found
+
+    def put_many(self, entries: Dict[str, Rows], ttl: float):
+        expires_at = time.time() + ttl
+        with self._lock:
+            for key, rows in entries.items():
+                self._store(key, expires_at, rows)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._hexagons = 0
+            if self.directory is not None:
+                for path in list(self._disk_index()):
+                    self._disk_remove(path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_tiles": len(self._memory),
+                "memory_hexagons": self._hexagons,
+                "disk_tiles": len(self._disk) if self._disk is not None else None,
+                "disk_bytes": self._disk_bytes if self._disk is not None else None,
+            }
+
+
+cache = TileCache(H3_CACHE_MEMORY_HEXAGONS, H3_CACHE_DIR, int(H3_CACHE_DISK_MAX_MB * 1024 * 1024))
+
+# Tile in corso di lettura dal warehouse: le richieste concorrenti attendono la stessa query
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def _overlaps(boundary: dict, bounds: Tuple[float, float, float, float]) -> bool:
+    """True se il bounding box dell'esagono interseca il viewport (come H3_COVERASH3 sul viewport)"""
+    min_lat, max_lat, min_lng, max_lng = bounds
+    ring = boundary["coordinates"][0]
+    lngs = [point[0] for point in ring]
+    lats = [point[1] for point in ring]
+    return min(lngs) <= max_lng and max(lngs) >= min_lng and min(lats) <= max_lat and max(lats) >= min_lat
+
+
+def _merge(tiles: Iterable[Rows], bounds: Optional[Tuple[float, float, float, float]] = None) -> List[dict]:
+    """
+    Esagoni delle tile senza duplicati (celle sul bordo), per conteggio decrescente.
+    Con bounds restano solo gli esagoni che toccano il viewport: le tile in cache
+    coprono un'area più ampia di quella da disegnare.
+    """
+    if bounds is not None:
+        min_lat, max_lat, min_lng, max_lng = bounds
+        bounds = (min(min_lat, max_lat), max(min_lat, max_lat), min(min_lng, max_lng), max(min_lng, max_lng))
+    cells = {}
+    for rows in tiles:
+        for cell_id, boundary, count in rows:
+            if cell_id in cells or (bounds is not None and not _overlaps(boundary, bounds)):
+                continue
+            cells[cell_id] = (boundary, count)
+    hexagons = [{"hex_boundary": boundary, "count": count} for boundary, count in cells.values()]
+    hexagons.sort(key=lambda h: h["count"], reverse=True)
+    return hexagons
+
+
+async def _fetch(source: str, column: str, resolution: int, polygons: Optional[Dict[str, str]]) -> Dict[str, Rows]:
+    df = await sql_warehouse_connector.run_query(build_query(source, column, resolution, polygons))
+    return _split_rows(df, polygons or ["world"])
+
+
+async def get_hexagons(
+    catalog: str, schema: str, table: str, column: str, resolution: int,
+    bounds: Optional[Tuple[float, float, float, float]] = None
+) -> Tuple[List[dict], dict]:
+    """
+    Esagoni (hex_boundary, count) del viewport bounds = (min_lat, max_lat, min_lng, max_lng)
+    o del mondo intero, e le statistiche della cache per la risposta
+    """
+    source = f"{catalog}.{schema}.{table}"
+    # Il lato della tile fa parte della chiave: cambiando H3_TILE_HEXAGONS le voci su disco non vengono riusate
+    prefix = f"{source}|{column}|{resolution}|{tile_degrees(resolution)}"
+    if bounds is None:
+        polygons = None
+        keys = {"world": f"{prefix}|world"}
+    else:
+        xs, ys = tiles_for_bounds(resolution, *bounds)
+        tile_count = len(xs) * len(ys)
+        if tile_count > H3_TILE_MAX_TILES:
+            min_lat, max_lat, min_lng, max_lng = bounds
+            rows = await _fetch(source, column, resolution, {"viewport": _polygon_wkt(min_lng, min_lat, max_lng, max_lat)})
+            return _merge(rows.values()), {"tiles": tile_count, "cached": 0, "queried": 0, "uncached_viewport": True}
+        polygons = {f"{x}_{y}": tile_wkt(resolution, x, y) for y in ys for x in xs}
+        keys = {tile_id: f"{prefix}|{tile_id}" for tile_id in polygons}
+
+    found = await run_in_threadpool(cache.get_many, keys.values())
+    for key in keys.values():
+        metrics.cache_hit("h3_tiles", key in found)
+    missing = [tile_id for tile_id, key in keys.items() if key not in found]
+    shared = {tile_id: _inflight[keys[tile_id]] for tile_id in missing if keys[tile_id] in _inflight}
+    to_fetch = [tile_id for tile_id in missing if tile_id not in shared]
+
+    if to_fetch:
+        loop = asyncio.get_running_loop()
+        futures = {tile_id: loop.create_future() for tile_id in to_fetch}
+        for tile_id, future in futures.items():
+            _inflight[keys[tile_id]] = future
+        try:
+            fetched = await _fetch(source, column, resolution, None if polygons is None else {t: polygons[t] for t in to_fetch})
+            await run_in_threadpool(cache.put_many, {keys[t]: fetched[t] for t in to_fetch}, _TTLS.get(source, H3_CACHE_TTL))
+            for tile_id, future in futures.items():
+                future.set_result(fetched[tile_id])
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(e)
+                future.exception()  # Nessun avviso "exception never retrieved" se nessuno attende
+            raise
+        finally:
+            for tile_id in to_fetch:
+                _inflight.pop(keys[tile_id], None)
+        found.update({keys[t]: fetched[t] for t in to_fetch})
+
+    for tile_id, future in shared.items():
+        found[keys[tile_id]] = await future
+
+    logger.info(
+        "H3 tiles: %d cached, %d queried, %d shared", len(keys) - len(missing), len(to_fetch), len(shared),
+        extra={"resolution": resolution}
+    )
+    stats = {"tiles": len(keys), "cached": len(keys) - len(missing), "queried": len(to_fetch), "shared": len(shared)}
+    return _merge((found[key] for key in keys.values()), bounds), stats
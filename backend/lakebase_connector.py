@@ -1,67 +1,59 @@
 """
 Lakebase Connector for Web Democracy Application
 Provides database connection using Databricks OAuth authentication
+
+L'import del modulo non effettua chiamate di rete: il WorkspaceClient, l'identità
+dell'app e l'inizializzazione dello schema vengono risolti al primo utilizzo,
+così l'app risponde su /api/health subito dopo un restart o uno scale-up.
 """
+import logging
 import os
-from databricks.sdk import WorkspaceClient
+import threading
+from functools import lru_cache
 from sqlalchemy import create_engine, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from partitioning import partition_tables
+from metrics import TimedQueuePool
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def get_workspace_client():
+    """Crea il WorkspaceClient al primo utilizzo (il Databricks SDK è pesante da importare)"""
+    from databricks.sdk import WorkspaceClient
+    return WorkspaceClient()
 
-# Initialize Databricks workspace client
-workspace_client = WorkspaceClient()
-user = workspace_client.current_user.me().user_name
 
-# Debug: Print environment variables
-print("=" * 80)
-print("🔍 DEBUG: Environment Variables")
-print("=" * 80)
-for key, value in sorted(os.environ.items()):
-    if any(x in key.upper() for x in ['PG', 'DB', 'DATABASE', 'WEBDEMOCRACY']):
-        print(f"{key} = {value}")
-# Print Databricks-specific variables
-print(f"DATABRICKS_HOST = {os.getenv('DATABRICKS_HOST', 'NOT SET')}")
-print(f"DATABRICKS_APP_URL = {os.getenv('DATABRICKS_APP_URL', 'NOT SET')}")
-print("=" * 80)
+@lru_cache(maxsize=1)
+def get_postgres_username() -> str:
+    """Username dell'app su Lakebase (una sola chiamata a current_user.me())"""
+    return get_workspace_client().current_user.me().user_name
+
 
 # Get PostgreSQL connection parameters from environment
 # Databricks Apps exposes database resource variables with format: {RESOURCE_NAME}_{FIELD}
 # Resource name in app.yml: "webdemocracy-db"
-postgres_username = user
 postgres_host = os.getenv("WEBDEMOCRACY_DB_HOST") or os.getenv("PGHOST")
 postgres_port = os.getenv("WEBDEMOCRACY_DB_PORT") or os.getenv("PGPORT") or "5432"
 postgres_database = os.getenv("WEBDEMOCRACY_DB_DATABASE_NAME") or os.getenv("PGDATABASE") or "webdemocracy_db"
 
-print("=" * 60)
-print("🔗 Databricks Lakebase Connection")
-print("=" * 60)
-print(f"postgres_username: {postgres_username}")
-print(f"postgres_host: {postgres_host}")
-print(f"postgres_port: {postgres_port}")
-print(f"postgres_database: {postgres_database}")
-print("=" * 60)
-
 # Check if required parameters are available
 if not postgres_host:
-    print("⚠️  WARNING: postgres_host is not set!")
-    print("⚠️  Databricks Apps should provide these variables automatically.")
-    print("⚠️  Attempting to use default connection string...")
+    logger.warning("postgres_host is not set: Databricks Apps should provide it automatically, falling back to localhost")
     # Usa un default che NON funzionerà, ma mostrerà l'errore
     postgres_host = "localhost"
 
-print(f"🔗 Creating engine with: postgresql+psycopg2://{postgres_username}:@{postgres_host}:{postgres_port}/{postgres_database}")
-
 # Create SQLAlchemy engine
-try:
-    postgres_pool = create_engine(
-        f"postgresql+psycopg2://{postgres_username}:@{postgres_host}:{postgres_port}/{postgres_database}",
-        echo=False,
-        pool_pre_ping=True
-    )
-    print("✅ SQLAlchemy engine created successfully")
-except Exception as e:
-    print(f"❌ ERROR creating SQLAlchemy engine: {e}")
-    raise
+# Username e password vengono forniti in provide_token() alla prima connessione:
+# create_engine non apre connessioni, quindi qui non serve contattare il workspace
+postgres_pool = create_engine(
+    f"postgresql+psycopg2://{postgres_host}:{postgres_port}/{postgres_database}",
+    echo=False,
+    pool_pre_ping=True,
+    poolclass=TimedQueuePool  # Misura l'attesa del checkout (/metrics)
+)
 
 # Base for models
 Base = declarative_base()
@@ -72,12 +64,43 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=postgres_poo
 
 @event.listens_for(postgres_pool, "do_connect")
 def provide_token(dialect, conn_rec, cargs, cparams):
-    """Provide the App's OAuth token. Caching is managed by WorkspaceClient"""
+    """Provide the App's identity and OAuth token. Caching is managed by WorkspaceClient"""
+    workspace_client = get_workspace_client()
+    cparams["user"] = get_postgres_username()
     cparams["password"] = workspace_client.config.oauth_token().access_token
 
 
+# Stato dell'inizializzazione dello schema (eseguita in background all'avvio)
+_schema_ready = threading.Event()
+_schema_lock = threading.Lock()
+_schema_thread = None
+
+
+def start_schema_initialization():
+    """Avvia initialize_schema() in un thread di background (una sola volta per processo)"""
+    global _schema_thread
+    with _schema_lock:
+        if _schema_thread is None:
+            _schema_thread = threading.Thread(
+                target=_run_schema_initialization,
+                name="lakebase-schema-init",
+                daemon=True
+            )
+            _schema_thread.start()
+
+
+def wait_for_schema(timeout: float = None) -> bool:
+    """Attende il termine dell'inizializzazione dello schema (avviandola se necessario)"""
+    if not _schema_ready.is_set():
+        start_schema_initialization()
+    return _schema_ready.wait(timeout)
+
+
 def get_db():
     """Dependency for getting database sessions"""
+    # Le richieste che usano il database attendono l'inizializzazione dello schema;
+    # gli endpoint senza database (es. /api/health) non vengono bloccati
+    wait_for_schema()
     db = SessionLocal()
     try:
         yield db
@@ -85,6 +108,14 @@ def get_db():
         db.close()
 
 
+def print_connection_info():
+    """Logga i parametri di connessione (risolve l'identità dell'app); mai variabili d'ambiente o token"""
+    logger.info(
+        "Databricks Lakebase connection: %s@%s:%s/%s",
+        get_postgres_username(), postgres_host, postgres_port, postgres_database
+    )
+
+
 def initialize_schema():
     """
     Initialize the database schema for Web Democracy.
@@ -133,6 +164,8 @@ def initialize_schema():
         print("🗑️  Dropping existing tables and types for clean setup...")
         conn.execute(text("DROP TABLE IF EXISTS webdemocracy.user_groups CASCADE"))
         conn.execute(text("DROP TABLE IF EXISTS webdemocracy.groups CASCADE"))
+        conn.execute(text("DROP TABLE IF EXISTS webdemocracy.survey_participant_sketches CASCADE"))
+        conn.execute(text("DROP TABLE IF EXISTS webdemocracy.survey_result_snapshots CASCADE"))
         conn.execute(text("DROP TABLE IF EXISTS webdemocracy.survey_likes CASCADE"))
         conn.execute(text("DROP TABLE IF EXISTS webdemocracy.open_responses CASCADE"))
         conn.execute(text("DROP TABLE IF EXISTS webdemocracy.votes CASCADE"))
@@ -334,8 +367,8 @@ def initialize_schema():
                 id SERIAL PRIMARY KEY,
                 survey_id INTEGER NOT NULL REFERENCES webdemocracy.surveys(id) ON DELETE CASCADE,
                 option_id INTEGER REFERENCES webdemocracy.survey_options(id) ON DELETE CASCADE,
-                voter_ip VARCHAR(45),
-                voter_session VARCHAR(100),
+                voter_ip INET,
+                voter_session UUID,
                 
                 -- Per risposte numeriche, scale, rating
                 numeric_value DOUBLE PRECISION,
@@ -355,8 +388,8 @@ def initialize_schema():
                 id SERIAL PRIMARY KEY,
                 survey_id INTEGER NOT NULL REFERENCES webdemocracy.surveys(id) ON DELETE CASCADE,
                 option_id INTEGER REFERENCES webdemocracy.survey_options(id) ON DELETE CASCADE,
-                voter_ip VARCHAR(45),
-                voter_session VARCHAR(100),
+                voter_ip INET,
+                voter_session UUID,
                 response_text TEXT NOT NULL,
                 responded_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
                 
@@ -371,8 +404,8 @@ def initialize_schema():
             CREATE TABLE webdemocracy.survey_likes (
                 id SERIAL PRIMARY KEY,
                 survey_id INTEGER NOT NULL REFERENCES webdemocracy.surveys(id) ON DELETE CASCADE,
-                user_ip VARCHAR(45),
-                user_session VARCHAR(100),
+                user_ip INET,
+                user_session UUID,
                 rating INTEGER NOT NULL CHECK (rating >= 1 AND rating <= 5),
                 comment TEXT,
                 created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
@@ -383,6 +416,30 @@ def initialize_schema():
         """))
         print("✅ Table 'survey_likes' created (or already exists)")
         
+        # Create survey_result_snapshots table
+        conn.execute(text("""
+            CREATE TABLE webdemocracy.survey_result_snapshots (
+                survey_id INTEGER PRIMARY KEY REFERENCES webdemocracy.surveys(id) ON DELETE CASCADE,
+                version INTEGER NOT NULL DEFAULT 1,
+                payload JSONB NOT NULL,
+                frozen_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        print("✅ Table 'survey_result_snapshots' created (or already exists)")
+        
+        # Create survey_participant_sketches table
+        conn.execute(text("""
+            CREATE TABLE webdemocracy.survey_participant_sketches (
+                survey_id INTEGER NOT NULL REFERENCES webdemocracy.surveys(id) ON DELETE CASCADE,
+                granularity VARCHAR(10) NOT NULL,
+                bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+                registers BYTEA NOT NULL,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (survey_id, granularity, bucket_start)
+            )
+        """))
+        print("✅ Table 'survey_participant_sketches' created (or already exists)")
+        
         # Create settings table
         conn.execute(text("""
             CREATE TABLE webdemocracy.settings (
@@ -435,6 +492,7 @@ def initialize_schema():
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_surveys_user_id ON webdemocracy.surveys(user_id)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_surveys_resource_type ON webdemocracy.surveys(resource_type)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_surveys_resource_news_id ON webdemocracy.surveys(resource_news_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_surveys_active_expiry ON webdemocracy.surveys(expires_at NULLS FIRST, id) WHERE is_active"))
         
         # Survey options indexes
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_options_survey_id ON webdemocracy.survey_options(survey_id)"))
@@ -446,25 +504,34 @@ def initialize_schema():
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_tags_tag ON webdemocracy.survey_tags(tag_id)"))
         
         # Votes indexes
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_survey_id ON webdemocracy.votes(survey_id)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_option_id ON webdemocracy.votes(option_id)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_session ON webdemocracy.votes(voter_session)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_ip ON webdemocracy.votes(voter_ip)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_voted_at ON webdemocracy.votes(voted_at DESC)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_user_id ON webdemocracy.votes(user_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_survey_session ON webdemocracy.votes(survey_id, voter_session)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_survey_ip ON webdemocracy.votes(survey_id, voter_ip)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_survey_user ON webdemocracy.votes(survey_id, user_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_survey_option_value ON webdemocracy.votes(survey_id, option_id, numeric_value)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_votes_survey_voted_at ON webdemocracy.votes(survey_id, voted_at)"))
         
         # Open responses indexes
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_survey_id ON webdemocracy.open_responses(survey_id)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_option_id ON webdemocracy.open_responses(option_id)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_session ON webdemocracy.open_responses(voter_session)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_responded_at ON webdemocracy.open_responses(responded_at DESC)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_user_id ON webdemocracy.open_responses(user_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_survey_session ON webdemocracy.open_responses(survey_id, voter_session)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_survey_ip ON webdemocracy.open_responses(survey_id, voter_ip)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_survey_user ON webdemocracy.open_responses(survey_id, user_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_open_responses_survey_responded_at ON webdemocracy.open_responses(survey_id, responded_at)"))
         
         # Survey likes indexes
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_likes_survey_id ON webdemocracy.survey_likes(survey_id)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_likes_session ON webdemocracy.survey_likes(user_session)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_likes_created_at ON webdemocracy.survey_likes(created_at DESC)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_likes_user_id ON webdemocracy.survey_likes(user_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_likes_survey_session ON webdemocracy.survey_likes(survey_id, user_session)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_likes_survey_ip ON webdemocracy.survey_likes(survey_id, user_ip)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_survey_likes_survey_rating ON webdemocracy.survey_likes(survey_id, rating)"))
         
         # Settings indexes
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_settings_key ON webdemocracy.settings(key)"))
@@ -477,7 +544,11 @@ def initialize_schema():
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_user_groups_user_id ON webdemocracy.user_groups(user_id)"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS idx_user_groups_group_id ON webdemocracy.user_groups(group_id)"))
         
-        print("✅ Indexes created (47 indexes - completamente allineato con init.sql)")
+        print("✅ Indexes created (completamente allineato con init.sql)")
+        
+        # ========== PARTITIONING (opzionale, VOTES_PARTITIONING=hash|month) ==========
+        # Le tabelle sono appena state create vuote: la conversione è immediata
+        partition_tables(conn)
         
         # Check if tags table is empty and insert default tags
         result = conn.execute(text("SELECT COUNT(*) FROM webdemocracy.tags"))
@@ -531,7 +602,7 @@ def initialize_schema():
         print("👤 Checking current user permissions...")
         print("=" * 60)
         try:
-            current_user_email = workspace_client.current_user.me().user_name
+            current_user_email = get_postgres_username()
             print(f"Current user email: {current_user_email}")
             
             result = conn.execute(text("""
@@ -708,18 +779,15 @@ def initialize_schema():
     print("=" * 60)
 
 
-# Initialize schema on module import
-print("🚀 About to initialize schema...")
-try:
-    initialize_schema()
-    print("✅ Schema initialization completed successfully!")
-except Exception as e:
-    print(f"❌ FATAL ERROR initializing schema: {e}")
-    import traceback
-    traceback.print_exc()
-    print("=" * 80)
-    print("⚠️  DATABASE INITIALIZATION FAILED!")
-    print("⚠️  The app may not function correctly.")
-    print("=" * 80)
-    # NON sollevo l'errore così l'app parte comunque e possiamo vedere i logs
-
+def _run_schema_initialization():
+    """Corpo del thread di inizializzazione: gli errori vengono loggati, non sollevati"""
+    logger.info("Initializing schema...")
+    try:
+        print_connection_info()
+        initialize_schema()
+        logger.info("Schema initialization completed")
+    except Exception:
+        logger.exception("DATABASE INITIALIZATION FAILED: the app may not function correctly")
+        # NON sollevo l'errore così l'app parte comunque e possiamo vedere i logs
+    finally:
+        _schema_ready.set()
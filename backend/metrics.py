@@ -0,0 +1,149 @@
+"""
+Metriche Prometheus (GET /metrics)
+
+- latenza per route (istogramma), richieste in corso, richieste per stato
+- query e tempo sul database per richiesta (da query_stats)
+- attesa per il checkout di una connessione dal pool e stato del pool
+- hit/miss delle cache (snapshot dei risultati)
+- durata delle query su SQL Warehouse (ok, error, timeout, rejected) e stato del circuit breaker
+- schede registrate (voti e import massivi): il rate è la velocità di ingest
+
+Le label usano il template della route (/surveys/{survey_id}), non il path,
+così la cardinalità resta limitata. Con più worker uvicorn ogni processo espone
+le proprie metriche (Prometheus le aggrega per istanza).
+"""
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy.pool import QueuePool
+
+import query_stats
+
+# Bucket in secondi: dalle letture servite dalla cache alle query su SQL Warehouse
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HTTP_REQUESTS = Counter(
+    "webdemocracy_http_requests_total", "Richieste HTTP completate",
+    ["method", "route", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "webdemocracy_http_request_duration_seconds", "Durata delle richieste HTTP (fino all'ultimo byte)",
+    ["method", "route"], buckets=LATENCY_BUCKETS
+)
+HTTP_IN_PROGRESS = Gauge("webdemocracy_http_requests_in_progress", "Richieste HTTP in corso")
+DB_TIME = Histogram(
+    "webdemocracy_db_time_per_request_seconds", "Tempo speso sul database per richiesta",
+    ["route"], buckets=LATENCY_BUCKETS
+)
+DB_QUERIES = Histogram(
+    "webdemocracy_db_queries_per_request", "Statement SQL eseguiti per richiesta",
+    ["route"], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "webdemocracy_db_pool_checkout_wait_seconds", "Attesa per ottenere una connessione dal pool",
+    ["pool"], buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+CACHE_REQUESTS = Counter(
+    "webdemocracy_cache_requests_total", "Letture delle cache applicative",
+    ["cache", "result"]
+)
+WAREHOUSE_QUERY = Histogram(
+    "webdemocracy_warehouse_query_duration_seconds", "Durata delle query su SQL Warehouse",
+    ["status"], buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 180)
+)
+WAREHOUSE_CIRCUIT_OPEN = Gauge("webdemocracy_warehouse_circuit_open", "1 se il circuit breaker di SQL Warehouse è aperto")
+BALLOTS = Counter(
+    "webdemocracy_ballots_total", "Schede registrate",
+    ["question_type", "source"]
+)
+
+
+def cache_hit(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool che misura l'attesa per il checkout (pool esaurito = richieste in coda)"""
+
+    metrics_name = "default"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.labels(pool=self.metrics_name).observe(time.perf_counter() - started)
+
+
+class _PoolCollector:
+    """Stato del pool letto al momento dello scrape (nessun costo per richiesta)"""
+
+    def __init__(self):
+        self.pools = {}
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            "webdemocracy_db_pool_connections", "Connessioni del pool per stato", labels=["pool", "state"]
+        )
+        for name, pool in self.pools.items():
+            if not isinstance(pool, QueuePool):
+                continue
+            family.add_metric([name, "checked_out"], pool.checkedout())
+            family.add_metric([name, "idle"], pool.checkedin())
+            family.add_metric([name, "overflow"], max(pool.overflow(), 0))
+            family.add_metric([name, "size"], pool.size())
+        yield family
+
+
+_pool_collector = _PoolCollector()
+REGISTRY.register(_pool_collector)
+
+
+def register_pool(engine, name: str):
+    """Espone lo stato del pool dell'engine e ne etichetta le attese di checkout"""
+    engine.pool.metrics_name = name
+    _pool_collector.pools[name] = engine.pool
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: latenza, stato e richieste in corso per route.
+    Va registrato dentro QueryCounterMiddleware per leggere le statistiche SQL della richiesta.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            route = getattr(scope.get("route"), "path", "<unmatched>")
+            method = scope.get("method", "")
+            HTTP_LATENCY.labels(method=method, route=route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(method=method, route=route, status=str(status)).inc()
+            stats = query_stats.current()
+            if stats is not None:
+                DB_TIME.labels(route=route).observe(stats.duration)
+                DB_QUERIES.labels(route=route).observe(stats.count)
+
+
+def exposition() -> tuple:
+    """(body, content type) del formato di testo Prometheus"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -2,11 +2,13 @@
 Unified models.py - Works for both Databricks Apps and Local/Hybrid modes
 Uses environment variable DEPLOY_MODE to determine schema usage
 """
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Float, Table, Enum, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Float, Table, Enum, JSON, LargeBinary
+from sqlalchemy.dialects.postgresql import INET, JSONB, UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
 import os
+from partitioning import VOTES_PARTITIONING, partition_by, is_partition_key
 
 # Determine deployment mode from environment
 DEPLOY_MODE = os.getenv("DEPLOY_MODE", "local").lower()  # local, hybrid, or databricks
@@ -23,7 +25,12 @@ else:  # local
     from database import Base  # database.py usa PostgreSQL locale
     SCHEMA_NAME = None
 
-print(f"🔧 Models initialized for mode: {DEPLOY_MODE} (schema: {SCHEMA_NAME or 'public'})")
+def partitioned_table_args(table: str) -> dict:
+    """__table_args__ per votes/open_responses, con PARTITION BY se VOTES_PARTITIONING è attivo"""
+    args = {'schema': SCHEMA_NAME} if USE_SCHEMA and SCHEMA_NAME else {}
+    if VOTES_PARTITIONING != "none":
+        args['postgresql_partition_by'] = partition_by(table)
+    return args
 
 # Enum per i tipi di domanda (validazione Python)
 class QuestionType(str, enum.Enum):
@@ -120,9 +127,10 @@ class Survey(Base):
     user_id = Column(Integer, ForeignKey(fk('user'), ondelete='CASCADE'), nullable=False)  # Creatore del sondaggio
     
     options = relationship("SurveyOption", back_populates="survey", cascade="all, delete-orphan")
-    votes = relationship("Vote", back_populates="survey", cascade="all, delete-orphan")
-    open_responses = relationship("OpenResponse", back_populates="survey", cascade="all, delete-orphan")
-    survey_likes = relationship("SurveyLike", back_populates="survey", cascade="all, delete-orphan")
+    # passive_deletes: le righe figlie vengono eliminate in bulk / da ON DELETE CASCADE, senza caricarle
+    votes = relationship("Vote", back_populates="survey", cascade="all, delete-orphan", passive_deletes=True)
+    open_responses = relationship("OpenResponse", back_populates="survey", cascade="all, delete-orphan", passive_deletes=True)
+    survey_likes = relationship("SurveyLike", back_populates="survey", cascade="all, delete-orphan", passive_deletes=True)
     tags = relationship("Tag", secondary=survey_tags, back_populates="surveys")
     creator = relationship("User", back_populates="surveys", foreign_keys=[user_id])
     resource_news = relationship("News", foreign_keys=[resource_news_id])
@@ -146,19 +154,20 @@ class SurveyOption(Base):
 
 class Vote(Base):
     __tablename__ = "votes"
-    if USE_SCHEMA and SCHEMA_NAME:
-        __table_args__ = {'schema': SCHEMA_NAME}
+    __table_args__ = partitioned_table_args("votes")
     
-    id = Column(Integer, primary_key=True, index=True)
-    survey_id = Column(Integer, ForeignKey(fk('surveys'), ondelete='CASCADE'), nullable=False)
+    # Con il partizionamento la chiave di partizione fa parte della primary key:
+    # autoincrement esplicito perché id resti SERIAL anche nella chiave composta
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    survey_id = Column(Integer, ForeignKey(fk('surveys'), ondelete='CASCADE'), nullable=False, primary_key=is_partition_key("votes", "survey_id"))
     option_id = Column(Integer, ForeignKey(fk('survey_options'), ondelete='CASCADE'))
-    voter_ip = Column(String(45))
-    voter_session = Column(String(100))
+    voter_ip = Column(INET)
+    voter_session = Column(UUID(as_uuid=False))
     
     numeric_value = Column(Float)
     date_value = Column(DateTime(timezone=True))
     
-    voted_at = Column(DateTime(timezone=True), server_default=func.now())
+    voted_at = Column(DateTime(timezone=True), server_default=func.now(), primary_key=is_partition_key("votes", "voted_at"))
     user_id = Column(Integer, ForeignKey(fk('user'), ondelete='CASCADE'), nullable=True)  # Nullable per voti anonimi
     
     survey = relationship("Survey", back_populates="votes")
@@ -167,16 +176,15 @@ class Vote(Base):
 
 class OpenResponse(Base):
     __tablename__ = "open_responses"
-    if USE_SCHEMA and SCHEMA_NAME:
-        __table_args__ = {'schema': SCHEMA_NAME}
+    __table_args__ = partitioned_table_args("open_responses")
     
-    id = Column(Integer, primary_key=True, index=True)
-    survey_id = Column(Integer, ForeignKey(fk('surveys'), ondelete='CASCADE'), nullable=False)
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    survey_id = Column(Integer, ForeignKey(fk('surveys'), ondelete='CASCADE'), nullable=False, primary_key=is_partition_key("open_responses", "survey_id"))
     option_id = Column(Integer, ForeignKey(fk('survey_options'), ondelete='CASCADE'))
-    voter_ip = Column(String(45))
-    voter_session = Column(String(100))
+    voter_ip = Column(INET)
+    voter_session = Column(UUID(as_uuid=False))
     response_text = Column(Text, nullable=False)
-    responded_at = Column(DateTime(timezone=True), server_default=func.now())
+    responded_at = Column(DateTime(timezone=True), server_default=func.now(), primary_key=is_partition_key("open_responses", "responded_at"))
     user_id = Column(Integer, ForeignKey(fk('user'), ondelete='CASCADE'), nullable=True)  # Nullable per risposte anonime
     
     survey = relationship("Survey", back_populates="open_responses")
@@ -190,8 +198,8 @@ class SurveyLike(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     survey_id = Column(Integer, ForeignKey(fk('surveys'), ondelete='CASCADE'), nullable=False)
-    user_ip = Column(String(45))
-    user_session = Column(String(100))
+    user_ip = Column(INET)
+    user_session = Column(UUID(as_uuid=False))
     rating = Column(Integer, nullable=False)
     comment = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -200,6 +208,29 @@ class SurveyLike(Base):
     survey = relationship("Survey", back_populates="survey_likes")
     liker = relationship("User", back_populates="survey_likes", foreign_keys=[user_id])
 
+class SurveyResultSnapshot(Base):
+    """Risultati finali congelati alla chiusura del sondaggio (payload = SurveyResultsResponse senza campi utente)"""
+    __tablename__ = "survey_result_snapshots"
+    if USE_SCHEMA and SCHEMA_NAME:
+        __table_args__ = {'schema': SCHEMA_NAME}
+    
+    survey_id = Column(Integer, ForeignKey(fk('surveys'), ondelete='CASCADE'), primary_key=True)
+    version = Column(Integer, nullable=False, default=1)
+    payload = Column(JSONB, nullable=False)
+    frozen_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class SurveyParticipantSketch(Base):
+    """Sketch HyperLogLog dei partecipanti unici per sondaggio e bucket (vedi participants.py)"""
+    __tablename__ = "survey_participant_sketches"
+    if USE_SCHEMA and SCHEMA_NAME:
+        __table_args__ = {'schema': SCHEMA_NAME}
+    
+    survey_id = Column(Integer, ForeignKey(fk('surveys'), ondelete='CASCADE'), primary_key=True)
+    granularity = Column(String(10), primary_key=True)  # 'all', 'hour', 'day'
+    bucket_start = Column(DateTime(timezone=True), primary_key=True)  # 1970-01-01 per 'all'
+    registers = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
 class Settings(Base):
     __tablename__ = "settings"
     if USE_SCHEMA and SCHEMA_NAME:
@@ -0,0 +1,364 @@
+"""
+Conteggio dei partecipanti unici con sketch HyperLogLog
+
+Per ogni sondaggio vengono mantenuti sketch HLL (2^HLL_PRECISION registri da un
+byte, salvati come BYTEA in survey_participant_sketches) per tre granularità:
+'all' (intero sondaggio), 'hour' e 'day' (bucket UTC della timeline).
+Ogni voto aggiorna un solo registro per sketch con un UPSERT atomico
+(set_byte solo se il rank cresce), quindi niente COUNT(DISTINCT) sull'intera tabella dei voti.
+
+Il partecipante è user_id per i sondaggi non anonimi e voter_session per quelli
+anonimi, come nei conteggi esatti. Sotto HLL_EXACT_THRESHOLD partecipanti
+stimati si usa comunque il conteggio esatto (economico su pochi voti);
+sopra, la stima HLL (errore standard ~1.04/sqrt(2^p), ~1.6% con p=12).
+
+Gli sketch sono unibili (massimo registro per registro): l'unione tra sondaggi
+o tra bucket costa O(2^p) indipendentemente dal numero di voti.
+
+Ricostruzione degli sketch dai voti esistenti:
+    python participants.py backfill
+"""
+import hashlib
+import math
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+import models
+from partitioning import survey_rows, surveys_rows
+
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+HLL_REGISTERS = 1 << HLL_PRECISION
+# Sotto questa soglia (partecipanti stimati) si restituisce il conteggio esatto
+HLL_EXACT_THRESHOLD = int(os.getenv("HLL_EXACT_THRESHOLD", "2000"))
+
+# bucket_start dello sketch 'all'
+ALL_BUCKET = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# La timeline è oraria solo nelle prime 48 ore: oltre, niente sketch orari
+HOURLY_TIMELINE_HOURS = 48
+
+SKETCH_TABLE = models.SurveyParticipantSketch.__table__.fullname
+EMPTY_REGISTERS = bytes(HLL_REGISTERS)
+
+
+# ----------------------------------------------------------------------------
+# HyperLogLog
+# ----------------------------------------------------------------------------
+
+def participant_key(survey: models.Survey, user_id: Optional[int], session_id: Optional[str]) -> Optional[str]:
+    """Chiave del partecipante (None se non identificabile: non conta, come COUNT(DISTINCT) sui NULL)"""
+    if survey.is_anonymous:
+        return f"s:{session_id}" if session_id else None
+    return f"u:{user_id}" if user_id is not None else None
+
+
+def register_update(key: str) -> Tuple[int, int]:
+    """(indice del registro, rank) per una chiave: hash a 64 bit, primi p bit = registro"""
+    h = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+    index = h >> (64 - HLL_PRECISION)
+    remaining = h & ((1 << (64 - HLL_PRECISION)) - 1)
+    rank = (64 - HLL_PRECISION) - remaining.bit_length() + 1
+    return index, rank
+
+
+def estimate(registers: bytes) -> float:
+    """Stima di cardinalità (con linear counting per valori piccoli)"""
+    import numpy as np
+
+    regs = np.frombuffer(registers, dtype=np.uint8)
+    m = len(regs)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / float(np.sum(np.ldexp(1.0, -regs.astype(np.int32))))
+    zeros = int(np.count_nonzero(regs == 0))
+    if raw <= 2.5 * m and zeros:
+        return m * math.log(m / zeros)
+    return raw
+
+
+def merge(sketches: Iterable[bytes]) -> bytes:
+    """Unione di sketch: massimo registro per registro"""
+    import numpy as np
+
+    merged = np.zeros(HLL_REGISTERS, dtype=np.uint8)
+    for registers in sketches:
+        np.maximum(merged, np.frombuffer(registers, dtype=np.uint8), out=merged)
+    return merged.tobytes()
+
+
+def _as_utc(moment: datetime) -> datetime:
+    return moment.astimezone(timezone.utc) if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def bucket_starts(moment: datetime) -> Dict[str, datetime]:
+    moment = _as_utc(moment)
+    return {
+        "all": ALL_BUCKET,
+        "hour": moment.replace(minute=0, second=0, microsecond=0),
+        "day": moment.replace(hour=0, minute=0, second=0, microsecond=0),
+    }
+
+
+def survey_buckets(survey: models.Survey, moment: datetime) -> Dict[str, datetime]:
+    """Bucket da aggiornare per un voto: quello orario solo nella finestra oraria della timeline"""
+    buckets = bucket_starts(moment)
+    if survey.created_at is not None and (_as_utc(moment) - _as_utc(survey.created_at)).total_seconds() >= HOURLY_TIMELINE_HOURS * 3600:
+        del buckets["hour"]
+    return buckets
+
+
+# ----------------------------------------------------------------------------
+# Aggiornamento
+# ----------------------------------------------------------------------------
+
+def record_participant(
+    survey: models.Survey,
+    user_id: Optional[int],
+    session_id: Optional[str],
+    db: Session,
+    voted_at: Optional[datetime] = None
+):
+    """Aggiunge il partecipante agli sketch del sondaggio (una sola istruzione, nella transazione del voto)"""
+    key = participant_key(survey, user_id, session_id)
+    if key is None:
+        return
+    index, rank = register_update(key)
+    buckets = survey_buckets(survey, voted_at or datetime.now(timezone.utc))
+    registers = bytearray(EMPTY_REGISTERS)
+    registers[index] = rank
+
+    # Un solo UPSERT per tutti i bucket; la riga viene riscritta solo se il registro cresce
+    values = ", ".join(f"(:survey_id, '{g}', :bucket_{g}, :registers)" for g in buckets)
+    db.execute(text(f"""
+        INSERT INTO {SKETCH_TABLE} AS s (survey_id, granularity, bucket_start, registers)
+        VALUES {values}
+        ON CONFLICT (survey_id, granularity, bucket_start) DO UPDATE
+        SET registers = set_byte(s.registers, :index, :rank),
+            updated_at = now()
+        WHERE get_byte(s.registers, :index) < :rank
+    """), {
+        "survey_id": survey.id,
+        "registers": bytes(registers),
+        "index": index,
+        "rank": rank,
+        **{f"bucket_{g}": b for g, b in buckets.items()},
+    })
+
+
+def _participant_rows(survey: models.Survey, db: Session):
+    """(timestamp, chiave) dei voti del sondaggio, con la stessa regola di participant_key"""
+    model = models.OpenResponse if survey.question_type == models.QuestionType.OPEN_TEXT else models.Vote
+    timestamp = model.responded_at if model is models.OpenResponse else model.voted_at
+    column = model.voter_session if survey.is_anonymous else model.user_id
+    return model, timestamp, column
+
+
+def rebuild_sketches(survey: models.Survey, db: Session) -> int:
+    """Ricalcola da zero gli sketch di un sondaggio dai voti (backfill, import massivo). Il chiamante fa commit."""
+    import numpy as np
+
+    model, timestamp, column = _participant_rows(survey, db)
+    sketches: Dict[Tuple[str, datetime], np.ndarray] = {}
+    rows = db.query(timestamp, column).filter(
+        *survey_rows(model, survey), column.isnot(None)
+    ).yield_per(10000)
+    for moment, value in rows:
+        key = participant_key(survey, value, value)
+        index, rank = register_update(key)
+        for granularity, bucket in survey_buckets(survey, moment).items():
+            regs = sketches.setdefault((granularity, bucket), np.zeros(HLL_REGISTERS, dtype=np.uint8))
+            if regs[index] < rank:
+                regs[index] = rank
+
+    db.query(models.SurveyParticipantSketch).filter(
+        models.SurveyParticipantSketch.survey_id == survey.id
+    ).delete(synchronize_session=False)
+    if sketches:
+        db.execute(models.SurveyParticipantSketch.__table__.insert(), [
+            {"survey_id": survey.id, "granularity": g, "bucket_start": b, "registers": regs.tobytes()}
+            for (g, b), regs in sketches.items()
+        ])
+    return len(sketches)
+
+
+# ----------------------------------------------------------------------------
+# Lettura
+# ----------------------------------------------------------------------------
+
+def _sketches(db: Session, survey_ids: List[int], granularity: str) -> List[models.SurveyParticipantSketch]:
+    return db.query(models.SurveyParticipantSketch).filter(
+        models.SurveyParticipantSketch.survey_id.in_(survey_ids),
+        models.SurveyParticipantSketch.granularity == granularity
+    ).order_by(models.SurveyParticipantSketch.bucket_start).all()
+
+
+def exact_count(survey: models.Survey, db: Session) -> int:
+    model, _, column = _participant_rows(survey, db)
+    return db.query(func.count(func.distinct(column))).filter(
+        *survey_rows(model, survey), column.isnot(None)
+    ).scalar() or 0
+
+
+def exact_counts(surveys: List[models.Survey], db: Session) -> Dict[int, int]:
+    """exact_count per più sondaggi: un COUNT(DISTINCT) ... GROUP BY survey_id per tabella e colonna"""
+    groups: Dict[Tuple[type, bool], List[models.Survey]] = {}
+    for survey in surveys:
+        model, _, _ = _participant_rows(survey, db)
+        groups.setdefault((model, bool(survey.is_anonymous)), []).append(survey)
+    counts = {survey.id: 0 for survey in surveys}
+    for (model, _), group in groups.items():
+        _, _, column = _participant_rows(group[0], db)
+        counts.update(db.query(model.survey_id, func.count(func.distinct(column))).filter(
+            *surveys_rows(model, group), column.isnot(None)
+        ).group_by(model.survey_id).all())
+    return counts
+
+
+def count_participants(survey: models.Survey, db: Session, registers: Optional[bytes] = None) -> int:
+    """Partecipanti unici: esatto sotto HLL_EXACT_THRESHOLD o senza sketch, stima HLL sopra"""
+    if registers is None:
+        sketch = _sketches(db, [survey.id], "all")
+        if not sketch:
+            # Nessun voto, oppure sondaggio con voti precedenti agli sketch (backfill non eseguito)
+            return exact_count(survey, db)
+        registers = sketch[0].registers
+    approx = estimate(registers)
+    if approx < HLL_EXACT_THRESHOLD:
+        return exact_count(survey, db)
+    return int(round(approx))
+
+
+def count_participants_many(surveys: List[models.Survey], db: Session) -> Dict[int, int]:
+    """
+    count_participants per una lista di sondaggi: una query per gli sketch e i
+    conteggi esatti (senza sketch o sotto soglia) raggruppati per survey_id
+    """
+    registers = {s.survey_id: s.registers for s in _sketches(db, [s.id for s in surveys], "all")}
+    counts = {}
+    exact = []
+    for survey in surveys:
+        approx = estimate(registers[survey.id]) if survey.id in registers else 0
+        if approx < HLL_EXACT_THRESHOLD:
+            exact.append(survey)
+        else:
+            counts[survey.id] = int(round(approx))
+    if exact:
+        counts.update(exact_counts(exact, db))
+    return counts
+
+
+def union_count(survey_ids: List[int], db: Session) -> int:
+    """Partecipanti unici su più sondaggi (stima HLL dell'unione degli sketch 'all')"""
+    sketches = _sketches(db, survey_ids, "all")
+    if not sketches:
+        return 0
+    return int(round(estimate(merge(s.registers for s in sketches))))
+
+
+def timeline_counts(survey: models.Survey, db: Session, granularity: str) -> List[Tuple[object, int, int]]:
+    """
+    [(bucket, partecipanti nel bucket, partecipanti cumulativi fino al bucket)] in ordine.
+    bucket è un datetime UTC per 'hour' e una date per 'day'.
+    Esatto con una sola query per i sondaggi piccoli, altrimenti dagli sketch.
+    """
+    import numpy as np
+
+    def bucket_key(moment: datetime):
+        start = bucket_starts(moment)[granularity]
+        return start.date() if granularity == "day" else start
+
+    sketches = _sketches(db, [survey.id], granularity)
+    total = merge(s.registers for s in sketches) if sketches else None
+    if total is None or estimate(total) < HLL_EXACT_THRESHOLD:
+        model, timestamp, column = _participant_rows(survey, db)
+        trunc = func.date_trunc(granularity, func.timezone("UTC", timestamp))
+        rows = db.query(trunc, column).filter(
+            *survey_rows(model, survey), column.isnot(None)
+        ).group_by(trunc, column).order_by(trunc).all()
+        counts = []
+        seen = set()
+        for bucket, value in rows:
+            key = bucket_key(bucket.replace(tzinfo=timezone.utc))
+            if not counts or counts[-1][0] != key:
+                counts.append([key, 0, 0])
+            counts[-1][1] += 1
+            seen.add(value)
+            counts[-1][2] = len(seen)
+        return [tuple(c) for c in counts]
+
+    cumulative = np.zeros(HLL_REGISTERS, dtype=np.uint8)
+    counts = []
+    for sketch in sketches:
+        regs = np.frombuffer(sketch.registers, dtype=np.uint8)
+        np.maximum(cumulative, regs, out=cumulative)
+        counts.append((
+            bucket_key(sketch.bucket_start),
+            int(round(estimate(sketch.registers))),
+            int(round(estimate(cumulative.tobytes())))
+        ))
+    return counts
+
+
+def timeline_points(start, current, counts: List[Tuple[object, int, int]]) -> List[dict]:
+    """
+    Punti della timeline da timeline_counts: un punto iniziale alla creazione con
+    0 partecipanti, uno per bucket e uno finale "adesso" se diverso dall'ultimo bucket.
+    """
+    timeline = [{
+        'timestamp': start.isoformat(),
+        'votes': 0,
+        'period_votes': 0
+    }]
+    last_bucket = start
+    total_now = 0
+
+    for bucket, period_count, cumulative_count in counts:
+        point = {
+            'timestamp': bucket.isoformat(),
+            'votes': cumulative_count,
+            'period_votes': period_count
+        }
+        # Non duplicare se il voto è nello stesso periodo della creazione
+        if bucket == start:
+            timeline[-1] = point
+        else:
+            timeline.append(point)
+        last_bucket = bucket
+        total_now = cumulative_count
+
+    if last_bucket != current:
+        timeline.append({
+            'timestamp': current.isoformat(),
+            'votes': total_now,
+            'period_votes': 0
+        })
+    return timeline
+
+
+def backfill_sketches(db: Session) -> int:
+    """Ricostruisce gli sketch di tutti i sondaggi"""
+    rebuilt = 0
+    for survey in db.query(models.Survey).all():
+        rebuild_sketches(survey, db)
+        db.commit()
+        rebuilt += 1
+    return rebuilt
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("Uso: python participants.py backfill")
+        sys.exit(1)
+    if os.getenv("DEPLOY_MODE", "local").lower() == "databricks":
+        from lakebase_connector import SessionLocal
+    else:
+        from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        print(f"✅ Sketch ricostruiti per {backfill_sketches(db)} sondaggi")
+    finally:
+        db.close()
@@ -0,0 +1,333 @@
+"""
+Partizionamento dichiarativo (opzionale) di votes e open_responses
+
+Configurazione via variabili d'ambiente:
+- VOTES_PARTITIONING: none (default), hash (per survey_id) oppure month (per data del voto)
+- VOTES_PARTITION_COUNT: numero di partizioni hash (default 16)
+- VOTES_PARTITION_MONTHS_AHEAD: partizioni mensili create in anticipo (default 3)
+- PARTITION_MAINTENANCE_INTERVAL: secondi tra due esecuzioni di maintain() nel
+  thread dello scheduler delle scadenze (default 86400, un giorno)
+
+Con "hash" le query per singolo sondaggio (WHERE survey_id = ?) toccano una sola
+partizione; con "month" i dati vecchi si archiviano con DETACH/DROP PARTITION e
+il vacuum lavora solo sui mesi attivi.
+
+Migrazione dei dati esistenti (tabelle non partizionate -> partizionate):
+    python partitioning.py migrate --strategy hash --partitions 16
+    python partitioning.py ensure     # crea le prossime partizioni mensili
+"""
+import logging
+import os
+from datetime import date, datetime, timezone
+from typing import Optional
+
+from sqlalchemy import text
+
+VOTES_PARTITIONING = os.getenv("VOTES_PARTITIONING", "none").lower()  # none, hash, month
+VOTES_PARTITION_COUNT = int(os.getenv("VOTES_PARTITION_COUNT", "16"))
+VOTES_PARTITION_MONTHS_AHEAD = int(os.getenv("VOTES_PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "86400"))
+
+STRATEGIES = ("none", "hash", "month")
+if VOTES_PARTITIONING not in STRATEGIES:
+    raise ValueError(f"VOTES_PARTITIONING must be one of {', '.join(STRATEGIES)}, got '{VOTES_PARTITIONING}'")
+
+# Tabella -> colonna temporale usata dalla strategia "month"
+PARTITIONED_TABLES = {
+    "votes": "voted_at",
+    "open_responses": "responded_at",
+}
+
+DEFAULT_SCHEMA = "webdemocracy"
+
+logger = logging.getLogger(__name__)
+
+
+def partition_column(table: str, strategy: str = VOTES_PARTITIONING) -> Optional[str]:
+    """Colonna chiave di partizionamento (None se la tabella non è partizionata)"""
+    if strategy == "hash":
+        return "survey_id"
+    if strategy == "month":
+        return PARTITIONED_TABLES[table]
+    return None
+
+
+def partition_by(table: str, strategy: str = VOTES_PARTITIONING) -> Optional[str]:
+    """Clausola PARTITION BY per la tabella, es. 'HASH (survey_id)'"""
+    column = partition_column(table, strategy)
+    if column is None:
+        return None
+    return f"HASH ({column})" if strategy == "hash" else f"RANGE ({column})"
+
+
+def is_partition_key(table: str, column: str) -> bool:
+    """True se la colonna deve far parte della primary key (Postgres lo richiede per la chiave di partizione)"""
+    return partition_column(table) == column
+
+
+def survey_rows(model, survey) -> list:
+    """
+    Condizioni WHERE per le righe di un sondaggio.
+    Con la strategia "month" aggiunge il vincolo voted_at >= created_at del sondaggio,
+    così il planner esclude i mesi precedenti (partition pruning).
+    """
+    conditions = [model.survey_id == survey.id]
+    if VOTES_PARTITIONING == "month" and survey.created_at is not None:
+        conditions.append(getattr(model, PARTITIONED_TABLES[model.__tablename__]) >= survey.created_at)
+    return conditions
+
+
+def surveys_rows(model, surveys) -> list:
+    """Come survey_rows per più sondaggi (IN), con il created_at più vecchio come limite per il pruning"""
+    conditions = [model.survey_id.in_([survey.id for survey in surveys])]
+    created = [survey.created_at for survey in surveys if survey.created_at is not None]
+    if VOTES_PARTITIONING == "month" and created and len(created) == len(surveys):
+        conditions.append(getattr(model, PARTITIONED_TABLES[model.__tablename__]) >= min(created))
+    return conditions
+
+
+def _month_start(value: date, offset: int = 0) -> date:
+    month = value.month - 1 + offset
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned(conn, table: str, schema: str = DEFAULT_SCHEMA) -> bool:
+    relkind = conn.execute(text("""
+        SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relname = :table
+    """), {"schema": schema, "table": table}).scalar()
+    return relkind == "p"
+
+
+def ensure_partitions(
+    conn,
+    table: str,
+    strategy: str = VOTES_PARTITIONING,
+    schema: str = DEFAULT_SCHEMA,
+    partitions: int = VOTES_PARTITION_COUNT,
+    months_ahead: int = VOTES_PARTITION_MONTHS_AHEAD,
+    since: Optional[date] = None
+) -> int:
+    """
+    Crea le partizioni mancanti di una tabella già partizionata.
+    hash: MODULUS/REMAINDER 0..partitions-1
+    month: una partizione per mese da `since` (default mese corrente) a oggi + months_ahead,
+           più una partizione DEFAULT per le righe fuori intervallo (le righe del mese
+           finite nella DEFAULT vengono spostate nella nuova partizione)
+    Restituisce il numero di partizioni create.
+    """
+    created = 0
+    existing = set(conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:parent)
+    """), {"parent": f"{schema}.{table}"}).scalars())
+
+    if strategy == "hash":
+        for remainder in range(partitions):
+            name = f"{table}_p{remainder}"
+            if name in existing:
+                continue
+            conn.execute(text(
+                f"CREATE TABLE {schema}.{name} PARTITION OF {schema}.{table} "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+            ))
+            created += 1
+        return created
+
+    if strategy != "month":
+        return created
+
+    column = PARTITIONED_TABLES[table]
+    default_name = f"{table}_default"
+    if default_name not in existing:
+        conn.execute(text(f"CREATE TABLE {schema}.{default_name} PARTITION OF {schema}.{table} DEFAULT"))
+        created += 1
+
+    today = datetime.now(timezone.utc).date()
+    month = _month_start(since or today)
+    last = _month_start(today, months_ahead)
+    while month <= last:
+        upper = _month_start(month, 1)
+        name = f"{table}_y{month.year}m{month.month:02d}"
+        if name not in existing:
+            # Postgres rifiuta la creazione se la partizione DEFAULT contiene righe del mese:
+            # vengono spostate in una tabella temporanea e reinserite nella nuova partizione
+            bounds = {"lower": month, "upper": upper}
+            in_default = conn.execute(text(
+                f"SELECT EXISTS (SELECT 1 FROM {schema}.{default_name} WHERE {column} >= :lower AND {column} < :upper)"
+            ), bounds).scalar()
+            if in_default:
+                moved_name = f"{name}_moved"
+                conn.execute(text(f"CREATE TEMP TABLE {moved_name} (LIKE {schema}.{table}) ON COMMIT DROP"))
+                conn.execute(text(
+                    f"WITH moved AS (DELETE FROM {schema}.{default_name} WHERE {column} >= :lower AND {column} < :upper RETURNING *) "
+                    f"INSERT INTO {moved_name} SELECT * FROM moved"
+                ), bounds)
+            conn.execute(text(
+                f"CREATE TABLE {schema}.{name} PARTITION OF {schema}.{table} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')"
+            ))
+            if in_default:
+                moved = conn.execute(text(f"INSERT INTO {schema}.{table} SELECT * FROM {moved_name}")).rowcount
+                logger.info("✅ %d rows moved from %s.%s to %s.%s", moved, schema, default_name, schema, name)
+            created += 1
+        month = upper
+    return created
+
+
+def migrate_table(
+    conn,
+    table: str,
+    strategy: str = VOTES_PARTITIONING,
+    schema: str = DEFAULT_SCHEMA,
+    partitions: int = VOTES_PARTITION_COUNT,
+    months_ahead: int = VOTES_PARTITION_MONTHS_AHEAD,
+    keep_old: bool = False
+) -> bool:
+    """
+    Converte una tabella esistente in tabella partizionata, copiando i dati.
+    Deve girare in una transazione: le scritture sono bloccate fino al commit.
+    Colonne, default, CHECK, foreign key e indici vengono ricreati dalla tabella originale;
+    la primary key diventa (id, <chiave di partizione>).
+    Restituisce False se la tabella è già partizionata.
+    """
+    if strategy not in ("hash", "month"):
+        raise ValueError(f"Unsupported partitioning strategy: {strategy}")
+    if is_partitioned(conn, table, schema):
+        return False
+
+    column = partition_column(table, strategy)
+    old_name = f"{table}_unpartitioned"
+    qualified = f"{schema}.{table}"
+
+    conn.execute(text(f"LOCK TABLE {qualified} IN EXCLUSIVE MODE"))
+
+    # Definizioni da ricreare sulla nuova tabella (lette prima del rename, quindi con il nome finale)
+    pkey = conn.execute(text("""
+        SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:t) AND contype = 'p'
+    """), {"t": qualified}).scalar()
+    foreign_keys = conn.execute(text("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = to_regclass(:t) AND contype = 'f'
+    """), {"t": qualified}).all()
+    indexes = conn.execute(text("""
+        SELECT indexname, indexdef FROM pg_indexes
+        WHERE schemaname = :schema AND tablename = :table AND indexname <> :pkey
+    """), {"schema": schema, "table": table, "pkey": pkey or ""}).all()
+    columns = conn.execute(text("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = to_regclass(:t) AND attnum > 0 AND NOT attisdropped ORDER BY attnum
+    """), {"t": qualified}).scalars().all()
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": qualified}).scalar()
+
+    # Sposta la tabella originale (e i nomi dei suoi indici) per liberare i nomi
+    conn.execute(text(f"ALTER TABLE {qualified} RENAME TO {old_name}"))
+    if pkey:
+        conn.execute(text(f"ALTER TABLE {schema}.{old_name} RENAME CONSTRAINT {pkey} TO {old_name}_pkey"))
+    for index_name, _ in indexes:
+        conn.execute(text(f"ALTER INDEX {schema}.{index_name} RENAME TO {index_name[:48]}_unpartitioned"))
+
+    conn.execute(text(f"""
+        CREATE TABLE {qualified} (
+            LIKE {schema}.{old_name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING COMMENTS,
+            PRIMARY KEY (id, {column})
+        ) PARTITION BY {partition_by(table, strategy)}
+    """))
+    for name, definition in foreign_keys:
+        conn.execute(text(f"ALTER TABLE {qualified} ADD CONSTRAINT {name} {definition}"))
+
+    since = None
+    if strategy == "month":
+        oldest = conn.execute(text(f"SELECT min({column}) FROM {schema}.{old_name}")).scalar()
+        since = oldest.date() if oldest else None
+    ensure_partitions(conn, table, strategy, schema, partitions, months_ahead, since)
+
+    # Copia prima di creare gli indici secondari: molto più veloce
+    column_list = ", ".join(columns)
+    select_list = ", ".join(
+        f"COALESCE({c}, CURRENT_TIMESTAMP)" if strategy == "month" and c == column else c
+        for c in columns
+    )
+    copied = conn.execute(text(
+        f"INSERT INTO {qualified} ({column_list}) SELECT {select_list} FROM {schema}.{old_name}"
+    )).rowcount
+
+    for _, definition in indexes:
+        conn.execute(text(definition))
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {qualified}.id"))
+    if not keep_old:
+        conn.execute(text(f"DROP TABLE {schema}.{old_name}"))
+
+    print(f"✅ {qualified} partitioned by {partition_by(table, strategy)} ({copied} rows copied)")
+    return True
+
+
+def partition_tables(conn, strategy: str = VOTES_PARTITIONING, schema: str = DEFAULT_SCHEMA, **kwargs):
+    """Converte tutte le tabelle partizionabili (no-op con strategia 'none')"""
+    if strategy == "none":
+        return
+    for table in PARTITIONED_TABLES:
+        migrate_table(conn, table, strategy, schema, **kwargs)
+
+
+def ensure_all_partitions(conn, strategy: str = VOTES_PARTITIONING, schema: str = DEFAULT_SCHEMA):
+    """Crea le partizioni mancanti (es. i prossimi mesi) per tutte le tabelle già partizionate"""
+    if strategy == "none":
+        return
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(conn, table, schema):
+            logger.warning("⚠️  %s.%s is not partitioned: run 'python partitioning.py migrate --strategy %s'", schema, table, strategy)
+            continue
+        created = ensure_partitions(conn, table, strategy, schema)
+        if created:
+            logger.info("✅ %d partitions created for %s.%s", created, schema, table)
+
+
+def maintain(engine, strategy: str = VOTES_PARTITIONING, schema: str = DEFAULT_SCHEMA):
+    """Manutenzione periodica: crea i mesi successivi prima che i voti finiscano nella DEFAULT"""
+    if strategy == "none":
+        return
+    with engine.begin() as conn:
+        ensure_all_partitions(conn, strategy, schema)
+
+
+def _get_engine():
+    if os.getenv("DEPLOY_MODE", "local").lower() == "databricks":
+        from lakebase_connector import postgres_pool
+        return postgres_pool
+    from database import engine
+    return engine
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Partizionamento di votes / open_responses")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Converte le tabelle esistenti in tabelle partizionate")
+    migrate_parser.add_argument("--strategy", choices=["hash", "month"], default=VOTES_PARTITIONING if VOTES_PARTITIONING != "none" else "hash")
+    migrate_parser.add_argument("--partitions", type=int, default=VOTES_PARTITION_COUNT, help="Numero di partizioni hash")
+    migrate_parser.add_argument("--months-ahead", type=int, default=VOTES_PARTITION_MONTHS_AHEAD)
+    migrate_parser.add_argument("--table", choices=sorted(PARTITIONED_TABLES), action="append", help="Default: tutte")
+    migrate_parser.add_argument("--keep-old", action="store_true", help="Conserva la tabella originale come <table>_unpartitioned")
+
+    ensure_parser = subparsers.add_parser("ensure", help="Crea le partizioni mancanti (es. prossimi mesi)")
+    ensure_parser.add_argument("--strategy", choices=["hash", "month"], default=VOTES_PARTITIONING if VOTES_PARTITIONING != "none" else "month")
+
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA)
+    args = parser.parse_args()
+    # ensure_partitions / ensure_all_partitions scrivono sul logger del modulo
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with _get_engine().begin() as conn:
+        if args.command == "migrate":
+            for table in args.table or PARTITIONED_TABLES:
+                if not migrate_table(conn, table, args.strategy, args.schema, args.partitions, args.months_ahead, args.keep_old):
+                    print(f"ℹ️  {args.schema}.{table} is already partitioned")
+            conn.execute(text(f"ANALYZE {args.schema}.votes"))
+            conn.execute(text(f"ANALYZE {args.schema}.open_responses"))
+        else:
+            ensure_all_partitions(conn, args.strategy, args.schema)
@@ -0,0 +1,201 @@
+"""
+Profilazione su richiesta di una singola richiesta (solo admin)
+
+Una richiesta con header X-Profile: 1 (o ?_profile=1) inviata da un admin viene
+eseguita con un profiler a campionamento: un thread legge gli stack con
+sys._current_frames() ogni PROFILE_SAMPLE_INTERVAL_MS e li accumula in formato
+"folded" (flamegraph.pl, speedscope, inferno). Al profilo si aggiungono i tempi
+SQL per statement (query_stats).
+
+Il profilo viene salvato in memoria (ultimi PROFILE_KEEP) e, se PROFILE_DIR è
+impostata, anche su disco; la risposta riporta l'id nell'header X-Profile-Id:
+    GET /api/debug/profiles/{id}                profilo e tempi SQL (JSON)
+    GET /api/debug/profiles/{id}?format=folded  stack per il flamegraph
+
+Senza flag il costo è la sola ricerca dell'header. Vengono campionati il thread
+dell'event loop e i worker del threadpool occupati (endpoint sincroni): con
+altre richieste in corso i loro stack possono comparire nel profilo.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, QueryParams
+
+import models
+import query_stats
+
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "2"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+
+# Frame foglia di un thread in attesa (worker libero, event loop in select)
+_IDLE_FILES = ("threading.py", "queue.py", "selectors.py")
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_profiles: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _fold(frame, thread_name: str) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+class Sampler:
+    """Campiona gli stack del thread della richiesta e dei worker del threadpool occupati"""
+
+    def __init__(self, loop_thread: int, interval: float):
+        self.loop_thread = loop_thread
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        deadline = time.monotonic() + PROFILE_MAX_SECONDS
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, "")
+                if ident != self.loop_thread and not name.startswith("AnyIO worker"):
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+                    continue
+                self.stacks[_fold(frame, "event-loop" if ident == self.loop_thread else name)] += 1
+            self.samples += 1
+
+
+def _store(profile: dict):
+    with _lock:
+        _profiles[profile["id"]] = profile
+        while len(_profiles) > PROFILE_KEEP:
+            _profiles.popitem(last=False)
+    if PROFILE_DIR:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, profile["id"])
+        with open(base + ".folded", "w") as f:
+            f.write(profile["folded"])
+        with open(base + ".json", "w") as f:
+            json.dump({k: v for k, v in profile.items() if k != "folded"}, f, indent=2)
+
+
+def get_profile(profile_id: str) -> Optional[dict]:
+    with _lock:
+        return _profiles.get(profile_id)
+
+
+def list_profiles() -> list:
+    """Profili in memoria, dal più recente, senza gli stack"""
+    with _lock:
+        return [
+            {k: v for k, v in profile.items() if k not in ("folded", "sql")}
+            for profile in reversed(_profiles.values())
+        ]
+
+
+def _requested(scope) -> bool:
+    for name, value in scope.get("headers", ()):
+        if name == b"x-profile":
+            return value.strip() in (b"1", b"true")
+    return QueryParams(scope.get("query_string", b"")).get("_profile") in ("1", "true")
+
+
+class ProfilingMiddleware:
+    """
+    Middleware ASGI: profila la richiesta se richiesto da un admin.
+    Va registrato dentro QueryCounterMiddleware per leggere i tempi SQL.
+    """
+
+    def __init__(self, app, session_factory: Callable, email_header: Optional[str] = None, default_email: str = "demo@local.dev"):
+        self.app = app
+        self.session_factory = session_factory
+        self.email_header = email_header
+        self.default_email = default_email
+
+    def _is_admin(self, headers: Headers) -> bool:
+        email = (headers.get(self.email_header) if self.email_header else None) or self.default_email
+        db = self.session_factory()
+        try:
+            user = db.query(models.User).filter(models.User.email == email).first()
+            return user is not None and user.user_role == "admin"
+        finally:
+            db.close()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _requested(scope):
+            await self.app(scope, receive, send)
+            return
+        if not await run_in_threadpool(self._is_admin, Headers(scope=scope)):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex[:12]
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        sampler = Sampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL_MS / 1000)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            duration = time.perf_counter() - started
+            stats = query_stats.current()
+            profile = {
+                "id": profile_id,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "method": scope.get("method"),
+                "path": scope.get("path"),
+                "query_string": scope.get("query_string", b"").decode("latin-1"),
+                "route": getattr(scope.get("route"), "path", None),
+                "status": status,
+                "duration_ms": round(duration * 1000, 2),
+                "samples": sampler.samples,
+                "interval_ms": PROFILE_SAMPLE_INTERVAL_MS,
+                "sql": {
+                    "count": stats.count,
+                    "time_ms": round(stats.duration_ms, 2),
+                    "statements": stats.slowest(),
+                } if stats is not None else None,
+                "folded": "\n".join(f"{stack} {count}" for stack, count in sampler.stacks.most_common()) + "\n",
+            }
+            _store(profile)
+            logger.info(
+                "🔬 Profile %s: %s %s %s ms, %d samples",
+                profile_id, profile["method"], profile["path"], profile["duration_ms"], sampler.samples
+            )
@@ -0,0 +1,219 @@
+"""
+Conteggio delle query SQL per richiesta e rilevamento dei pattern N+1
+
+I listener before/after_cursor_execute vengono registrati una sola volta
+sull'engine (install) e scrivono nelle statistiche della richiesta corrente,
+tenute in una ContextVar impostata da QueryCounterMiddleware: le query fuori
+da una richiesta (scheduler, thread di background) non vengono contate.
+
+Per ogni richiesta: numero di statement, tempo totale sul database e
+fingerprint degli statement (letterali normalizzati). Le richieste oltre le
+soglie vengono loggate con gli statement ripetuti, tipico segnale di N+1.
+Con QUERY_DEBUG_HEADERS=1 i conteggi vengono esposti negli header
+X-DB-Query-Count / X-DB-Time-Ms.
+
+Helper per test e benchmark:
+    with assert_max_queries(12):
+        client.get("/surveys")
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import event
+
+QUERY_COUNT_WARN = int(os.getenv("QUERY_COUNT_WARN", "50"))
+QUERY_TIME_WARN_MS = float(os.getenv("QUERY_TIME_WARN_MS", "500"))
+# Stesso statement ripetuto almeno N volte nella stessa richiesta: sospetto N+1
+QUERY_REPEAT_WARN = int(os.getenv("QUERY_REPEAT_WARN", "10"))
+QUERY_DEBUG_HEADERS = os.getenv("QUERY_DEBUG_HEADERS", "").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+_NUMBER = re.compile(r"\b\d+(\.\d+)?\b")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*(?:\?|%\(\w+\)s|__\[POSTCOMPILE_\w+\]|\d+|'[^']*')\s*,?)+\)", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """Statement con letterali e liste IN normalizzati (i parametri bind sono già segnaposto)"""
+    statement = _STRING.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = _IN_LIST.sub("IN (...)", statement)
+    return _SPACES.sub(" ", statement).strip()
+
+
+class QueryStats:
+    """Statement eseguiti in una richiesta (o in un blocco count_queries)"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+        self.fingerprint_time = Counter()
+        # Scope ASGI della richiesta (route e path params per slow_queries), None fuori dal middleware
+        self.scope = None
+        self._lock = threading.Lock()
+
+    def record(self, statement: str, duration: float):
+        key = fingerprint(statement)
+        with self._lock:
+            self.count += 1
+            self.duration += duration
+            self.fingerprints[key] += 1
+            self.fingerprint_time[key] += duration
+
+    def merge(self, other: "QueryStats"):
+        with self._lock:
+            self.count += other.count
+            self.duration += other.duration
+            self.fingerprints.update(other.fingerprints)
+            self.fingerprint_time.update(other.fingerprint_time)
+
+    @property
+    def duration_ms(self) -> float:
+        return self.duration * 1000
+
+    def repeated(self, threshold: int = 2) -> List[tuple]:
+        """[(fingerprint, volte)] degli statement eseguiti almeno threshold volte"""
+        return [(fp, n) for fp, n in self.fingerprints.most_common() if n >= threshold]
+
+    def slowest(self, limit: int = 20) -> List[dict]:
+        """Statement per tempo totale: [{statement, count, time_ms}]"""
+        return [
+            {"statement": fp, "count": self.fingerprints[fp], "time_ms": round(seconds * 1000, 2)}
+            for fp, seconds in self.fingerprint_time.most_common(limit)
+        ]
+
+    def report(self, limit: int = 5) -> str:
+        lines = [f"{self.count} queries, {self.duration_ms:.1f} ms"]
+        for fp, n in self.repeated()[:limit]:
+            lines.append(f"  {n}x {fp[:200]}")
+        return "\n".join(lines)
+
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+# Callback chiamate con le statistiche di ogni richiesta completata (assert_max_queries)
+_observers: List[Callable[[QueryStats], None]] = []
+
+_route_lock = threading.Lock()
+_route_totals: Dict[str, Dict[str, float]] = {}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info["query_stats_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None:
+        return
+    started = conn.info.pop("query_stats_start", None) or time.perf_counter()
+    stats.record(statement, time.perf_counter() - started)
+
+
+def install(engine):
+    """Registra i listener sull'engine (idempotente)"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def current() -> Optional[QueryStats]:
+    return _current.get()
+
+
+def route_stats() -> Dict[str, Dict[str, float]]:
+    """Totali per route: richieste, query e tempo sul database"""
+    with _route_lock:
+        return {
+            route: {
+                "requests": int(totals["requests"]),
+                "queries": int(totals["queries"]),
+                "db_time_ms": round(totals["db_time_ms"], 1),
+                "avg_queries": round(totals["queries"] / totals["requests"], 1),
+            }
+            for route, totals in sorted(_route_totals.items())
+        }
+
+
+def _record_route(route: str, stats: QueryStats):
+    with _route_lock:
+        totals = _route_totals.setdefault(route, {"requests": 0, "queries": 0, "db_time_ms": 0.0})
+        totals["requests"] += 1
+        totals["queries"] += stats.count
+        totals["db_time_ms"] += stats.duration_ms
+
+
+def _route_name(scope) -> str:
+    # Template della route (/surveys/{survey_id}), non il path: cardinalità limitata
+    route = scope.get("route")
+    return f"{scope.get('method', '')} {getattr(route, 'path', '<unmatched>')}"
+
+
+class QueryCounterMiddleware:
+    """Middleware ASGI: statistiche SQL per richiesta, log degli sforamenti e header di debug"""
+
+    def __init__(self, app, debug_headers: bool = QUERY_DEBUG_HEADERS):
+        self.app = app
+        self.debug_headers = debug_headers
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        stats.scope = scope
+        token = _current.set(stats)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start" and self.debug_headers:
+                # Query eseguite fino all'invio degli header (le risposte in streaming continuano dopo)
+                headers = list(message.get("headers", []))
+                headers.append((b"x-db-query-count", str(stats.count).encode()))
+                headers.append((b"x-db-time-ms", f"{stats.duration_ms:.1f}".encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            _current.reset(token)
+            route = _route_name(scope)
+            _record_route(route, stats)
+            for observer in list(_observers):
+                observer(stats)
+            repeated = stats.repeated(QUERY_REPEAT_WARN)
+            if stats.count > QUERY_COUNT_WARN or stats.duration_ms > QUERY_TIME_WARN_MS or repeated:
+                logger.warning("🐢 %s: %s", route, stats.report(), extra={"queries": stats.count, "db_time_ms": round(stats.duration_ms, 1)})
+
+
+@contextmanager
+def count_queries():
+    """Conta le query eseguite nel blocco (chiamate dirette e richieste servite dal middleware)"""
+    stats = QueryStats()
+    token = _current.set(stats)
+    _observers.append(stats.merge)
+    try:
+        yield stats
+    finally:
+        _observers.remove(stats.merge)
+        _current.reset(token)
+
+
+@contextmanager
+def assert_max_queries(limit: int):
+    """AssertionError se il blocco esegue più di limit query, con gli statement ripetuti"""
+    with count_queries() as stats:
+        yield stats
+    if stats.count > limit:
+        raise AssertionError(f"Troppe query: {stats.count} > {limit}\n{stats.report()}")
@@ -0,0 +1,528 @@
+"""
+Calcolo dei risultati dei sondaggi e snapshot dei risultati finali
+
+Quando un sondaggio si chiude i suoi risultati non cambiano più: vengono calcolati
+una volta e salvati in survey_result_snapshots, così la pagina dei risultati di un
+sondaggio archiviato costa una sola lettura.
+Solo i campi specifici dell'utente (opzioni votate, risposte proprie) vengono
+aggiunti a ogni richiesta.
+
+Backfill dei sondaggi già chiusi:
+    python results.py backfill
+"""
+from collections import Counter
+from datetime import datetime, timezone
+from typing import List, Optional, Set
+
+from sqlalchemy.orm import Session
+from sqlalchemy import func
+
+import models, schemas, metrics
+from partitioning import survey_rows
+
+# Incrementare quando cambia la struttura di SurveyResultsResponse:
+# gli snapshot con versione diversa vengono ricalcolati alla prima lettura
+SNAPSHOT_VERSION = 1
+
+
+def calculate_like_stats(survey_id: int, db: Session) -> Optional[schemas.SurveyLikeStats]:
+    """Calcola le statistiche dei gradimenti per un sondaggio"""
+    ratings = [r[0] for r in db.query(models.SurveyLike.rating).filter(
+        models.SurveyLike.survey_id == survey_id
+    ).all()]
+    return like_stats(ratings)
+
+
+def like_stats(ratings: List[int]) -> Optional[schemas.SurveyLikeStats]:
+    """Media e distribuzione 1-5 dei gradimenti (None se non ce ne sono)"""
+    if not ratings:
+        return None
+    
+    total_likes = len(ratings)
+    average_rating = sum(ratings) / total_likes
+    
+    # Calcola la distribuzione (1-5)
+    rating_counts = Counter(ratings)
+    distribution = []
+    for val in range(1, 6):
+        distribution.append(schemas.ValueDistribution(
+            value=float(val),
+            count=rating_counts.get(val, 0)
+        ))
+    
+    return schemas.SurveyLikeStats(
+        average_rating=round(average_rating, 2),
+        total_likes=total_likes,
+        rating_distribution=distribution
+    )
+
+
+def is_closed(survey: models.Survey) -> bool:
+    """Un sondaggio è chiuso se disattivato o se la scadenza è passata"""
+    if not survey.is_active:
+        return True
+    if survey.expires_at:
+        expires_at = survey.expires_at if survey.expires_at.tzinfo else survey.expires_at.replace(tzinfo=timezone.utc)
+        return expires_at < datetime.now(timezone.utc)
+    return False
+
+
+def numeric_group_stats(survey: models.Survey, db: Session, option_ids: Optional[List[int]]) -> List[dict]:
+    """
+    Statistiche dei voti numerici per opzione, in un solo passaggio vettoriale.
+
+    Il database restituisce l'istogramma (option_id, numeric_value, conteggio) come
+    array (servito dall'indice idx_votes_survey_option_value); NumPy calcola
+    conteggi, media, mediana (elemento n//2 dei valori ordinati), min/max e la
+    distribuzione min_value..max_value con bincount pesati.
+    Con option_ids=None tutti i voti formano un unico gruppo.
+    Restituisce un dict per gruppo, nell'ordine di option_ids.
+    """
+    import numpy as np
+
+    histogram = db.query(
+        func.coalesce(models.Vote.option_id, -1).label("option_id"),
+        models.Vote.numeric_value.label("value"),
+        func.count().label("n")
+    ).filter(
+        *survey_rows(models.Vote, survey),
+        models.Vote.numeric_value.isnot(None)
+    ).group_by(models.Vote.option_id, models.Vote.numeric_value).subquery()
+    option_col, value_col, count_col = db.query(
+        func.array_agg(histogram.c.option_id),
+        func.array_agg(histogram.c.value),
+        func.array_agg(histogram.c.n)
+    ).one()
+
+    groups = len(option_ids) if option_ids is not None else 1
+    low, high = survey.min_value, survey.max_value
+    width = max(high - low + 1, 0)
+    empty = [{"count": 0, "distribution": [0] * width} for _ in range(groups)]
+    if not option_col:
+        return empty
+
+    values = np.asarray(value_col, dtype=np.float64)
+    weights = np.asarray(count_col, dtype=np.int64)
+    if option_ids is None:
+        group = np.zeros(len(values), dtype=np.int64)
+    else:
+        # option_id -> posizione in option_ids; i voti su opzioni estranee vengono ignorati
+        options = np.asarray(option_ids, dtype=np.int64)
+        sorter = np.argsort(options)
+        voted = np.asarray(option_col, dtype=np.int64)
+        pos = np.clip(np.searchsorted(options, voted, sorter=sorter), 0, len(options) - 1)
+        known = options[sorter[pos]] == voted
+        group, values, weights = sorter[pos[known]], values[known], weights[known]
+
+    counts = np.bincount(group, weights=weights, minlength=groups).astype(np.int64)
+    sums = np.bincount(group, weights=values * weights, minlength=groups)
+
+    # Ordinamento per (gruppo, valore): min, max e mediana dalle somme cumulative dei pesi
+    order = np.lexsort((values, group))
+    group, values, weights = group[order], values[order], weights[order]
+    cumulative = np.cumsum(weights)
+    first = np.searchsorted(group, np.arange(groups), side="left")
+    last = np.searchsorted(group, np.arange(groups), side="right") - 1
+    before = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    median_pos = np.searchsorted(cumulative, before + counts // 2, side="right")
+
+    # Distribuzione sui valori interi min_value..max_value
+    in_range = (values >= low) & (values <= high) & (values == np.floor(values))
+    cells = group[in_range] * width + (values[in_range] - low).astype(np.int64)
+    distribution = np.bincount(cells, weights=weights[in_range], minlength=groups * width)
+    distribution = distribution.astype(np.int64).reshape(groups, width) if width else np.zeros((groups, 0), dtype=np.int64)
+
+    stats = []
+    for g in range(groups):
+        if not counts[g]:
+            stats.append(empty[g])
+            continue
+        stats.append({
+            "count": int(counts[g]),
+            "average": float(sums[g] / counts[g]),
+            "median": float(values[median_pos[g]]),
+            "min": float(values[first[g]]),
+            "max": float(values[last[g]]),
+            "distribution": distribution[g].tolist(),
+        })
+    return stats
+
+
+def compute_survey_results(survey: models.Survey, db: Session, fields: Optional[Set[str]] = None) -> schemas.SurveyResultsResponse:
+    """
+    Risultati completi di un sondaggio, senza i campi specifici dell'utente.
+    Con fields (sparse fieldset) le sezioni costose non richieste (risposte aperte,
+    commenti e statistiche di gradimento) non vengono lette.
+    """
+    survey_id = survey.id
+    
+    def wants(name):
+        return fields is None or name in fields
+    
+    results = []
+    numeric_stats = None
+    value_distribution = None
+    open_responses = []
+    most_common_date = None
+    total_votes = 0
+    total_responses = 0
+    
+    if survey.question_type in [models.QuestionType.SINGLE_CHOICE, models.QuestionType.MULTIPLE_CHOICE]:
+        # Risultati per choice
+        result_query = db.query(
+            models.SurveyOption.id,
+            models.SurveyOption.option_text,
+            func.count(models.Vote.id).label('vote_count')
+        ).outerjoin(models.Vote).filter(
+            models.SurveyOption.survey_id == survey_id
+        ).group_by(models.SurveyOption.id).all()
+        
+        total_votes = sum(r.vote_count for r in result_query)
+        
+        results = [
+            schemas.SurveyResult(
+                option_id=r.id,
+                option_text=r.option_text,
+                vote_count=r.vote_count,
+                percentage=round((r.vote_count / total_votes * 100), 2) if total_votes > 0 else 0
+            )
+            for r in result_query
+        ]
+        
+        # Per multiple choice, conta risposte uniche
+        total_responses = db.query(models.Vote.voter_session).filter(
+            models.Vote.survey_id == survey_id
+        ).distinct().count()
+    
+    elif survey.question_type == models.QuestionType.OPEN_TEXT:
+        # Risposte aperte
+        # Controlla se ci sono opzioni nel sondaggio
+        survey_options = db.query(models.SurveyOption).filter(
+            models.SurveyOption.survey_id == survey_id
+        ).all()
+        
+        if wants("open_responses"):
+            open_responses_query = db.query(models.OpenResponse).filter(
+                models.OpenResponse.survey_id == survey_id
+            ).all()
+            open_responses = [schemas.OpenResponse.from_orm(r) for r in open_responses_query]
+            responses_per_option = Counter(r.option_id for r in open_responses_query)
+        else:
+            # Solo i conteggi: il testo delle risposte non viene letto
+            responses_per_option = Counter(dict(db.query(
+                models.OpenResponse.option_id,
+                func.count(models.OpenResponse.id)
+            ).filter(*survey_rows(models.OpenResponse, survey)).group_by(models.OpenResponse.option_id).all()))
+        total_votes = sum(responses_per_option.values())
+        total_responses = total_votes
+        
+        # Se ci sono opzioni, crea anche un conteggio per opzione
+        if survey_options:
+            for option in survey_options:
+                results.append(schemas.SurveyResult(
+                    option_id=option.id,
+                    option_text=option.option_text,
+                    vote_count=responses_per_option[option.id]
+                ))
+    
+    elif survey.question_type in [models.QuestionType.SCALE, models.QuestionType.RATING]:
+        # Statistiche numeriche: istogramma (opzione, valore) calcolato dal database
+        # e aggregato con NumPy in un solo passaggio (vedi numeric_group_stats)
+        survey_options = db.query(models.SurveyOption).filter(
+            models.SurveyOption.survey_id == survey_id
+        ).all()
+        value_range = range(survey.min_value, survey.max_value + 1)
+        
+        if survey_options:
+            # Con opzioni: mostra risultati per ogni opzione
+            stats = numeric_group_stats(survey, db, [option.id for option in survey_options])
+            for option, option_stats in zip(survey_options, stats):
+                distribution = [
+                    schemas.ValueDistribution(value=float(val), count=count)
+                    for val, count in zip(value_range, option_stats["distribution"])
+                ]
+                if option_stats["count"]:
+                    results.append(schemas.SurveyResult(
+                        option_id=option.id,
+                        option_text=option.option_text,
+                        vote_count=option_stats["count"],
+                        numeric_average=round(option_stats["average"], 2),
+                        numeric_median=option_stats["median"],
+                        numeric_min=option_stats["min"],
+                        numeric_max=option_stats["max"],
+                        value_distribution=distribution
+                    ))
+                    total_votes += option_stats["count"]
+                else:
+                    # Distribuzione vuota se non ci sono voti
+                    results.append(schemas.SurveyResult(
+                        option_id=option.id,
+                        option_text=option.option_text,
+                        vote_count=0,
+                        value_distribution=distribution
+                    ))
+            
+            total_responses = total_votes
+        else:
+            # Backward compatibility: statistiche senza opzioni (tutti i voti in un unico gruppo)
+            overall = numeric_group_stats(survey, db, None)[0]
+            
+            if overall["count"]:
+                total_votes = overall["count"]
+                total_responses = total_votes
+                
+                numeric_stats = schemas.NumericResultStats(
+                    average=round(overall["average"], 2),
+                    min_value=overall["min"],
+                    max_value=overall["max"],
+                    median=overall["median"],
+                    count=overall["count"]
+                )
+                
+                # Distribuzione su tutti i valori possibili da min_value a max_value
+                value_distribution = [
+                    schemas.ValueDistribution(value=float(val), count=count)
+                    for val, count in zip(value_range, overall["distribution"])
+                ]
+    
+    elif survey.question_type == models.QuestionType.DATE:
+        # Date - controlla se ci sono opzioni
+        survey_options = db.query(models.SurveyOption).filter(
+            models.SurveyOption.survey_id == survey_id
+        ).all()
+        
+        if survey_options:
+            # Con opzioni: mostra risultati come per SINGLE_CHOICE
+            result_query = db.query(
+                models.SurveyOption.id,
+                models.SurveyOption.option_text,
+                func.count(models.Vote.id).label('vote_count')
+            ).outerjoin(models.Vote).filter(
+                models.SurveyOption.survey_id == survey_id
+            ).group_by(models.SurveyOption.id).all()
+            
+            total_votes = sum(r.vote_count for r in result_query)
+            
+            results = [
+                schemas.SurveyResult(
+                    option_id=r.id,
+                    option_text=r.option_text,
+                    vote_count=r.vote_count,
+                    percentage=round((r.vote_count / total_votes * 100), 2) if total_votes > 0 else 0
+                )
+                for r in result_query
+            ]
+            
+            total_responses = total_votes
+        else:
+            # Backward compatibility: date senza opzioni.
+            # Una sola query raggruppata: totale e data più votata dallo stesso istogramma
+            date_counts = db.query(
+                models.Vote.date_value,
+                func.count(models.Vote.id)
+            ).filter(
+                *survey_rows(models.Vote, survey),
+                models.Vote.date_value.isnot(None)
+            ).group_by(models.Vote.date_value).all()
+            
+            if date_counts:
+                most_common_date, _ = max(date_counts, key=lambda r: r[1])
+                total_votes = sum(count for _, count in date_counts)
+                total_responses = total_votes
+    
+    # Recupera tutti i commenti dai gradimenti (i commenti ora sono in survey_likes)
+    comments_from_likes = db.query(models.SurveyLike).filter(
+        models.SurveyLike.survey_id == survey_id,
+        models.SurveyLike.comment.isnot(None),
+        models.SurveyLike.comment != ''
+    ).order_by(models.SurveyLike.created_at.desc()).all() if wants("like_comments") else []
+    
+    # Costruisci i commenti del gradimento con informazioni utente (se non anonimo)
+    like_comments = []
+    for like in comments_from_likes:
+        comment_dict = {
+            'id': like.id,
+            'survey_id': like.survey_id,
+            'rating': like.rating,
+            'comment': like.comment,
+            'created_at': like.created_at,
+            'user_id': like.user_id
+        }
+        # Se il sondaggio non è anonimo e c'è un user_id, recupera i dati utente
+        if not survey.is_anonymous and like.user_id:
+            user = db.query(models.User).filter(models.User.id == like.user_id).first()
+            if user:
+                comment_dict['user_name'] = user.name
+                comment_dict['user_email'] = user.email
+        like_comments.append(schemas.SurveyLikeComment(**comment_dict))
+    
+    # Calcola statistiche gradimento
+    like_stats = calculate_like_stats(survey_id, db) if wants("like_stats") else None
+    
+    return schemas.SurveyResultsResponse(
+        survey_id=survey_id,
+        survey_title=survey.title,
+        question_type=survey.question_type,
+        total_votes=total_votes,
+        total_responses=total_responses,
+        results=results,
+        numeric_stats=numeric_stats,
+        value_distribution=value_distribution,
+        rating_icon=survey.rating_icon if survey.question_type in [models.QuestionType.RATING, models.QuestionType.SCALE] else None,
+        min_value=survey.min_value if survey.question_type in [models.QuestionType.RATING, models.QuestionType.SCALE] else None,
+        max_value=survey.max_value if survey.question_type in [models.QuestionType.RATING, models.QuestionType.SCALE] else None,
+        like_stats=like_stats,
+        like_comments=like_comments,
+        open_responses=open_responses,
+        most_common_date=most_common_date
+    )
+
+
+def user_result_fields(survey: models.Survey, user_id: Optional[int], db: Session) -> dict:
+    """Campi dei risultati specifici dell'utente corrente (solo per sondaggi non anonimi)"""
+    user_voted_option_ids = []
+    user_response_ids = []
+    user_numeric_votes = None
+    if user_id and not survey.is_anonymous:
+        # Opzioni votate per sondaggi a scelta/data
+        if survey.question_type in [models.QuestionType.SINGLE_CHOICE, models.QuestionType.MULTIPLE_CHOICE, models.QuestionType.DATE]:
+            user_votes = db.query(models.Vote.option_id).filter(
+                models.Vote.survey_id == survey.id,
+                models.Vote.user_id == user_id
+            ).all()
+            user_voted_option_ids = [vote.option_id for vote in user_votes if vote.option_id]
+        
+        # Voti numerici per sondaggi SCALE/RATING
+        if survey.question_type in [models.QuestionType.SCALE, models.QuestionType.RATING]:
+            user_votes = db.query(models.Vote.option_id, models.Vote.numeric_value).filter(
+                models.Vote.survey_id == survey.id,
+                models.Vote.user_id == user_id
+            ).all()
+            # Dizionario {option_id: numeric_value} con chiavi intere
+            user_numeric_votes = {
+                int(vote.option_id): int(vote.numeric_value)
+                for vote in user_votes
+                if vote.option_id and vote.numeric_value is not None
+            }
+        
+        # Risposte aperte dell'utente per sondaggi a risposta aperta
+        if survey.question_type == models.QuestionType.OPEN_TEXT:
+            user_open_responses = db.query(models.OpenResponse.id).filter(
+                models.OpenResponse.survey_id == survey.id,
+                models.OpenResponse.user_id == user_id
+            ).all()
+            user_response_ids = [resp.id for resp in user_open_responses]
+    
+    return {
+        "user_voted_option_ids": user_voted_option_ids,
+        "user_response_ids": user_response_ids,
+        "user_numeric_votes": user_numeric_votes
+    }
+
+
+# ===== SNAPSHOT DEI RISULTATI FINALI =====
+
+def freeze_results(survey: models.Survey, db: Session) -> schemas.SurveyResultsResponse:
+    """Calcola i risultati finali e li salva come snapshot (il commit è a carico del chiamante)"""
+    response = compute_survey_results(survey, db)
+    db.merge(models.SurveyResultSnapshot(
+        survey_id=survey.id,
+        version=SNAPSHOT_VERSION,
+        payload=response.model_dump(mode="json"),
+        frozen_at=datetime.now(timezone.utc)
+    ))
+    return response
+
+
+def invalidate_snapshot(survey_id: int, db: Session):
+    """Elimina lo snapshot (sondaggio riaperto o gradimenti modificati): verrà ricalcolato alla prossima lettura"""
+    db.query(models.SurveyResultSnapshot).filter(
+        models.SurveyResultSnapshot.survey_id == survey_id
+    ).delete(synchronize_session=False)
+
+
+def on_status_change(survey: models.Survey, db: Session):
+    """Hook da chiamare prima del commit quando cambia lo stato/scadenza di un sondaggio"""
+    if is_closed(survey):
+        freeze_results(survey, db)
+    else:
+        invalidate_snapshot(survey.id, db)
+
+
+def get_survey_results(survey: models.Survey, db: Session) -> schemas.SurveyResultsResponse:
+    """
+    Risultati senza campi utente: per i sondaggi chiusi legge lo snapshot,
+    creandolo alla prima lettura se manca (sondaggi chiusi prima dell'introduzione degli snapshot)
+    """
+    if not is_closed(survey):
+        return compute_survey_results(survey, db)
+    
+    snapshot = db.query(models.SurveyResultSnapshot).filter(
+        models.SurveyResultSnapshot.survey_id == survey.id
+    ).first()
+    if snapshot and snapshot.version == SNAPSHOT_VERSION:
+        metrics.cache_hit("results_snapshot", True)
+        return schemas.SurveyResultsResponse.model_validate(snapshot.payload)
+    
+    metrics.cache_hit("results_snapshot", False)
+    response = freeze_results(survey, db)
+    db.commit()
+    return response
+
+
+def get_survey_results_payload(survey: models.Survey, db: Session, fields: Optional[Set[str]] = None) -> dict:
+    """
+    Come get_survey_results ma come dict pronto per la codifica JSON:
+    il payload dello snapshot viene restituito senza rivalidarlo con pydantic.
+    Con fields i sondaggi aperti calcolano solo le sezioni richieste (la proiezione è a carico del chiamante).
+    """
+    if not is_closed(survey):
+        return compute_survey_results(survey, db, fields).model_dump()
+    snapshot = db.query(models.SurveyResultSnapshot).filter(
+        models.SurveyResultSnapshot.survey_id == survey.id
+    ).first()
+    if snapshot and snapshot.version == SNAPSHOT_VERSION:
+        metrics.cache_hit("results_snapshot", True)
+        return dict(snapshot.payload)
+    return get_survey_results(survey, db).model_dump()
+
+
+def backfill_snapshots(db: Session, batch_size: int = 100) -> int:
+    """Crea gli snapshot mancanti (o di versione precedente) per tutti i sondaggi chiusi"""
+    frozen = 0
+    up_to_date = db.query(models.SurveyResultSnapshot.survey_id).filter(
+        models.SurveyResultSnapshot.version == SNAPSHOT_VERSION
+    )
+    candidates = db.query(models.Survey).filter(
+        ~models.Survey.id.in_(up_to_date)
+    ).order_by(models.Survey.id).all()
+    for survey in candidates:
+        if not is_closed(survey):
+            continue
+        freeze_results(survey, db)
+        frozen += 1
+        if frozen % batch_size == 0:
+            db.commit()
+    db.commit()
+    return frozen
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="Snapshot dei risultati dei sondaggi chiusi")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if os.getenv("DEPLOY_MODE", "local").lower() == "databricks":
+        from lakebase_connector import SessionLocal
+    else:
+        from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        print(f"✅ {backfill_snapshots(db, args.batch_size)} snapshot creati")
+    finally:
+        db.close()
@@ -159,6 +159,22 @@ class Vote(BaseModel):
     class Config:
         from_attributes = True
 
+# Import massivo di schede (cartacee / chioschi offline)
+class BallotImportError(BaseModel):
+    row: int  # Numero di riga dei dati (1 = prima riga dopo l'header)
+    error: str
+
+class BallotImportResponse(BaseModel):
+    survey_id: int
+    target_table: str  # votes oppure open_responses
+    total_rows: int
+    imported_rows: int
+    rejected_rows: int
+    dry_run: bool = False
+    errors: List[BallotImportError] = []
+    errors_truncated: bool = False  # True se gli errori superano IMPORT_MAX_ERRORS
+    elapsed_seconds: float
+
 # ===== SCHEMI PER RISPOSTE APERTE =====
 class OpenResponseCreate(BaseModel):
     response_text: str = Field(..., min_length=1)
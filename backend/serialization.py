@@ -0,0 +1,88 @@
+"""
+Serializzazione veloce per gli endpoint caldi (lista sondaggi, risultati, mappa)
+
+Invece di costruire un modello pydantic, convertirlo in dict, rivalidarlo in un
+secondo modello e farlo validare ancora da FastAPI (response_model), questi
+endpoint costruiscono dict semplici direttamente dagli oggetti ORM e li
+codificano con orjson. Restituendo una Response, FastAPI salta la validazione
+del response_model, che resta sull'endpoint solo per la documentazione OpenAPI.
+
+I campi dei dict sono presi dagli schemi pydantic: aggiungendo un campo a
+schemas.Survey lo si aggiunge anche qui.
+"""
+from typing import Any, Dict, List, Optional, Set
+
+import orjson
+from fastapi.responses import ORJSONResponse
+
+import models, schemas
+
+# OPT_UTC_Z: "Z" per UTC come pydantic; OPT_NON_STR_KEYS: dict con chiavi intere (user_numeric_votes)
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+class FastJSONResponse(ORJSONResponse):
+    """ORJSONResponse con le opzioni compatibili con l'output di pydantic"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
+
+
+def _field_defaults(schema) -> Dict[str, Any]:
+    return {
+        name: None if field.is_required() else field.default
+        for name, field in schema.model_fields.items()
+    }
+
+
+# Campi "piatti" degli schemi (gli oggetti annidati sono gestiti a parte)
+_SURVEY_FIELDS = {
+    name: default for name, default in _field_defaults(schemas.Survey).items()
+    if name not in ("creator", "options", "tags")
+}
+_OPTION_FIELDS = _field_defaults(schemas.SurveyOption)
+_TAG_FIELDS = _field_defaults(schemas.Tag)
+_USER_FIELDS = _field_defaults(schemas.UserBasic)
+
+
+def _attrs(obj, fields: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: getattr(obj, name, default) for name, default in fields.items()}
+
+
+def survey_dict(survey: models.Survey, fields: Optional[Set[str]] = None) -> Dict[str, Any]:
+    """
+    Equivalente di schemas.Survey.from_orm(survey).model_dump(), senza validazione.
+    Con fields (sparse fieldset) legge solo gli attributi richiesti, senza lazy load degli altri.
+    """
+    def wants(name):
+        return fields is None or name in fields
+
+    data = _attrs(survey, _SURVEY_FIELDS if fields is None else {
+        name: default for name, default in _SURVEY_FIELDS.items() if name in fields
+    })
+    if wants("creator"):
+        data["creator"] = _attrs(survey.creator, _USER_FIELDS) if survey.creator else None
+    if wants("options"):
+        data["options"] = [_attrs(option, _OPTION_FIELDS) for option in survey.options]
+    if wants("tags"):
+        data["tags"] = [_attrs(tag, _TAG_FIELDS) for tag in survey.tags]
+    return data
+
+
+def h3_hexagons(boundaries: List[Any], counts: List[Any]) -> List[Dict[str, Any]]:
+    """Righe H3 (colonne del DataFrame, non iterrows) -> esagoni con GeoJSON decodificato con orjson"""
+    return [
+        {
+            "hex_boundary": orjson.loads(boundary) if isinstance(boundary, str) else boundary,
+            "count": int(count)
+        }
+        for boundary, count in zip(boundaries, counts)
+    ]
+
+
+def json_response(content: Any, status_code: int = 200) -> FastJSONResponse:
+    return FastJSONResponse(content=content, status_code=status_code)
+
+
+def loads(data) -> Any:
+    return orjson.loads(data)
@@ -0,0 +1,179 @@
+"""
+Log delle query lente con EXPLAIN (ANALYZE, BUFFERS) a campione
+
+Ogni statement oltre SLOW_QUERY_MS viene registrato con i parametri bind, la
+route di origine e il sondaggio (path param survey_id o parametro bind
+survey_id*) in un buffer circolare di SLOW_QUERY_KEEP voci, visibile da
+GET /api/debug/slow-queries.
+
+Per una frazione SLOW_QUERY_EXPLAIN_SAMPLE delle SELECT lente il piano viene
+catturato in background con EXPLAIN (ANALYZE, BUFFERS) su una connessione
+separata del pool, dentro una transazione annullata e con statement_timeout:
+un solo worker e al massimo SLOW_QUERY_EXPLAIN_QUEUE piani in coda, gli altri
+vengono scartati. EXPLAIN ANALYZE riesegue la query, per questo solo SELECT.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import count
+from typing import List, Optional
+
+from sqlalchemy import event
+
+import query_stats
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_KEEP = int(os.getenv("SLOW_QUERY_KEEP", "200"))
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE", "0.1"))
+SLOW_QUERY_EXPLAIN_QUEUE = int(os.getenv("SLOW_QUERY_EXPLAIN_QUEUE", "10"))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", "10000"))
+
+# Lunghezza massima di statement e parametri salvati nel buffer
+MAX_STATEMENT_CHARS = 4000
+MAX_PARAM_CHARS = 200
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_entries: deque = deque(maxlen=SLOW_QUERY_KEEP)
+_ids = count(1)
+
+_explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-query-explain")
+_explain_pending = 0
+# Le query del worker di EXPLAIN non vanno registrate (sarebbero lente per definizione)
+_local = threading.local()
+
+
+def _short(value) -> str:
+    text = repr(value)
+    return text if len(text) <= MAX_PARAM_CHARS else text[:MAX_PARAM_CHARS] + "..."
+
+
+def _safe_parameters(parameters):
+    if isinstance(parameters, dict):
+        return {key: _short(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_short(value) for value in parameters]
+    return None
+
+
+def _origin(parameters):
+    """(route, survey_id) della richiesta corrente"""
+    stats = query_stats.current()
+    scope = stats.scope if stats is not None else None
+    route = survey_id = None
+    if scope is not None:
+        route = f"{scope.get('method', '')} {getattr(scope.get('route'), 'path', scope.get('path'))}"
+        # Starlette lascia i path param come stringhe: stesso tipo dei parametri bind
+        path_survey_id = (scope.get("path_params") or {}).get("survey_id")
+        if isinstance(path_survey_id, str) and path_survey_id.isdigit():
+            survey_id = int(path_survey_id)
+        elif isinstance(path_survey_id, int):
+            survey_id = path_survey_id
+    if survey_id is None and isinstance(parameters, dict):
+        for key, value in parameters.items():
+            if key.startswith("survey_id") and isinstance(value, int):
+                survey_id = value
+                break
+    return route, survey_id
+
+
+def _explainable(statement: str, executemany: bool) -> bool:
+    head = statement.lstrip().upper()
+    return not executemany and head.startswith("SELECT") and "FOR UPDATE" not in head
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["slow_query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("slow_query_start", None)
+    if started is None or getattr(_local, "explaining", False):
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    route, survey_id = _origin(parameters)
+    entry = {
+        "id": next(_ids),
+        "at": datetime.now(timezone.utc).isoformat(),
+        "duration_ms": round(duration_ms, 1),
+        "route": route,
+        "survey_id": survey_id,
+        "statement": statement[:MAX_STATEMENT_CHARS],
+        "fingerprint": query_stats.fingerprint(statement)[:MAX_STATEMENT_CHARS],
+        "parameters": _safe_parameters(parameters),
+        "explain": None,
+        "explain_error": None,
+    }
+    with _lock:
+        _entries.append(entry)
+    logger.warning(
+        "🐌 Query lenta %s ms (%s): %s", entry["duration_ms"], route or "fuori richiesta", entry["fingerprint"][:200],
+        extra={"slow_query_id": entry["id"], "survey_id": survey_id}
+    )
+
+    engine = conn.engine
+    if (
+        engine.dialect.name == "postgresql"
+        and _explainable(statement, executemany)
+        and random.random() < SLOW_QUERY_EXPLAIN_SAMPLE
+    ):
+        _schedule_explain(engine, entry, statement, parameters)
+
+
+def _schedule_explain(engine, entry: dict, statement: str, parameters):
+    global _explain_pending
+    with _lock:
+        if _explain_pending >= SLOW_QUERY_EXPLAIN_QUEUE:
+            return
+        _explain_pending += 1
+        entry["explain"] = "pending"
+    _explain_executor.submit(_run_explain, engine, entry, statement, parameters)
+
+
+def _run_explain(engine, entry: dict, statement: str, parameters):
+    global _explain_pending
+    plan = error = None
+    _local.explaining = True
+    try:
+        with engine.connect() as conn:
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+            rows = conn.exec_driver_sql(
+                "EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters or {}
+            ).fetchall()
+            plan = "\n".join(row[0] for row in rows)
+            # EXPLAIN ANALYZE esegue davvero la query: nessun effetto da conservare
+            conn.rollback()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:500]
+    finally:
+        _local.explaining = False
+        with _lock:
+            _explain_pending -= 1
+            entry["explain"] = plan
+            entry["explain_error"] = error
+
+
+def install(engine):
+    """Registra i listener sull'engine (idempotente)"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def recent(limit: int = 50, route: Optional[str] = None, survey_id: Optional[int] = None) -> List[dict]:
+    """Query lente dalla più recente, filtrabili per route (sottostringa) e sondaggio"""
+    with _lock:
+        entries = [dict(entry) for entry in reversed(_entries)]
+    if route:
+        entries = [entry for entry in entries if entry["route"] and route in entry["route"]]
+    if survey_id is not None:
+        entries = [entry for entry in entries if entry["survey_id"] == survey_id]
+    return entries[:limit]
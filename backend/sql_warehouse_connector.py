@@ -2,79 +2,284 @@
 SQL Warehouse Connector for H3 Geospatial Queries
 Separate from Lakebase connector to query Unity Catalog tables
 Uses Databricks SDK for better authentication handling in Apps
+
+Le chiamate condividono il WorkspaceClient di lakebase_connector (creato una
+sola volta, al primo utilizzo) e un executor di WAREHOUSE_MAX_CONCURRENCY
+thread creato all'avvio del processo: una richiesta della mappa non paga né la
+discovery dell'autenticazione né la creazione dei thread.
+
+- run_query(): versione async con al massimo WAREHOUSE_MAX_QUEUE query in attesa
+  oltre a quelle in esecuzione (oltre: WarehouseUnavailable, 503)
+- timeout per chiamata (WAREHOUSE_QUERY_TIMEOUT, attesa in coda compresa): lo
+  statement viene seguito con get_statement e annullato sul warehouse alla scadenza
+- circuit breaker: dopo WAREHOUSE_BREAKER_FAILURES timeout/errori di
+  connessione consecutivi le chiamate falliscono subito per
+  WAREHOUSE_BREAKER_COOLDOWN secondi (warehouse spento o in avvio), poi una
+  sola chiamata di prova decide se richiudere il circuito. Gli errori SQL
+  (statement FAILED) non contano: il warehouse ha risposto.
 """
+import asyncio
+import logging
 import os
-from databricks.sdk import WorkspaceClient
-from databricks.sdk.service import sql as sdk_sql
-import pandas as pd
-from typing import Optional
-from fastapi import Request
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, TYPE_CHECKING
+from fastapi import Request
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# pandas e Databricks SDK vengono importati al primo utilizzo (pesanti all'avvio)
+if TYPE_CHECKING:
+    import pandas as pd
+
+WAREHOUSE_MAX_CONCURRENCY = int(os.getenv("WAREHOUSE_MAX_CONCURRENCY", "4"))
+WAREHOUSE_MAX_QUEUE = int(os.getenv("WAREHOUSE_MAX_QUEUE", "16"))
+# Il warehouse può impiegare 2-3 minuti per avviarsi se è fermo
+WAREHOUSE_QUERY_TIMEOUT = float(os.getenv("WAREHOUSE_QUERY_TIMEOUT", "180"))
+WAREHOUSE_BREAKER_FAILURES = int(os.getenv("WAREHOUSE_BREAKER_FAILURES", "3"))
+WAREHOUSE_BREAKER_COOLDOWN = float(os.getenv("WAREHOUSE_BREAKER_COOLDOWN", "30"))
+
+# Attesa sincrona massima consentita da execute_statement (5-50 s), poi polling
+MAX_WAIT_TIMEOUT = 50
+POLL_INTERVAL = 1.0
+# Retry-After suggerito quando la coda è piena
+QUEUE_FULL_RETRY_AFTER = 5
+
+
+class WarehouseUnavailable(Exception):
+    """Circuito aperto o coda piena: la chiamata fallisce subito"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class WarehouseTimeout(Exception):
+    """La query non si è conclusa entro il timeout (statement annullato)"""
+
+
+class WarehouseQueryError(Exception):
+    """Lo statement è fallito sul warehouse (errore SQL)"""
+
+
+class CircuitBreaker:
+    """Circuit breaker chiuso / aperto / semiaperto (una chiamata di prova dopo il cooldown)"""
+
+    def __init__(self, failures: int, cooldown: float):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.cooldown else "open"
+
+    def retry_after(self) -> Optional[float]:
+        """Secondi prima di poter riprovare, None se una chiamata può passare (senza prenotarla)"""
+        with self._lock:
+            return self._retry_after()
+
+    def _retry_after(self) -> Optional[float]:
+        if self._opened_at is None:
+            return None
+        remaining = self.cooldown - (time.monotonic() - self._opened_at)
+        if remaining > 0:
+            return remaining
+        # Semiaperto: passa una sola chiamata di prova alla volta
+        return self.cooldown if self._trial else None
+
+    def acquire(self) -> Optional[float]:
+        """Come retry_after, ma prenota la chiamata di prova se il circuito è semiaperto"""
+        with self._lock:
+            retry_after = self._retry_after()
+            if retry_after is None and self._opened_at is not None:
+                self._trial = True
+            return retry_after
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("🟢 SQL Warehouse circuit closed")
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial = False
+            metrics.WAREHOUSE_CIRCUIT_OPEN.set(0)
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._trial or self._consecutive >= self.failures:
+                if self._opened_at is None or self._trial:
+                    logger.warning(
+                        "🔴 SQL Warehouse circuit open for %ss after %d failures",
+                        self.cooldown, self._consecutive
+                    )
+                self._opened_at = time.monotonic()
+                metrics.WAREHOUSE_CIRCUIT_OPEN.set(1)
+            self._trial = False
+
+
+breaker = CircuitBreaker(WAREHOUSE_BREAKER_FAILURES, WAREHOUSE_BREAKER_COOLDOWN)
+
+_executor = ThreadPoolExecutor(max_workers=WAREHOUSE_MAX_CONCURRENCY, thread_name_prefix="sql-warehouse")
+_pending_lock = threading.Lock()
+_pending = 0
+
+
+def _workspace_client():
+    # Un solo WorkspaceClient per processo, condiviso con la connessione a Lakebase
+    from lakebase_connector import get_workspace_client
+    return get_workspace_client()
 
 
-def execute_sql_warehouse_query(query: str, request: Optional[Request] = None) -> pd.DataFrame:
+def _execute(query: str, warehouse_id: str, deadline: float):
+    """Esegue lo statement e lo segue fino al termine o alla scadenza (poi lo annulla)"""
+    from databricks.sdk.service.sql import ExecuteStatementRequestOnWaitTimeout, StatementState
+
+    w = _workspace_client()
+    wait = int(min(MAX_WAIT_TIMEOUT, max(5, deadline - time.monotonic())))
+    result = w.statement_execution.execute_statement(
+        warehouse_id=warehouse_id,
+        statement=query,
+        wait_timeout=f"{wait}s",
+        on_wait_timeout=ExecuteStatementRequestOnWaitTimeout.CONTINUE
+    )
+    while result.status and result.status.state in (StatementState.PENDING, StatementState.RUNNING):
+        if time.monotonic() >= deadline:
+            try:
+                w.statement_execution.cancel_execution(result.statement_id)
+            except Exception:
+                logger.warning("Cancel of statement %s failed", result.statement_id, exc_info=True)
+            raise WarehouseTimeout("SQL Warehouse query timed out")
+        time.sleep(min(POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+        result = w.statement_execution.get_statement(result.statement_id)
+
+    if result.status and result.status.state != StatementState.SUCCEEDED:
+        error = result.status.error.message if result.status.error else result.status.state.value
+        raise WarehouseQueryError(f"Statement {result.status.state.value}: {error}")
+    return result
+
+
+def execute_sql_warehouse_query(query: str, request: Optional[Request] = None, timeout: Optional[float] = None) -> "pd.DataFrame":
     """
     Execute a SQL query on Databricks SQL Warehouse using SDK and return results as DataFrame
-    Uses Databricks SDK which handles authentication automatically in Apps context
-    
+    Uses Databricks SDK which handles authentication automatically in Apps
+
     Args:
         query: SQL query to execute
         request: FastAPI Request object (not used, kept for compatibility)
-        
+        timeout: seconds before the statement is cancelled (default WAREHOUSE_QUERY_TIMEOUT)
+
     Returns:
         pandas DataFrame with query results
+
+    Raises WarehouseUnavailable (circuit open), WarehouseTimeout, WarehouseQueryError
     """
-    import traceback
-    
+    import pandas as pd
+
+    DATABRICKS_WAREHOUSE_ID = os.getenv("DATABRICKS_WAREHOUSE_ID")
+    if not DATABRICKS_WAREHOUSE_ID:
+        logger.error("DATABRICKS_WAREHOUSE_ID environment variable not set")
+        raise ValueError("DATABRICKS_WAREHOUSE_ID environment variable not set")
+
+    if timeout is not None and timeout <= 0:
+        # Scaduta in coda: non arriva al warehouse e non conta per il circuit breaker
+        metrics.WAREHOUSE_QUERY.labels(status="timeout").observe(0)
+        raise WarehouseTimeout("SQL Warehouse query timed out in queue")
+
+    retry_after = breaker.acquire()
+    if retry_after is not None:
+        metrics.WAREHOUSE_QUERY.labels(status="rejected").observe(0)
+        raise WarehouseUnavailable("SQL Warehouse circuit open", retry_after)
+
+    started = time.perf_counter()
+    deadline = time.monotonic() + (WAREHOUSE_QUERY_TIMEOUT if timeout is None else timeout)
     try:
-        DATABRICKS_WAREHOUSE_ID = os.getenv("DATABRICKS_WAREHOUSE_ID")
-        
-        if not DATABRICKS_WAREHOUSE_ID:
-            print("ERROR: DATABRICKS_WAREHOUSE_ID environment variable not set")
-            raise ValueError("DATABRICKS_WAREHOUSE_ID environment variable not set")
-        
-        print(f"DATABRICKS_WAREHOUSE_ID: {DATABRICKS_WAREHOUSE_ID}")
-        print(f"Query preview: {query[:200]}...")
-        
-        # Use Databricks SDK - it handles authentication automatically in Apps
-        print("Creating WorkspaceClient for SQL execution...")
-        w = WorkspaceClient()
-        
-        print(f"Executing query on warehouse {DATABRICKS_WAREHOUSE_ID}...")
-        # Execute the query using SDK
-        result = w.statement_execution.execute_statement(
-            warehouse_id=DATABRICKS_WAREHOUSE_ID,
-            statement=query,
-            wait_timeout="50s"  # Maximum allowed wait time
-        )
-        
-        print("Query executed, processing results...")
-        
-        # Extract column names and data from result
-        if not result.manifest or not result.manifest.schema or not result.manifest.schema.columns:
-            print("No data returned from query")
-            return pd.DataFrame()
-        
-        columns = [col.name for col in result.manifest.schema.columns]
-        print(f"Columns: {columns}")
-        
-        # Extract rows from result
-        rows = []
-        if result.result and result.result.data_array:
-            for row_data in result.result.data_array:
-                # row_data is already a list of values
-                rows.append(row_data)
-            print(f"Fetched {len(rows)} rows")
-        else:
-            print("No rows in result")
-        
-        df = pd.DataFrame(rows, columns=columns)
-        print(f"✓ Query completed successfully - returned {len(df)} rows")
-        return df
-        
+        # Anteprima della query solo a livello DEBUG (nessuno slicing se disabilitato)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Warehouse query: %s", query[:200])
+
+        result = _execute(query, DATABRICKS_WAREHOUSE_ID, deadline)
+    except WarehouseQueryError as e:
+        # Errore SQL: il warehouse è raggiungibile, il circuito non si apre
+        breaker.success()
+        metrics.WAREHOUSE_QUERY.labels(status="error").observe(time.perf_counter() - started)
+        logger.warning("Warehouse query failed: %s", e)
+        raise
+    except WarehouseTimeout:
+        breaker.failure()
+        metrics.WAREHOUSE_QUERY.labels(status="timeout").observe(time.perf_counter() - started)
+        logger.error("Warehouse query timed out", extra={"duration_ms": round((time.perf_counter() - started) * 1000, 1)})
+        raise
     except Exception as e:
-        print(f"ERROR in execute_sql_warehouse_query: {type(e).__name__}: {str(e)}")
-        print("Full traceback:")
-        print(traceback.format_exc())
+        breaker.failure()
+        metrics.WAREHOUSE_QUERY.labels(status="error").observe(time.perf_counter() - started)
+        logger.exception("Warehouse query failed: %s", type(e).__name__)
         raise
 
+    breaker.success()
+    duration = time.perf_counter() - started
+    metrics.WAREHOUSE_QUERY.labels(status="ok").observe(duration)
+
+    # Extract column names and data from result
+    if not result.manifest or not result.manifest.schema or not result.manifest.schema.columns:
+        logger.info("Warehouse query returned no data", extra={"duration_ms": round(duration * 1000, 1)})
+        return pd.DataFrame()
+
+    columns = [col.name for col in result.manifest.schema.columns]
+
+    # Extract rows from result (row_data is already a list of values)
+    rows = result.result.data_array if result.result and result.result.data_array else []
+
+    df = pd.DataFrame(rows, columns=columns)
+    logger.info("Warehouse query completed", extra={"rows": len(df), "duration_ms": round(duration * 1000, 1)})
+    return df
+
+
+async def run_query(query: str, timeout: float = WAREHOUSE_QUERY_TIMEOUT) -> "pd.DataFrame":
+    """
+    execute_sql_warehouse_query sull'executor condiviso. Il timeout comprende
+    l'attesa in coda; con il circuito aperto o la coda piena fallisce subito.
+    """
+    global _pending
+    retry_after = breaker.retry_after()
+    if retry_after is not None:
+        metrics.WAREHOUSE_QUERY.labels(status="rejected").observe(0)
+        raise WarehouseUnavailable("SQL Warehouse circuit open", retry_after)
+    with _pending_lock:
+        if _pending >= WAREHOUSE_MAX_CONCURRENCY + WAREHOUSE_MAX_QUEUE:
+            metrics.WAREHOUSE_QUERY.labels(status="rejected").observe(0)
+            raise WarehouseUnavailable("Too many SQL Warehouse queries in progress", QUEUE_FULL_RETRY_AFTER)
+        _pending += 1
+
+    deadline = time.monotonic() + timeout
+
+    def call():
+        return execute_sql_warehouse_query(query, timeout=deadline - time.monotonic())
+
+    def done(_):
+        global _pending
+        with _pending_lock:
+            _pending -= 1
+
+    future = _executor.submit(call)
+    future.add_done_callback(done)
+    try:
+        # Margine oltre il timeout: lo statement viene annullato dal worker, qui si evita solo di attendere per sempre
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout + MAX_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise WarehouseTimeout("SQL Warehouse query timed out")
+
+
+def shutdown():
+    """Annulla le query in coda e non attende quelle in esecuzione (shutdown dell'app)"""
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,145 @@
+"""
+Manifest in memoria dei file statici del frontend React
+
+All'avvio StaticManifest.load() percorre backend/static una sola volta e per
+ogni file registra stat, Content-Type, ETag (hash del contenuto, uguale su
+tutte le repliche e tra un deploy e l'altro se il file non cambia) e i fratelli
+precompressi .br/.gz generati da build.sh. I file fino a
+STATIC_MEMORY_MAX_BYTES (index.html compreso) restano in memoria.
+
+Per richiesta il costo è una lookup nel dizionario: niente os.path.exists,
+mimetypes o open. Le richieste condizionali (If-None-Match) ricevono 304.
+Cache-Control:
+- file con hash nel nome (main.1a2b3c4d.js, logo.1a2b3c4d.svg): un anno, immutable
+- gli altri (index.html, favicon, /assets): no-cache, rivalidati con l'ETag
+
+Solo i file presenti nel manifest sono serviti (niente path traversal). Dopo un
+nuovo build serve un riavvio dell'app (o load()).
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+import compression
+
+STATIC_MEMORY_MAX_BYTES = int(os.getenv("STATIC_MEMORY_MAX_BYTES", str(256 * 1024)))
+
+# Nome con hash del contenuto generato da react-scripts: nome.<hex>.[chunk.]ext
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.(?:chunk\.)?[A-Za-z0-9]+$")
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Estensioni non sempre note a mimetypes (dipende dal sistema)
+_FALLBACK_TYPES = {".svg": "image/svg+xml", ".png": "image/png", ".jpg": "image/jpeg", ".webp": "image/webp", ".woff2": "font/woff2"}
+_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+logger = logging.getLogger(__name__)
+
+
+class StaticFile:
+    """Variante di un file statico (originale o precompressa)"""
+
+    __slots__ = ("path", "stat", "etag", "content")
+
+    def __init__(self, path: str, etag: str, content: Optional[bytes]):
+        self.path = path
+        self.stat = os.stat(path)
+        self.etag = etag
+        self.content = content
+
+
+class StaticEntry:
+    """File del manifest: tipo, Cache-Control e varianti per Content-Encoding (None = originale)"""
+
+    __slots__ = ("media_type", "cache_control", "variants")
+
+    def __init__(self, media_type: Optional[str], cache_control: str, variants: Dict[Optional[str], StaticFile]):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.variants = variants
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _media_type(name: str) -> Optional[str]:
+    media_type, _ = mimetypes.guess_type(name)
+    return media_type or _FALLBACK_TYPES.get(os.path.splitext(name)[1].lower())
+
+
+def _entry(path: str, name: str) -> StaticEntry:
+    data = _read(path)
+    digest = hashlib.md5(data, usedforsecurity=False).hexdigest()[:20]
+    variants = {None: StaticFile(path, f'"{digest}"', data if len(data) <= STATIC_MEMORY_MAX_BYTES else None)}
+    for coding, suffix in _ENCODINGS:
+        if os.path.isfile(path + suffix):
+            size = os.path.getsize(path + suffix)
+            content = _read(path + suffix) if size <= STATIC_MEMORY_MAX_BYTES else None
+            # ETag distinto per codifica: le cache non devono confondere le varianti
+            variants[coding] = StaticFile(path + suffix, f'"{digest}-{coding}"', content)
+    cache_control = IMMUTABLE_CACHE_CONTROL if HASHED_NAME.search(name) else REVALIDATE_CACHE_CONTROL
+    return StaticEntry(_media_type(name), cache_control, variants)
+
+
+def _not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Confronto debole (RFC 9110): W/"x" equivale a "x"
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class StaticManifest:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.entries: Dict[str, StaticEntry] = {}
+
+    def load(self) -> int:
+        """(Ri)costruisce il manifest; restituisce il numero di file"""
+        entries = {}
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    # I fratelli precompressi sono varianti dell'originale, non file a sé
+                    if name.endswith((".br", ".gz")) and os.path.isfile(path[:-3]):
+                        continue
+                    rel_path = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                    entries[rel_path] = _entry(path, name)
+        self.entries = entries
+        in_memory = sum(1 for e in entries.values() if e.variants[None].content is not None)
+        logger.info("Static manifest: %d files (%d in memory) from %s", len(entries), in_memory, self.directory)
+        return len(entries)
+
+    def get(self, rel_path: str) -> Optional[StaticEntry]:
+        return self.entries.get(rel_path)
+
+    def response(self, entry: StaticEntry, request: Request) -> Response:
+        """Risposta per la variante accettata dal client: 304 se l'ETag coincide, altrimenti il file"""
+        coding = None
+        if len(entry.variants) > 1:
+            accepted = compression.accepted_encodings(request.headers.get("accept-encoding"))
+            coding = next((c for c, _ in _ENCODINGS if c in entry.variants and compression.accepts(accepted, c)), None)
+        variant = entry.variants[coding]
+
+        headers = {"ETag": variant.etag, "Cache-Control": entry.cache_control}
+        if len(entry.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if _not_modified(request.headers.get("if-none-match"), variant.etag):
+            return Response(status_code=304, headers=headers)
+        if coding:
+            headers["Content-Encoding"] = coding
+        if variant.content is not None:
+            return Response(content=variant.content, media_type=entry.media_type, headers=headers)
+        # stat_result dal manifest: FileResponse non rilegge i metadati dal disco
+        return FileResponse(variant.path, media_type=entry.media_type, headers=headers, stat_result=variant.stat)
@@ -0,0 +1,146 @@
+"""
+Logging strutturato per il backend (sostituisce i print sui percorsi caldi)
+
+- livelli standard (LOG_LEVEL, default INFO) e output JSON su stdout
+  (LOG_FORMAT=json, default) o testo leggibile (LOG_FORMAT=text)
+- request id: RequestIdMiddleware legge X-Request-ID (o ne genera uno), lo
+  restituisce nella risposta e lo aggiunge a ogni record della richiesta
+- campionamento degli eventi frequenti: extra={"sample_rate": 0.01} tiene circa
+  un record su cento (il campo sample_rate resta nel record per riscalare i conteggi)
+- QueueHandler non bloccante: il thread che logga accoda il record, la
+  formattazione e la scrittura su stdout avvengono nel thread del QueueListener
+
+Con il livello disabilitato logger.debug("...%s", x) non formatta nulla: usare
+sempre gli argomenti lazy (mai f-string) e isEnabledFor per anteprime costose.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+import orjson
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# Attributi standard di LogRecord: tutto il resto arriva da extra= e finisce nel JSON
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+class _ContextFilter(logging.Filter):
+    """Campionamento e request id, nel thread che logga (la ContextVar è lì)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample_rate", None)
+        if rate is not None and random.random() >= rate:
+            return False
+        record.request_id = _request_id.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Accoda il record senza formattarlo: la coda è in memoria, non serve renderlo serializzabile"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    converter = time.gmtime
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "request_id"):
+            record.request_id = "-"
+        return super().format(record)
+
+
+def setup(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Configura il root logger con QueueHandler + QueueListener su stdout (idempotente)"""
+    global _listener
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    # Svuota la coda all'uscita del processo
+    atexit.register(_listener.stop)
+
+
+class RequestIdMiddleware:
+    """Middleware ASGI: request id da X-Request-ID (o generato), nei log e nella risposta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rid = None
+        for name, value in scope.get("headers", ()):
+            if name == REQUEST_ID_HEADER:
+                # Id del client/proxy accettato solo se breve e stampabile
+                candidate = value.decode("latin-1")
+                if 0 < len(candidate) <= 128 and candidate.isprintable():
+                    rid = candidate
+                break
+        rid = rid or uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + [(REQUEST_ID_HEADER, rid.encode("latin-1"))]}
+            await send(message)
+
+        token = _request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _request_id.reset(token)
@@ -0,0 +1,515 @@
+"""
+Generatore di dati sintetici con volumi da produzione
+
+Crea utenti, tag, gruppi, news e sondaggi di tutti i QuestionType con voti,
+risposte aperte e gradimenti distribuiti in modo realistico:
+- popolarità dei sondaggi e attività degli utenti a legge di potenza (Zipf)
+- preferenze sbilanciate tra le opzioni (Dirichlet per sondaggio)
+- timestamp a raffica: decadimento dalla creazione più picchi casuali
+- visitatori anonimi ricorrenti (stessa sessione e IP su più sondaggi)
+
+Le righe vengono generate con NumPy a blocchi e caricate con COPY FROM STDIN.
+Con lo stesso seed il dataset è identico (a parte gli id e l'istante di
+generazione). I dati sintetici sono riconoscibili (email @synthetic.local,
+titoli "[synthetic]", tag "synthetic-*", news con source_name 'synthetic')
+e vengono eliminati prima di ogni generazione e con `clear`.
+
+Uso:
+    python synthetic_data.py generate --users 20000 --surveys 2000 --votes 5000000 --seed 42
+    python synthetic_data.py clear
+oppure POST /api/surveys/synthetic-data (admin, volumi limitati).
+"""
+import io
+import os
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import models, participants, results
+from partitioning import ensure_all_partitions
+
+SYNTHETIC_DOMAIN = "synthetic.local"
+SYNTHETIC_PREFIX = "[synthetic]"
+SYNTHETIC_TAG_PREFIX = "synthetic-"
+SYNTHETIC_SOURCE = "synthetic"
+
+# Righe per blocco COPY (memoria del generatore limitata anche con milioni di voti)
+COPY_CHUNK_ROWS = int(os.getenv("SYNTHETIC_COPY_CHUNK_ROWS", "500000"))
+
+QUESTION_TYPE_WEIGHTS = {
+    models.QuestionType.SINGLE_CHOICE: 0.35,
+    models.QuestionType.MULTIPLE_CHOICE: 0.20,
+    models.QuestionType.SCALE: 0.12,
+    models.QuestionType.RATING: 0.13,
+    models.QuestionType.OPEN_TEXT: 0.12,
+    models.QuestionType.DATE: 0.08,
+}
+CHOICE_TYPES = (models.QuestionType.SINGLE_CHOICE, models.QuestionType.MULTIPLE_CHOICE)
+
+REGIONS = ["Lombardia", "Lazio", "Campania", "Sicilia", "Veneto", "Emilia-Romagna", "Piemonte", "Puglia", "Toscana", "Calabria"]
+GENDERS = ["Uomo", "Donna", "Preferisco non specificare"]
+NEWS_CATEGORIES = ["politica", "economia", "ambiente", "tecnologia", "sport", "cultura", "salute"]
+WORDS = (
+    "servizio trasporti scuola lavoro città ambiente sanità tasse parco verde traffico sicurezza "
+    "cultura sport giovani anziani costi qualità tempo quartiere comune regione progetto idea "
+    "migliorare ridurre aumentare bene male utile necessario importante problema proposta"
+).split()
+LIKE_COMMENTS = ["Interessante", "Domanda poco chiara", "Ottimo sondaggio", "Servirebbero più opzioni", "Utile"]
+
+
+def _name(table) -> str:
+    """Nome qualificato e quotato per l'SQL diretto ("user" è una parola riservata)"""
+    return postgresql.dialect().identifier_preparer.format_table(table)
+
+
+def _copy(cursor, table: str, frame):
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _zipf_weights(rng, n: int, skew: float):
+    """Pesi a legge di potenza assegnati in ordine casuale"""
+    import numpy as np
+    weights = np.arange(1, n + 1, dtype=float) ** -skew
+    return rng.permutation(weights / weights.sum())
+
+
+def _hex_ids(rng, n: int) -> list:
+    """UUID casuali (riproducibili) nel formato esadecimale accettato da Postgres"""
+    raw = rng.bytes(16 * n)
+    return [raw[i:i + 16].hex() for i in range(0, 16 * n, 16)]
+
+
+def _ips(rng, n: int) -> list:
+    octets = rng.integers(0, 256, size=(n, 3))
+    return [f"10.{a}.{b}.{c}" for a, b, c in octets]
+
+
+def _bursty_seconds(rng, n: int, start: float, end: float):
+    """
+    n istanti (epoch) in [start, end]: 40% con decadimento esponenziale dalla
+    creazione, 60% concentrati in 1-4 picchi (condivisioni, notizie)
+    """
+    import numpy as np
+    window = max(end - start, 60.0)
+    decay = start + rng.exponential(window * 0.1, size=n)
+    centers = start + rng.random(1 + rng.poisson(1.5)) * window
+    spread = max(window * 0.01, 300.0)
+    bursts = rng.choice(centers, size=n) + np.abs(rng.normal(0, spread, size=n))
+    moments = np.where(rng.random(n) < 0.4, decay, bursts)
+    return np.clip(moments, start, end)
+
+
+def _to_timestamps(seconds):
+    import pandas as pd
+    return pd.to_datetime(seconds, unit="s", utc=True)
+
+
+def _split_counts(rng, total: int, weights, mask):
+    """Distribuisce total righe sui sondaggi selezionati da mask in proporzione ai pesi"""
+    import numpy as np
+    counts = np.zeros(len(weights), dtype=np.int64)
+    if total and mask.any():
+        p = np.where(mask, weights, 0.0)
+        counts = rng.multinomial(total, p / p.sum())
+    return counts
+
+
+class _ChunkWriter:
+    """Accumula frame e li carica con COPY ogni COPY_CHUNK_ROWS righe"""
+
+    def __init__(self, cursor, table: str):
+        self.cursor = cursor
+        self.table = table
+        self.frames = []
+        self.pending = 0
+        self.total = 0
+
+    def add(self, frame):
+        self.frames.append(frame)
+        self.pending += len(frame)
+        if self.pending >= COPY_CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        import pandas as pd
+        if self.frames:
+            _copy(self.cursor, self.table, pd.concat(self.frames, ignore_index=True))
+            self.total += self.pending
+        self.frames = []
+        self.pending = 0
+
+
+def clear(db: Session) -> dict:
+    """Elimina i dati sintetici (risposte prima dei sondaggi: DELETE massive invece dei cascade riga per riga)"""
+    users_table = _name(models.User.__table__)
+    synthetic_surveys = (
+        f"SELECT id FROM {_name(models.Survey.__table__)} "
+        f"WHERE user_id IN (SELECT id FROM {users_table} WHERE email LIKE %(email)s)"
+    )
+    params = {
+        "email": f"%@{SYNTHETIC_DOMAIN}",
+        "tag": f"{SYNTHETIC_TAG_PREFIX}%",
+        "group": f"{SYNTHETIC_PREFIX}%",
+        "source": SYNTHETIC_SOURCE,
+    }
+    statements = [
+        ("votes", f"DELETE FROM {_name(models.Vote.__table__)} WHERE survey_id IN ({synthetic_surveys})"),
+        ("open_responses", f"DELETE FROM {_name(models.OpenResponse.__table__)} WHERE survey_id IN ({synthetic_surveys})"),
+        ("likes", f"DELETE FROM {_name(models.SurveyLike.__table__)} WHERE survey_id IN ({synthetic_surveys})"),
+        ("surveys", f"DELETE FROM {_name(models.Survey.__table__)} WHERE id IN ({synthetic_surveys})"),
+        ("tags", f"DELETE FROM {_name(models.Tag.__table__)} WHERE name LIKE %(tag)s"),
+        ("groups", f"DELETE FROM {_name(models.Group.__table__)} WHERE name LIKE %(group)s"),
+        ("news", f"DELETE FROM {_name(models.News.__table__)} WHERE source_name = %(source)s"),
+        ("users", f"DELETE FROM {users_table} WHERE email LIKE %(email)s"),
+    ]
+    deleted = {}
+    cursor = db.connection().connection.cursor()
+    try:
+        for name, statement in statements:
+            cursor.execute(statement, params)
+            deleted[name] = cursor.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+    return deleted
+
+
+def generate(
+    db: Session,
+    users: int = 1000,
+    surveys: int = 200,
+    votes: int = 100000,
+    open_responses: int = 10000,
+    likes: int = 20000,
+    tags: int = 12,
+    groups: int = 10,
+    news: int = 100,
+    days: int = 180,
+    skew: float = 1.1,
+    seed: int = 42,
+    sketches: bool = True
+) -> dict:
+    """Genera e carica il dataset; restituisce i conteggi e la durata"""
+    import numpy as np
+    import pandas as pd
+
+    if users < 1 or surveys < 1:
+        raise ValueError("Servono almeno un utente e un sondaggio")
+
+    started = time.perf_counter()
+    removed = clear(db)
+    rng = np.random.default_rng(seed)
+    now = datetime.now(timezone.utc)
+    now_s = now.timestamp()
+    day = 86400.0
+
+    cursor = db.connection().connection.cursor()
+    try:
+        # Partizioni mancanti di votes/open_responses (no-op senza VOTES_PARTITIONING)
+        ensure_all_partitions(db.connection())
+
+        # --- Utenti: pochi admin e pollster (autori dei sondaggi), il resto votanti ---
+        roles = rng.choice(["user", "pollster", "admin"], size=users, p=[0.95, 0.04, 0.01])
+        roles[0] = "pollster"
+        _copy(cursor, _name(models.User.__table__), pd.DataFrame({
+            "name": [f"Utente Sintetico {i + 1}" for i in range(users)],
+            "email": [f"user{i + 1}-{seed}@{SYNTHETIC_DOMAIN}" for i in range(users)],
+            "user_role": roles,
+            "gender": rng.choice(GENDERS, size=users),
+            "address_region": rng.choice(REGIONS, size=users),
+            "preferred_language": rng.choice(["it", "en"], size=users, p=[0.85, 0.15]),
+            "registration_date": _to_timestamps(now_s - rng.random(users) * 2 * days * day),
+        }))
+        cursor.execute(
+            f"SELECT id FROM {_name(models.User.__table__)} WHERE email LIKE %s ORDER BY id",
+            (f"%@{SYNTHETIC_DOMAIN}",)
+        )
+        user_ids = np.array([row[0] for row in cursor.fetchall()])
+        authors = user_ids[np.isin(roles, ["pollster", "admin"])]
+        user_weights = _zipf_weights(rng, users, skew)
+
+        # --- Tag, gruppi, news ---
+        if tags:
+            _copy(cursor, _name(models.Tag.__table__), pd.DataFrame({
+                "name": [f"{SYNTHETIC_TAG_PREFIX}{i + 1}" for i in range(tags)],
+                "color": [f"#{value:06x}" for value in rng.integers(0, 0xFFFFFF, size=tags)],
+                "user_id": rng.choice(authors, size=tags),
+            }))
+        cursor.execute(f"SELECT id FROM {_name(models.Tag.__table__)} WHERE name LIKE %s ORDER BY id", (f"{SYNTHETIC_TAG_PREFIX}%",))
+        tag_ids = np.array([row[0] for row in cursor.fetchall()])
+
+        if groups:
+            _copy(cursor, _name(models.Group.__table__), pd.DataFrame({
+                "name": [f"{SYNTHETIC_PREFIX} Gruppo {i + 1}" for i in range(groups)],
+                "description": "Gruppo generato per i benchmark",
+                "created_by": rng.choice(authors, size=groups),
+            }))
+            cursor.execute(f"SELECT id FROM {_name(models.Group.__table__)} WHERE name LIKE %s ORDER BY id", (f"{SYNTHETIC_PREFIX}%",))
+            group_ids = np.array([row[0] for row in cursor.fetchall()])
+            # Ogni utente in 0-3 gruppi, i gruppi grandi sono pochi
+            memberships = np.minimum(rng.poisson(1.0, size=users), min(3, groups))
+            group_weights = _zipf_weights(rng, groups, skew)
+            members = [
+                (user_ids[i], group_ids[g])
+                for i in np.flatnonzero(memberships)
+                for g in rng.choice(groups, size=memberships[i], replace=False, p=group_weights)
+            ]
+            if members:
+                _copy(cursor, _name(models.user_groups), pd.DataFrame(members, columns=["user_id", "group_id"]))
+
+        news_ids = np.array([], dtype=int)
+        if news:
+            _copy(cursor, _name(models.News.__table__), pd.DataFrame({
+                "title": [f"{SYNTHETIC_PREFIX} Notizia {i + 1}" for i in range(news)],
+                "description": [" ".join(rng.choice(WORDS, size=20)) for _ in range(news)],
+                "category": rng.choice(NEWS_CATEGORIES, size=news),
+                "language": "it",
+                "source_name": SYNTHETIC_SOURCE,
+                "published_at": _to_timestamps(now_s - rng.random(news) * days * day),
+                "is_breaking": rng.random(news) < 0.05,
+            }))
+            cursor.execute(f"SELECT id FROM {_name(models.News.__table__)} WHERE source_name = %s ORDER BY id", (SYNTHETIC_SOURCE,))
+            news_ids = np.array([row[0] for row in cursor.fetchall()])
+
+        # --- Sondaggi ---
+        type_values = [qt.value for qt in QUESTION_TYPE_WEIGHTS]
+        question_types = rng.choice(type_values, size=surveys, p=list(QUESTION_TYPE_WEIGHTS.values()))
+        created_s = now_s - rng.random(surveys) * days * day
+        closure = rng.choice(["permanent", "scheduled", "manual"], size=surveys, p=[0.6, 0.3, 0.1])
+        expires_s = np.where(closure == "scheduled", created_s + (1 + rng.random(surveys) * 29) * day, np.nan)
+        active = ~((closure == "scheduled") & (expires_s < now_s)) & ~((closure == "manual") & (rng.random(surveys) < 0.3))
+        is_scale = question_types == models.QuestionType.SCALE.value
+        is_numeric = is_scale | (question_types == models.QuestionType.RATING.value)
+        resource_news = pd.array(rng.choice(news_ids, size=surveys) if len(news_ids) else np.zeros(surveys, dtype=int), dtype="Int64")
+        with_news = (rng.random(surveys) < 0.1) & (len(news_ids) > 0)
+        resource_news[~with_news] = pd.NA
+        survey_authors = rng.choice(authors, size=surveys)
+        _copy(cursor, _name(models.Survey.__table__), pd.DataFrame({
+            "title": [f"{SYNTHETIC_PREFIX} Sondaggio {i + 1}" for i in range(surveys)],
+            "description": [" ".join(rng.choice(WORDS, size=12)) for _ in range(surveys)],
+            "question_type": question_types,
+            "min_value": 1,
+            "max_value": np.where(is_scale, 10, 5),
+            "scale_min_label": np.where(is_numeric, "Per niente", None),
+            "scale_max_label": np.where(is_numeric, "Moltissimo", None),
+            "created_at": _to_timestamps(created_s),
+            "closure_type": closure,
+            "expires_at": _to_timestamps(expires_s),
+            "is_active": active,
+            "show_results_on_close": rng.random(surveys) < 0.2,
+            "is_anonymous": rng.random(surveys) < 0.25,
+            "resource_type": np.where(with_news, "news", "none"),
+            "resource_news_id": resource_news,
+            "user_id": survey_authors,
+        }))
+        cursor.execute(
+            f"SELECT id, is_anonymous FROM {_name(models.Survey.__table__)} WHERE title LIKE %s ORDER BY id",
+            (f"{SYNTHETIC_PREFIX}%",)
+        )
+        survey_rows_db = cursor.fetchall()
+        survey_ids = np.array([row[0] for row in survey_rows_db])
+        anonymous = np.array([row[1] for row in survey_rows_db])
+
+        # Opzioni (2-8 per le domande a scelta) e tag (0-3 per sondaggio)
+        is_choice = np.isin(question_types, [qt.value for qt in CHOICE_TYPES])
+        option_counts = np.where(is_choice, rng.integers(2, 9, size=surveys), 0)
+        option_survey = np.repeat(np.arange(surveys), option_counts)
+        option_order = np.concatenate([np.arange(n) for n in option_counts]) if option_counts.sum() else np.array([], dtype=int)
+        if len(option_survey):
+            _copy(cursor, _name(models.SurveyOption.__table__), pd.DataFrame({
+                "survey_id": survey_ids[option_survey],
+                "option_text": [f"Opzione {k + 1}" for k in option_order],
+                "option_order": option_order,
+                "user_id": survey_authors[option_survey],
+            }))
+        cursor.execute(
+            f"SELECT survey_id, id FROM {_name(models.SurveyOption.__table__)} "
+            f"WHERE survey_id = ANY(%s) ORDER BY survey_id, option_order, id",
+            (survey_ids.tolist(),)
+        )
+        options_by_survey = {}
+        for survey_id, option_id in cursor.fetchall():
+            options_by_survey.setdefault(survey_id, []).append(option_id)
+
+        if len(tag_ids):
+            tag_counts = np.minimum(rng.integers(0, 4, size=surveys), len(tag_ids))
+            survey_tag_rows = [
+                (survey_ids[i], tag, survey_authors[i])
+                for i in np.flatnonzero(tag_counts)
+                for tag in rng.choice(tag_ids, size=tag_counts[i], replace=False)
+            ]
+            if survey_tag_rows:
+                _copy(cursor, _name(models.survey_tags), pd.DataFrame(survey_tag_rows, columns=["survey_id", "tag_id", "user_id"]))
+
+        # --- Votanti: utenti registrati (Zipf) e visitatori anonimi ricorrenti ---
+        visitors = max(users * 10, 1000)
+        visitor_sessions = np.array(_hex_ids(rng, visitors))
+        visitor_ips = np.array(_ips(rng, visitors))
+        visitor_weights = _zipf_weights(rng, visitors, skew)
+
+        def voters(n: int, is_anonymous: bool):
+            """(sessione, ip, user_id) di n schede; i non anonimi hanno user_id nel 70% dei casi"""
+            visitor = rng.choice(visitors, size=n, p=visitor_weights)
+            user = pd.array(rng.choice(user_ids, size=n, p=user_weights), dtype="Int64")
+            if is_anonymous:
+                user[:] = pd.NA
+            else:
+                user[rng.random(n) >= 0.7] = pd.NA
+            return visitor_sessions[visitor], visitor_ips[visitor], user
+
+        def window(i: int):
+            end = now_s if active[i] or np.isnan(expires_s[i]) else min(expires_s[i], now_s)
+            return created_s[i], max(end, created_s[i] + 60)
+
+        popularity = _zipf_weights(rng, surveys, skew)
+        is_open = question_types == models.QuestionType.OPEN_TEXT.value
+        vote_counts = _split_counts(rng, votes, popularity, ~is_open)
+        response_counts = _split_counts(rng, open_responses, popularity, is_open)
+        like_counts = _split_counts(rng, likes, popularity, np.ones(surveys, dtype=bool))
+
+        vote_writer = _ChunkWriter(cursor, _name(models.Vote.__table__))
+        response_writer = _ChunkWriter(cursor, _name(models.OpenResponse.__table__))
+        like_writer = _ChunkWriter(cursor, _name(models.SurveyLike.__table__))
+
+        for i in range(surveys):
+            start, end = window(i)
+            n = int(vote_counts[i])
+            if n:
+                sessions, ips, voter_users = voters(n, anonymous[i])
+                frame = pd.DataFrame({
+                    "survey_id": survey_ids[i],
+                    "option_id": pd.array([None] * n, dtype="Int64"),
+                    "voter_ip": ips,
+                    "voter_session": sessions,
+                    "numeric_value": np.nan,
+                    "date_value": pd.NaT,
+                    "voted_at": _to_timestamps(_bursty_seconds(rng, n, start, end)),
+                    "user_id": voter_users,
+                })
+                if is_choice[i]:
+                    option_ids = np.array(options_by_survey[survey_ids[i]])
+                    preference = rng.dirichlet(np.ones(len(option_ids)))
+                    frame["option_id"] = rng.choice(option_ids, size=n, p=preference)
+                elif is_numeric[i]:
+                    high = 10 if is_scale[i] else 5
+                    center = rng.uniform(1, high)
+                    frame["numeric_value"] = np.clip(np.rint(rng.normal(center, high / 5, size=n)), 1, high)
+                else:
+                    frame["date_value"] = _to_timestamps(now_s - rng.random(n) * 30 * 365 * day)
+                vote_writer.add(frame)
+
+            n = int(response_counts[i])
+            if n:
+                sessions, ips, voter_users = voters(n, anonymous[i])
+                lengths = rng.integers(3, 13, size=n)
+                words = rng.choice(WORDS, size=int(lengths.sum()))
+                bounds = np.concatenate([[0], np.cumsum(lengths)])
+                response_writer.add(pd.DataFrame({
+                    "survey_id": survey_ids[i],
+                    "voter_ip": ips,
+                    "voter_session": sessions,
+                    "response_text": [" ".join(words[a:b]) for a, b in zip(bounds[:-1], bounds[1:])],
+                    "responded_at": _to_timestamps(_bursty_seconds(rng, n, start, end)),
+                    "user_id": voter_users,
+                }))
+
+            n = int(like_counts[i])
+            if n:
+                sessions, ips, voter_users = voters(n, anonymous[i])
+                with_comment = rng.random(n) < 0.1
+                like_writer.add(pd.DataFrame({
+                    "survey_id": survey_ids[i],
+                    "user_ip": ips,
+                    "user_session": sessions,
+                    "rating": rng.choice([1, 2, 3, 4, 5], size=n, p=[0.05, 0.1, 0.2, 0.35, 0.3]),
+                    "comment": np.where(with_comment, rng.choice(LIKE_COMMENTS, size=n), None),
+                    "created_at": _to_timestamps(_bursty_seconds(rng, n, start, end)),
+                    "user_id": voter_users,
+                }))
+
+        for writer in (vote_writer, response_writer, like_writer):
+            writer.flush()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    # Statistiche del planner, sketch dei partecipanti e snapshot dei sondaggi chiusi
+    for model in (models.User, models.Survey, models.SurveyOption, models.Vote, models.OpenResponse, models.SurveyLike):
+        db.execute(text(f"ANALYZE {_name(model.__table__)}"))
+    db.commit()
+    if sketches:
+        for survey in db.query(models.Survey).filter(models.Survey.id.in_(survey_ids.tolist())).all():
+            participants.rebuild_sketches(survey, db)
+        db.commit()
+    snapshots = results.backfill_snapshots(db)
+
+    return {
+        "seed": seed,
+        "removed": removed,
+        "users": users,
+        "tags": len(tag_ids),
+        "groups": groups,
+        "news": len(news_ids),
+        "surveys": surveys,
+        "options": int(option_counts.sum()),
+        "votes": vote_writer.total,
+        "open_responses": response_writer.total,
+        "likes": like_writer.total,
+        "snapshots": snapshots,
+        "seconds": round(time.perf_counter() - started, 1),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Dati sintetici per benchmark e test dei piani di esecuzione")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate_parser = subparsers.add_parser("generate", help="Elimina i dati sintetici precedenti e ne genera di nuovi")
+    generate_parser.add_argument("--users", type=int, default=1000)
+    generate_parser.add_argument("--surveys", type=int, default=200)
+    generate_parser.add_argument("--votes", type=int, default=100000)
+    generate_parser.add_argument("--open-responses", type=int, default=10000)
+    generate_parser.add_argument("--likes", type=int, default=20000)
+    generate_parser.add_argument("--tags", type=int, default=12)
+    generate_parser.add_argument("--groups", type=int, default=10)
+    generate_parser.add_argument("--news", type=int, default=100)
+    generate_parser.add_argument("--days", type=int, default=180, help="Finestra temporale dei sondaggi")
+    generate_parser.add_argument("--skew", type=float, default=1.1, help="Esponente Zipf di popolarità e attività")
+    generate_parser.add_argument("--seed", type=int, default=42)
+    generate_parser.add_argument("--no-sketches", action="store_true", help="Non ricostruire gli sketch HLL dei partecipanti")
+    subparsers.add_parser("clear", help="Elimina i dati sintetici")
+    args = parser.parse_args()
+
+    if os.getenv("DEPLOY_MODE", "local").lower() == "databricks":
+        from lakebase_connector import SessionLocal
+    else:
+        from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        if args.command == "clear":
+            print(f"✅ Dati sintetici eliminati: {json.dumps(clear(db))}")
+        else:
+            summary = generate(
+                db, users=args.users, surveys=args.surveys, votes=args.votes,
+                open_responses=args.open_responses, likes=args.likes, tags=args.tags,
+                groups=args.groups, news=args.news, days=args.days, skew=args.skew,
+                seed=args.seed, sketches=not args.no_sketches
+            )
+            print(f"✅ Dati sintetici generati: {json.dumps(summary)}")
+    finally:
+        db.close()
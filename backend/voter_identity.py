@@ -0,0 +1,62 @@
+"""
+Identità del votante anonimo (IP + session cookie)
+
+Le colonne voter_ip / user_ip sono di tipo INET e voter_session / user_session
+di tipo UUID: i valori vanno normalizzati prima di essere scritti o usati nei
+filtri, altrimenti Postgres rifiuta il cast.
+"""
+import hashlib
+import ipaddress
+import uuid
+from typing import Optional
+
+from sqlalchemy import false, or_
+from fastapi import Request
+
+
+def normalize_ip(value: Optional[str]) -> Optional[str]:
+    """Indirizzo IPv4/IPv6 in forma canonica, None se non valido (es. 'testclient')"""
+    if not value:
+        return None
+    try:
+        return str(ipaddress.ip_address(value.strip()))
+    except ValueError:
+        return None
+
+
+def normalize_session(value: Optional[str]) -> Optional[str]:
+    """
+    Session ID come UUID canonico.
+    I valori legacy non-UUID vengono mappati in modo deterministico con md5,
+    come fa la migration 002 sui dati esistenti (md5(value)::uuid).
+    """
+    if not value:
+        return None
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return str(uuid.UUID(hashlib.md5(value.encode("utf-8")).hexdigest()))
+
+
+def get_client_ip(request: Request) -> Optional[str]:
+    """IP del client normalizzato per le colonne INET"""
+    return normalize_ip(request.client.host if request.client else None)
+
+
+def get_or_create_session(request: Request) -> str:
+    """Ottieni o crea una session ID per il votante"""
+    return normalize_session(request.cookies.get("session_id")) or str(uuid.uuid4())
+
+
+def same_voter(ip_column, session_column, client_ip: Optional[str], session_id: Optional[str]):
+    """
+    Condizione "stesso votante" su IP o sessione.
+    I valori mancanti vengono ignorati: `col == None` diventerebbe IS NULL
+    e farebbe combaciare tutte le righe senza IP.
+    """
+    conditions = []
+    if client_ip:
+        conditions.append(ip_column == client_ip)
+    if session_id:
+        conditions.append(session_column == session_id)
+    return or_(*conditions) if conditions else false()
@@ -0,0 +1,302 @@
+"""
+Load test end-to-end per il backend Web Democracy
+
+Simula N utenti concorrenti con un mix realistico di traffico:
+- list     GET  /surveys                  (home page)
+- detail   GET  /surveys/{id}             (pagina del sondaggio)
+- results  GET  /surveys/{id}/results     (polling dei risultati in tempo reale)
+- vote     POST /surveys/{id}/vote
+- like     POST /surveys/{id}/like
+
+Ogni utente ha un proprio cookie session_id. Prima del test vengono creati
+alcuni sondaggi di prova ("[loadtest] ...", voti multipli ammessi, così tutti i
+voti dallo stesso IP vengono accettati) e al termine vengono eliminati.
+
+Riporta per endpoint richieste, errori, throughput e latenze p50/p95/p99 e
+scrive un file JSON (con il commit git) confrontabile tra esecuzioni con
+--compare. Esce con codice 1 se il tasso di errore supera --max-error-rate.
+
+Uso (Postgres di docker-compose, dipendenze in benchmarks/requirements.txt):
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/loadtest.py --module main_local --concurrency 50 --duration 60 --output run.json
+    python benchmarks/loadtest.py --base-url http://localhost:8000 --mix list=10,results=60,vote=30
+    python benchmarks/loadtest.py --module main_local --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+DEFAULT_MIX = "list=20,detail=20,results=35,vote=15,like=10"
+ENDPOINTS = ("list", "detail", "results", "vote", "like")
+FIXTURE_PREFIX = "[loadtest]"
+# Endpoint senza database usato per attendere l'avvio del server
+READY_PATHS = {"app": "/api/health", "main_local": "/"}
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Endpoint sconosciuto nel mix: {name} (ammessi: {', '.join(ENDPOINTS)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(module: str, workers: int) -> tuple:
+    """Avvia uvicorn sul modulo indicato e attende che risponda"""
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env={**os.environ, "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING")},
+        stdout=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with code {proc.returncode}")
+        try:
+            if httpx.get(f"{base_url}{READY_PATHS[module]}", timeout=0.5).status_code == 200:
+                return proc, base_url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.kill()
+    raise TimeoutError(f"{module} not ready after 60s")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+async def create_fixtures(client: httpx.AsyncClient, count: int) -> list:
+    """Sondaggi di prova: [(survey_id, [option_id, ...])]"""
+    fixtures = []
+    for i in range(count):
+        response = await client.post("/surveys", json={
+            "title": f"{FIXTURE_PREFIX} Sondaggio {i + 1}",
+            "description": "Creato dal load test, viene eliminato al termine",
+            "question_type": "multiple_choice" if i % 2 else "single_choice",
+            "allow_multiple_responses": True,
+            "options": [f"Opzione {n + 1}" for n in range(4)],
+        })
+        response.raise_for_status()
+        survey = response.json()
+        fixtures.append((survey["id"], [option["id"] for option in survey["options"]]))
+    return fixtures
+
+
+async def delete_fixtures(client: httpx.AsyncClient, fixtures: list):
+    for survey_id, _ in fixtures:
+        await client.delete(f"/api/surveys/{survey_id}")
+
+
+def build_request(kind: str, rng: random.Random, fixtures: list) -> tuple:
+    """(method, url, json) per il tipo di richiesta"""
+    survey_id, option_ids = rng.choice(fixtures)
+    if kind == "list":
+        return "GET", "/surveys", None
+    if kind == "detail":
+        return "GET", f"/surveys/{survey_id}", None
+    if kind == "results":
+        return "GET", f"/surveys/{survey_id}/results", None
+    if kind == "vote":
+        return "POST", f"/surveys/{survey_id}/vote", {"option_ids": [rng.choice(option_ids)]}
+    return "POST", f"/surveys/{survey_id}/like", {"rating": rng.randint(1, 5)}
+
+
+async def virtual_user(index: int, client: httpx.AsyncClient, args, weights: dict, fixtures: list,
+                       started: float, samples: list):
+    rng = random.Random(args.seed * 100003 + index)
+    headers = {"Cookie": f"session_id={uuid.UUID(int=rng.getrandbits(128))}"}
+    kinds, kind_weights = list(weights), list(weights.values())
+    warmup_end = started + args.warmup
+    end = warmup_end + args.duration
+    while time.perf_counter() < end:
+        kind = rng.choices(kinds, kind_weights)[0]
+        method, url, body = build_request(kind, rng, fixtures)
+        t0 = time.perf_counter()
+        try:
+            response = await client.request(method, url, json=body, headers=headers)
+            await response.aread()
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        t1 = time.perf_counter()
+        if t0 >= warmup_end:
+            samples.append((kind, t1 - t0, status))
+        if args.think_ms:
+            await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+
+
+def _percentiles(latencies: list) -> dict:
+    if len(latencies) == 1:
+        value = latencies[0] * 1000
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {"p50_ms": cuts[49] * 1000, "p95_ms": cuts[94] * 1000, "p99_ms": cuts[98] * 1000}
+
+
+def summarize(samples: list, duration: float) -> dict:
+    groups = {}
+    for kind, latency, status in samples:
+        groups.setdefault(kind, []).append((latency, status))
+    groups["all"] = [(latency, status) for _, latency, status in samples]
+
+    summary = {}
+    for kind, rows in groups.items():
+        if not rows:
+            continue
+        latencies = sorted(latency for latency, _ in rows)
+        errors = sum(1 for _, status in rows if not isinstance(status, int) or status >= 400)
+        summary[kind] = {
+            "requests": len(rows),
+            "errors": errors,
+            "error_rate": round(errors / len(rows), 4),
+            "throughput_rps": round(len(rows) / duration, 1),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+            **{key: round(value, 2) for key, value in _percentiles(latencies).items()},
+            "max_ms": round(latencies[-1] * 1000, 2),
+        }
+    return summary
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(summary: dict, baseline: dict = None):
+    header = f"{'endpoint':<10}{'req':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+    if baseline:
+        header += f"{'Δp95':>9}{'Δrps':>9}"
+    print(header)
+    for kind in [*ENDPOINTS, "all"]:
+        row = summary.get(kind)
+        if not row:
+            continue
+        line = (f"{kind:<10}{row['requests']:>8}{row['errors']:>6}{row['throughput_rps']:>9.1f}"
+                f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}")
+        base = (baseline or {}).get(kind)
+        if base:
+            line += f"{_delta(row['p95_ms'], base['p95_ms']):>9}{_delta(row['throughput_rps'], base['throughput_rps']):>9}"
+        print(line)
+
+
+def _delta(value: float, base: float) -> str:
+    return f"{(value - base) / base * 100:+.0f}%" if base else "n/a"
+
+
+async def run(args) -> dict:
+    weights = parse_mix(args.mix)
+    proc = None
+    base_url = args.base_url
+    if not base_url:
+        proc, base_url = start_server(args.module, args.workers)
+    headers = {"x-forwarded-email": args.email} if args.email else {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout, headers=headers) as client:
+            fixtures = await create_fixtures(client, args.surveys)
+            samples = []
+            started = time.perf_counter()
+            try:
+                await asyncio.gather(*(
+                    virtual_user(i, client, args, weights, fixtures, started, samples)
+                    for i in range(args.concurrency)
+                ))
+            finally:
+                if not args.keep_fixtures:
+                    await delete_fixtures(client, fixtures)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "target": args.base_url or f"{args.module} (uvicorn, {args.workers} worker)",
+            "concurrency": args.concurrency,
+            "duration_seconds": args.duration,
+            "warmup_seconds": args.warmup,
+            "think_ms": args.think_ms,
+            "mix": weights,
+            "surveys": args.surveys,
+            "seed": args.seed,
+            "python": platform.python_version(),
+        },
+        "endpoints": summarize(samples, args.duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Web Democracy load test")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--base-url", help="Server già avviato (es. http://localhost:8000)")
+    target.add_argument("--module", default="main_local", choices=["main_local", "app"], help="Modulo da avviare con uvicorn")
+    parser.add_argument("--workers", type=int, default=1, help="Worker uvicorn (solo con --module)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Utenti virtuali concorrenti")
+    parser.add_argument("--duration", type=float, default=30, help="Durata della misura in secondi")
+    parser.add_argument("--warmup", type=float, default=5, help="Secondi iniziali esclusi dalle statistiche")
+    parser.add_argument("--think-ms", type=float, default=0, help="Pausa media tra due richieste dello stesso utente (esponenziale)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Pesi del traffico (default {DEFAULT_MIX})")
+    parser.add_argument("--surveys", type=int, default=5, help="Sondaggi di prova da creare")
+    parser.add_argument("--email", help="Header x-forwarded-email (app.py); l'utente deve poter creare sondaggi")
+    parser.add_argument("--timeout", type=float, default=30, help="Timeout per richiesta in secondi")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep-fixtures", action="store_true", help="Non eliminare i sondaggi di prova")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="Tasso di errore oltre il quale il run fallisce")
+    parser.add_argument("--output", help="File JSON in cui salvare i risultati")
+    parser.add_argument("--compare", help="File JSON di un run precedente da confrontare")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    baseline = json.loads(Path(args.compare).read_text())["endpoints"] if args.compare else None
+    print_table(report["endpoints"], baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+    overall = report["endpoints"].get("all")
+    if not overall:
+        print("❌ Nessuna richiesta completata", file=sys.stderr)
+        sys.exit(1)
+    if overall["error_rate"] > args.max_error_rate:
+        print(f"❌ Error rate {overall['error_rate']:.2%} (max {args.max_error_rate:.2%})", file=sys.stderr)
+        sys.exit(1)
+    print(f"✅ {overall['requests']} requests, {overall['throughput_rps']} req/s, p95 {overall['p95_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Micro-benchmark dei punti caldi in puro Python (nessun database)
+
+Isola il costo di serializzazione e aggregazione che nei load test resta
+nascosto dietro la latenza del database:
+- schemas.Survey da ORM a dict (pydantic) e serialization.survey_dict, su un
+  sondaggio con molte opzioni e tag
+- costruzione di SurveyResultsResponse con molte risposte aperte
+- results.like_stats (media e distribuzione dei gradimenti)
+- participants.timeline_points (assemblaggio dei bucket della timeline)
+- serialization.h3_hexagons (righe H3 -> GeoJSON)
+
+Le fixture sono oggetti ORM in memoria generati con un seed fisso. Ogni
+benchmark viene ripetuto --rounds volte (ciascuna di almeno ~0.2 s) e si
+confronta con la baseline salvata: oltre --tolerance (default 20%) è una
+regressione ed esce con codice 1.
+Il confronto usa il tempo relativo a un ciclo di calibrazione in puro Python
+misurato nello stesso processo subito prima di ogni ripetizione: una macchina
+o un momento più lenti spostano calibrazione e benchmark insieme. La
+normalizzazione non annulla le differenze tra versioni di Python o di
+pydantic: in quel caso (avviso "Ambiente diverso") la baseline va rigenerata
+con --save sull'host su cui si confronta.
+
+Uso:
+    python benchmarks/microbench.py                   # confronta con benchmarks/baselines/microbench.json
+    python benchmarks/microbench.py --save            # aggiorna la baseline
+    python benchmarks/microbench.py -k like --rounds 10
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baselines" / "microbench.json"
+
+os.environ.setdefault("DEPLOY_MODE", "local")
+sys.path.insert(0, str(BACKEND_DIR))
+
+import pydantic  # noqa: E402
+
+import models, schemas, results, participants, serialization  # noqa: E401,E402
+
+SEED = 42
+EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+# Dimensioni delle fixture
+SURVEY_OPTIONS = 200
+SURVEY_TAGS = 20
+OPEN_RESPONSES = 5000
+LIKE_RATINGS = 100_000
+TIMELINE_BUCKETS = 24 * 30
+H3_HEXAGONS = 20_000
+
+
+# ===== FIXTURE =====
+
+def _text(rng: random.Random, words: int) -> str:
+    vocabulary = ["sondaggio", "voto", "città", "trasporti", "scuola", "parco", "bilancio", "energia", "sanità", "cultura"]
+    return " ".join(rng.choice(vocabulary) for _ in range(words))
+
+
+def survey_fixture(rng: random.Random) -> models.Survey:
+    """Sondaggio ORM transitorio (non legato a una sessione) con opzioni, tag e creatore"""
+    creator = models.User(id=1, name="Mario Rossi", email="mario.rossi@example.com")
+    survey = models.Survey(
+        id=1, title="Priorità del bilancio partecipativo", description=_text(rng, 60),
+        question_type=models.QuestionType.MULTIPLE_CHOICE.value, min_value=1, max_value=5,
+        closure_type=models.ClosureType.PERMANENT.value, is_active=True, show_results_on_close=False,
+        allow_multiple_responses=False, allow_custom_options=True, require_comment=False,
+        rating_icon="star", is_anonymous=False, resource_type="none",
+        user_id=creator.id, created_at=EPOCH
+    )
+    survey.creator = creator
+    survey.options = [
+        models.SurveyOption(
+            id=i + 1, survey_id=survey.id, option_text=_text(rng, 6), option_order=i,
+            created_at=EPOCH + timedelta(minutes=i), user_id=creator.id
+        )
+        for i in range(SURVEY_OPTIONS)
+    ]
+    survey.tags = [
+        models.Tag(id=i + 1, name=f"tag-{i}", color="#6366f1", is_active=True, created_at=EPOCH, user_id=None)
+        for i in range(SURVEY_TAGS)
+    ]
+    return survey
+
+
+def open_response_fixture(rng: random.Random) -> list:
+    return [
+        models.OpenResponse(
+            id=i + 1, survey_id=1, option_id=None, response_text=_text(rng, rng.randint(5, 80)),
+            voter_ip=f"10.0.{i % 256}.{rng.randint(1, 254)}", voter_session=None,
+            responded_at=EPOCH + timedelta(seconds=rng.randint(0, 86400 * 30)), user_id=rng.randint(1, 1000)
+        )
+        for i in range(OPEN_RESPONSES)
+    ]
+
+
+def timeline_fixture(rng: random.Random):
+    """(start, current, counts) come da timeline_counts con granularità oraria"""
+    counts = []
+    cumulative = 0
+    for hour in range(TIMELINE_BUCKETS):
+        period = rng.randint(0, 50)
+        cumulative += period
+        counts.append((EPOCH + timedelta(hours=hour), period, cumulative))
+    return EPOCH, EPOCH + timedelta(hours=TIMELINE_BUCKETS + 3), counts
+
+
+def h3_fixture(rng: random.Random):
+    """Colonne hex_boundary (GeoJSON come stringa, come da h3_boundaryasgeojson) e count"""
+    boundaries = []
+    for _ in range(H3_HEXAGONS):
+        lng, lat = rng.uniform(-10, 30), rng.uniform(35, 60)
+        ring = [[round(lng + 0.05 * dx, 6), round(lat + 0.05 * dy, 6)] for dx, dy in ((0, 1), (1, 0.5), (1, -0.5), (0, -1), (-1, -0.5), (-1, 0.5), (0, 1))]
+        boundaries.append(json.dumps({"type": "Polygon", "coordinates": [ring]}))
+    return boundaries, [rng.randint(1, 10_000) for _ in range(H3_HEXAGONS)]
+
+
+# ===== BENCHMARK =====
+
+def build_benchmarks() -> dict:
+    """{nome: callable senza argomenti} sulle fixture generate con SEED"""
+    rng = random.Random(SEED)
+    survey = survey_fixture(rng)
+    responses = open_response_fixture(rng)
+    ratings = [rng.choice((1, 2, 3, 3, 4, 4, 4, 5, 5, 5)) for _ in range(LIKE_RATINGS)]
+    start, current, counts = timeline_fixture(rng)
+    boundaries, hex_counts = h3_fixture(rng)
+
+    def results_response():
+        open_responses = [schemas.OpenResponse.model_validate(r) for r in responses]
+        return schemas.SurveyResultsResponse(
+            survey_id=1, survey_title="Proposte per il quartiere", question_type=models.QuestionType.OPEN_TEXT,
+            total_votes=len(open_responses), total_responses=len(open_responses),
+            open_responses=open_responses, like_stats=results.like_stats(ratings[:500])
+        )
+
+    return {
+        "survey_pydantic_dump": lambda: schemas.Survey.model_validate(survey).model_dump(),
+        "survey_dict": lambda: serialization.survey_dict(survey),
+        "results_response_open_text": results_response,
+        "like_stats": lambda: results.like_stats(ratings),
+        "timeline_points": lambda: participants.timeline_points(start, current, counts),
+        "h3_hexagons": lambda: serialization.h3_hexagons(boundaries, hex_counts),
+    }
+
+
+def calibration_workload():
+    """Carico fisso (dict, generatori, sort) simile ai benchmark, indipendente dal codice dell'app"""
+    data = {i: (i * 7919) % 1000 for i in range(2000)}
+    return sum(v for k, v in data.items() if k % 3) + len(sorted(data.values(), reverse=True))
+
+
+def measure(func, rounds: int, calibration: timeit.Timer, calibration_loops: int) -> dict:
+    """
+    Secondi per chiamata su rounds ripetizioni (loop calibrati con autorange).
+    Ogni ripetizione è preceduta dalla calibrazione: "relative" è la mediana dei
+    rapporti benchmark / calibrazione, coppia per coppia
+    """
+    timer = timeit.Timer(func)
+    loops, _ = timer.autorange()
+    loops = max(1, loops)
+    per_call = []
+    ratios = []
+    for _ in range(rounds):
+        reference = calibration.timeit(calibration_loops) / calibration_loops
+        per_call.append(timer.timeit(loops) / loops)
+        ratios.append(per_call[-1] / reference)
+    return {
+        "loops": loops,
+        "rounds": rounds,
+        "min_us": round(min(per_call) * 1e6, 2),
+        "median_us": round(statistics.median(per_call) * 1e6, 2),
+        "stdev_us": round(statistics.stdev(per_call) * 1e6, 2) if rounds > 1 else 0.0,
+        "relative": round(statistics.median(ratios), 4),
+    }
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "pydantic": pydantic.VERSION,
+        "machine": platform.machine(),
+        "platform": platform.platform(terse=True),
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Nomi dei benchmark con tempo relativo alla calibrazione oltre baseline * (1 + tolerance)"""
+    regressions = []
+    print(f"\n{'benchmark':<30} {'baseline µs':>12} {'attuale µs':>12} {'delta':>8}")
+    for name, result in current.items():
+        base = baseline.get(name)
+        if base is None or "relative" not in base:
+            print(f"{name:<30} {'-':>12} {result['min_us']:>12.1f} {'nuovo':>8}")
+            continue
+        delta = result["relative"] / base["relative"] - 1
+        flag = "  ❌" if delta > tolerance else ""
+        print(f"{name:<30} {base['min_us']:>12.1f} {result['min_us']:>12.1f} {delta:>+7.1%}{flag}")
+        if delta > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Web Democracy micro-benchmark (senza database)")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("-k", dest="filter", help="Esegue solo i benchmark il cui nome contiene questa stringa")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="File JSON della baseline")
+    parser.add_argument("--save", action="store_true", help="Salva i risultati come nuova baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Peggioramento massimo del tempo minimo (0.2 = 20%%)")
+    parser.add_argument("--output", help="File JSON in cui salvare i risultati")
+    args = parser.parse_args()
+
+    benchmarks = build_benchmarks()
+    if args.filter:
+        benchmarks = {name: func for name, func in benchmarks.items() if args.filter in name}
+
+    calibration = timeit.Timer(calibration_workload)
+    calibration_loops, _ = calibration.autorange()
+    current = {}
+    for name, func in benchmarks.items():
+        current[name] = measure(func, args.rounds, calibration, calibration_loops)
+        r = current[name]
+        print(f"⏱️  {name:<30} mediana {r['median_us']:>10.1f} µs  min {r['min_us']:>10.1f} µs  ±{r['stdev_us']:.1f} ({r['loops']} loop x {r['rounds']})  x{r['relative']:.2f} calibrazione")
+
+    report = {"environment": environment(), "results": current}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+    baseline_path = Path(args.baseline)
+    if args.save:
+        # Aggiorna solo i benchmark eseguiti (con -k gli altri restano invariati)
+        saved = json.loads(baseline_path.read_text()) if baseline_path.exists() else {"results": {}}
+        saved["environment"] = report["environment"]
+        saved["results"].update(current)
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(saved, indent=2) + "\n")
+        print(f"\n💾 Baseline salvata in {baseline_path}")
+        return
+
+    if not baseline_path.exists():
+        print(f"\nNessuna baseline in {baseline_path}: eseguire con --save per crearla")
+        return
+
+    baseline = json.loads(baseline_path.read_text())
+    if baseline.get("environment") != report["environment"]:
+        print(f"\n⚠️  Ambiente diverso dalla baseline: {baseline.get('environment')} -> {report['environment']}")
+    regressions = compare(current, baseline.get("results", {}), args.tolerance)
+    if regressions:
+        print(f"\n❌ Regressioni oltre il {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    print("\n✅ Nessuna regressione")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Startup benchmark for Web Democracy backend
+
+Misura:
+- il tempo di import del modulo applicativo (python -X importtime) e i moduli più costosi
+- che i moduli pesanti (pandas, shapely, databricks.sdk, ...) NON vengano caricati all'import
+- il tempo dall'avvio di uvicorn alla prima risposta 200 su /api/health
+
+Esce con codice 1 se uno dei budget viene superato, così può girare in CI.
+
+Uso:
+    python benchmarks/startup_benchmark.py                      # app.py (Databricks)
+    python benchmarks/startup_benchmark.py --module main_local  # locale/ibrida
+    python benchmarks/startup_benchmark.py --output startup.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+# Moduli che devono essere caricati solo al primo utilizzo
+HEAVY_MODULES = ["pandas", "numpy", "shapely", "h3", "databricks.sdk", "databricks.sql"]
+
+DEPLOY_MODES = {"app": "databricks", "main_local": "local"}
+
+
+def _env(module: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("DEPLOY_MODE", DEPLOY_MODES.get(module, "local"))
+    return env
+
+
+def measure_import(module: str) -> dict:
+    """Import del modulo in un processo pulito con -X importtime"""
+    probe = (
+        "import sys, json, time\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - t\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print('__RESULT__' + json.dumps({'elapsed': elapsed, 'heavy': heavy}))\n"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe],
+        cwd=BACKEND_DIR, env=_env(module), capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Import of {module} failed:\n{proc.stderr[-2000:]}")
+
+    result_line = next(l for l in proc.stdout.splitlines() if l.startswith("__RESULT__"))
+    result = json.loads(result_line[len("__RESULT__"):])
+
+    # Righe "import time: self | cumulative | name"
+    # I figli vengono stampati prima del padre: il sottoalbero del modulo è il blocco
+    # di righe indentate che precede la sua riga di primo livello
+    subtree = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == module:
+                break
+            subtree = []
+            continue
+        if depth == 1:
+            subtree.append({
+                "module": name.strip(),
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000
+            })
+    subtree.sort(key=lambda m: m["cumulative_ms"], reverse=True)
+
+    return {
+        "import_seconds": result["elapsed"],
+        "heavy_modules_loaded": result["heavy"],
+        "slowest_direct_imports": subtree[:10],
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_ready(module: str, timeout: float) -> float:
+    """Tempo dall'avvio di uvicorn alla prima risposta 200 su /api/health"""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/api/health"
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=_env(module), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {proc.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=0.5) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"/api/health not ready after {timeout}s")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Web Democracy startup benchmark")
+    parser.add_argument("--module", default="app", choices=sorted(DEPLOY_MODES), help="Modulo FastAPI da misurare")
+    parser.add_argument("--import-budget", type=float, default=1.0, help="Budget per l'import in secondi")
+    parser.add_argument("--ready-budget", type=float, default=1.5, help="Budget per la prima risposta di /api/health in secondi (include avvio interprete e uvicorn)")
+    parser.add_argument("--runs", type=int, default=3, help="Numero di ripetizioni (si usa la mediana)")
+    parser.add_argument("--skip-ready", action="store_true", help="Misura solo l'import")
+    parser.add_argument("--output", help="File JSON in cui salvare i risultati")
+    args = parser.parse_args()
+
+    imports = [measure_import(args.module) for _ in range(args.runs)]
+    import_times = sorted(r["import_seconds"] for r in imports)
+    report = {
+        "module": args.module,
+        "import_seconds_median": import_times[len(import_times) // 2],
+        "import_budget_seconds": args.import_budget,
+        "heavy_modules_loaded": imports[-1]["heavy_modules_loaded"],
+        "slowest_direct_imports": imports[-1]["slowest_direct_imports"],
+    }
+    if not args.skip_ready:
+        ready_times = sorted(measure_ready(args.module, timeout=30) for _ in range(args.runs))
+        report["ready_seconds_median"] = ready_times[len(ready_times) // 2]
+        report["ready_budget_seconds"] = args.ready_budget
+
+    failures = []
+    if report["import_seconds_median"] > args.import_budget:
+        failures.append(f"import took {report['import_seconds_median']:.3f}s (budget {args.import_budget}s)")
+    if report["heavy_modules_loaded"]:
+        failures.append(f"heavy modules loaded at import: {', '.join(report['heavy_modules_loaded'])}")
+    if "ready_seconds_median" in report and report["ready_seconds_median"] > args.ready_budget:
+        failures.append(f"/api/health ready after {report['ready_seconds_median']:.3f}s (budget {args.ready_budget}s)")
+    report["failures"] = failures
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+    if failures:
+        print("❌ Startup budget exceeded:\n  - " + "\n  - ".join(failures), file=sys.stderr)
+        sys.exit(1)
+    print("✅ Startup within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,11 @@ if [ -d "backend/static/static" ]; then
     rmdir backend/static/static 2>/dev/null || true
 fi
 
+# Precompressione dei file testuali (.gz sempre, .br se il modulo brotli è installato):
+# il backend serve il fratello compresso in base ad Accept-Encoding
+echo "Precompressing static assets..."
+python3 backend/compression.py precompress backend/static
+
 echo ""
 echo "========================================"
 echo "✅ Build complete!"
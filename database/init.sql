@@ -19,6 +19,8 @@ CREATE SCHEMA IF NOT EXISTS webdemocracy;
 SET search_path TO webdemocracy;
 
 -- Drop tables if exist (in reverse order for foreign keys)
+DROP TABLE IF EXISTS survey_participant_sketches CASCADE;
+DROP TABLE IF EXISTS survey_result_snapshots CASCADE;
 DROP TABLE IF EXISTS survey_likes CASCADE;
 DROP TABLE IF EXISTS open_responses CASCADE;
 DROP TABLE IF EXISTS votes CASCADE;
@@ -236,6 +238,8 @@ CREATE INDEX idx_surveys_created_at ON surveys(created_at DESC);
 CREATE INDEX idx_surveys_user_id ON surveys(user_id);
 CREATE INDEX idx_surveys_resource_type ON surveys(resource_type);
 CREATE INDEX idx_surveys_resource_news_id ON surveys(resource_news_id);
+-- Indice parziale sui sondaggi ancora attivi: scheduler delle scadenze e lista con is_active=true
+CREATE INDEX idx_surveys_active_expiry ON surveys(expires_at NULLS FIRST, id) WHERE is_active;
 
 -- Tabella opzioni di risposta
 CREATE TABLE survey_options (
@@ -266,12 +270,14 @@ CREATE INDEX idx_survey_tags_tag ON survey_tags(tag_id);
 CREATE INDEX idx_survey_tags_user_id ON survey_tags(user_id);
 
 -- Tabella voti
+-- Per installazioni molto grandi votes e open_responses possono essere partizionate
+-- per hash(survey_id) o per mese: vedi backend/partitioning.py (VOTES_PARTITIONING)
 CREATE TABLE votes (
     id SERIAL PRIMARY KEY,
     survey_id INTEGER NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
     option_id INTEGER REFERENCES survey_options(id) ON DELETE CASCADE,  -- Nullable per risposte aperte
-    voter_ip VARCHAR(45),
-    voter_session VARCHAR(100),  -- Session ID per tracciare risposte multiple
+    voter_ip INET,
+    voter_session UUID,  -- Session ID per tracciare risposte multiple
     
     -- Per risposte numeriche, scale, rating
     numeric_value DOUBLE PRECISION,
@@ -283,20 +289,26 @@ CREATE TABLE votes (
     user_id INTEGER REFERENCES "user"(id) ON DELETE CASCADE
 );
 
-CREATE INDEX idx_votes_survey_id ON votes(survey_id);
 CREATE INDEX idx_votes_option_id ON votes(option_id);
 CREATE INDEX idx_votes_session ON votes(voter_session);
 CREATE INDEX idx_votes_ip ON votes(voter_ip);
 CREATE INDEX idx_votes_voted_at ON votes(voted_at DESC);
 CREATE INDEX idx_votes_user_id ON votes(user_id);
 
+-- Indici composti per i filtri "caldi" (sostituiscono idx_votes_survey_id, di cui sono un superset)
+CREATE INDEX idx_votes_survey_session ON votes(survey_id, voter_session);       -- verifica voto già espresso
+CREATE INDEX idx_votes_survey_ip ON votes(survey_id, voter_ip);                 -- verifica voto già espresso
+CREATE INDEX idx_votes_survey_user ON votes(survey_id, user_id);                -- voti dell'utente, partecipanti
+CREATE INDEX idx_votes_survey_option_value ON votes(survey_id, option_id, numeric_value);  -- risultati (covering)
+CREATE INDEX idx_votes_survey_voted_at ON votes(survey_id, voted_at);           -- timeline e ultimo voto
+
 -- Tabella risposte aperte testuali
 CREATE TABLE open_responses (
     id SERIAL PRIMARY KEY,
     survey_id INTEGER NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
     option_id INTEGER REFERENCES survey_options(id) ON DELETE CASCADE,  -- Opzionale per compatibilità
-    voter_ip VARCHAR(45),
-    voter_session VARCHAR(100),
+    voter_ip INET,
+    voter_session UUID,
     response_text TEXT NOT NULL,
     responded_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     
@@ -304,18 +316,23 @@ CREATE TABLE open_responses (
     user_id INTEGER REFERENCES "user"(id) ON DELETE CASCADE
 );
 
-CREATE INDEX idx_open_responses_survey_id ON open_responses(survey_id);
 CREATE INDEX idx_open_responses_option_id ON open_responses(option_id);
 CREATE INDEX idx_open_responses_session ON open_responses(voter_session);
 CREATE INDEX idx_open_responses_responded_at ON open_responses(responded_at DESC);
 CREATE INDEX idx_open_responses_user_id ON open_responses(user_id);
 
+-- Indici composti per i filtri "caldi" (sostituiscono idx_open_responses_survey_id)
+CREATE INDEX idx_open_responses_survey_session ON open_responses(survey_id, voter_session);
+CREATE INDEX idx_open_responses_survey_ip ON open_responses(survey_id, voter_ip);
+CREATE INDEX idx_open_responses_survey_user ON open_responses(survey_id, user_id);
+CREATE INDEX idx_open_responses_survey_responded_at ON open_responses(survey_id, responded_at);
+
 -- Tabella likes/ratings sui sondaggi
 CREATE TABLE survey_likes (
     id SERIAL PRIMARY KEY,
     survey_id INTEGER NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
-    user_ip VARCHAR(45),
-    user_session VARCHAR(100),
+    user_ip INET,
+    user_session UUID,
     rating INTEGER NOT NULL CHECK (rating >= 1 AND rating <= 5),  -- 1-5 pallini verdi
     comment TEXT,  -- Commento opzionale sul sondaggio
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
@@ -324,11 +341,33 @@ CREATE TABLE survey_likes (
     user_id INTEGER REFERENCES "user"(id) ON DELETE CASCADE
 );
 
-CREATE INDEX idx_survey_likes_survey_id ON survey_likes(survey_id);
 CREATE INDEX idx_survey_likes_session ON survey_likes(user_session);
 CREATE INDEX idx_survey_likes_created_at ON survey_likes(created_at DESC);
 CREATE INDEX idx_survey_likes_user_id ON survey_likes(user_id);
 
+-- Indici composti per i filtri "caldi" (sostituiscono idx_survey_likes_survey_id)
+CREATE INDEX idx_survey_likes_survey_session ON survey_likes(survey_id, user_session);  -- like dell'utente
+CREATE INDEX idx_survey_likes_survey_ip ON survey_likes(survey_id, user_ip);            -- like dell'utente
+CREATE INDEX idx_survey_likes_survey_rating ON survey_likes(survey_id, rating);         -- statistiche gradimento (covering)
+
+-- Tabella risultati finali congelati alla chiusura del sondaggio
+CREATE TABLE survey_result_snapshots (
+    survey_id INTEGER PRIMARY KEY REFERENCES surveys(id) ON DELETE CASCADE,
+    version INTEGER NOT NULL DEFAULT 1,   -- Versione del formato del payload
+    payload JSONB NOT NULL,               -- SurveyResultsResponse senza campi specifici dell'utente
+    frozen_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Tabella sketch HyperLogLog dei partecipanti unici (per sondaggio e bucket temporale)
+CREATE TABLE survey_participant_sketches (
+    survey_id INTEGER NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
+    granularity VARCHAR(10) NOT NULL,     -- 'all', 'hour', 'day'
+    bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,  -- Inizio del bucket UTC (1970-01-01 per 'all')
+    registers BYTEA NOT NULL,             -- 2^p registri HLL da un byte
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (survey_id, granularity, bucket_start)
+);
+
 -- Tabella impostazioni generali
 CREATE TABLE settings (
     id SERIAL PRIMARY KEY,
@@ -583,6 +622,8 @@ COMMENT ON TABLE survey_options IS 'Opzioni di risposta per i sondaggi';
 COMMENT ON TABLE votes IS 'Voti degli utenti con supporto per valori numerici e date';
 COMMENT ON TABLE open_responses IS 'Risposte aperte testuali degli utenti';
 COMMENT ON TABLE survey_likes IS 'Rating e commenti sui sondaggi';
+COMMENT ON TABLE survey_result_snapshots IS 'Risultati finali dei sondaggi chiusi, serviti senza ricalcolo';
+COMMENT ON TABLE survey_participant_sketches IS 'Sketch HyperLogLog dei partecipanti unici per sondaggio e bucket';
 COMMENT ON TABLE tags IS 'Tag per categorizzare i sondaggi';
 COMMENT ON TABLE survey_tags IS 'Associazione many-to-many tra sondaggi e tag';
 COMMENT ON TABLE settings IS 'Impostazioni generali dell''applicazione';
@@ -618,7 +659,7 @@ BEGIN
     RAISE NOTICE '========================================';
     RAISE NOTICE 'Web Democracy Database Initialized!';
     RAISE NOTICE '========================================';
-    RAISE NOTICE 'Tables created: 12';
+    RAISE NOTICE 'Tables created: 14';
     RAISE NOTICE 'Sample surveys: 6';
     RAISE NOTICE 'Tags: 8';
     RAISE NOTICE 'News examples: 10';
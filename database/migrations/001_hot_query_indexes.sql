@@ -0,0 +1,38 @@
+-- ============================================================================
+-- Migration 001: indici composti per le query "calde"
+-- ============================================================================
+-- Allinea un database esistente al set di indici di init.sql.
+-- CREATE INDEX CONCURRENTLY non blocca le scritture: eseguire FUORI da una
+-- transazione (psql -f, senza --single-transaction).
+--
+--   psql "$DATABASE_URL" -f database/migrations/001_hot_query_indexes.sql
+-- ============================================================================
+
+SET search_path TO webdemocracy, public;
+
+-- VOTES
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_votes_survey_session ON votes(survey_id, voter_session);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_votes_survey_ip ON votes(survey_id, voter_ip);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_votes_survey_user ON votes(survey_id, user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_votes_survey_option_value ON votes(survey_id, option_id, numeric_value);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_votes_survey_voted_at ON votes(survey_id, voted_at);
+
+-- OPEN RESPONSES
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_open_responses_survey_session ON open_responses(survey_id, voter_session);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_open_responses_survey_ip ON open_responses(survey_id, voter_ip);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_open_responses_survey_user ON open_responses(survey_id, user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_open_responses_survey_responded_at ON open_responses(survey_id, responded_at);
+
+-- SURVEY LIKES
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_survey_likes_survey_session ON survey_likes(survey_id, user_session);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_survey_likes_survey_ip ON survey_likes(survey_id, user_ip);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_survey_likes_survey_rating ON survey_likes(survey_id, rating);
+
+-- Gli indici su survey_id da solo sono prefisso dei composti: ridondanti
+DROP INDEX CONCURRENTLY IF EXISTS idx_votes_survey_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_open_responses_survey_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_survey_likes_survey_id;
+
+ANALYZE votes;
+ANALYZE open_responses;
+ANALYZE survey_likes;
@@ -0,0 +1,58 @@
+-- ============================================================================
+-- Migration 002: tipi nativi INET / UUID per l'identità del votante
+-- ============================================================================
+-- voter_ip / user_ip:           VARCHAR(45)  -> INET  (7 byte IPv4, 19 byte IPv6)
+-- voter_session / user_session: VARCHAR(100) -> UUID  (16 byte fissi)
+--
+-- I valori non validi vengono convertiti così:
+--   IP non parsabile        -> NULL
+--   sessione non-UUID       -> md5(valore)::uuid (stessa mappatura di
+--                              voter_identity.normalize_session, quindi i
+--                              cookie esistenti continuano a combaciare)
+--
+-- ALTER COLUMN TYPE riscrive le tabelle e ricostruisce gli indici con un lock
+-- ACCESS EXCLUSIVE: eseguire in una finestra di manutenzione.
+--
+--   psql "$DATABASE_URL" -f database/migrations/002_compact_voter_identity.sql
+-- ============================================================================
+
+SET search_path TO webdemocracy, public;
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION pg_temp.to_inet(value TEXT) RETURNS INET AS $$
+BEGIN
+    RETURN value::inet;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION pg_temp.to_uuid(value TEXT) RETURNS UUID AS $$
+BEGIN
+    IF value IS NULL OR value = '' THEN
+        RETURN NULL;
+    END IF;
+    RETURN value::uuid;
+EXCEPTION WHEN others THEN
+    RETURN md5(value)::uuid;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+ALTER TABLE votes
+    ALTER COLUMN voter_ip TYPE INET USING pg_temp.to_inet(voter_ip),
+    ALTER COLUMN voter_session TYPE UUID USING pg_temp.to_uuid(voter_session);
+
+ALTER TABLE open_responses
+    ALTER COLUMN voter_ip TYPE INET USING pg_temp.to_inet(voter_ip),
+    ALTER COLUMN voter_session TYPE UUID USING pg_temp.to_uuid(voter_session);
+
+ALTER TABLE survey_likes
+    ALTER COLUMN user_ip TYPE INET USING pg_temp.to_inet(user_ip),
+    ALTER COLUMN user_session TYPE UUID USING pg_temp.to_uuid(user_session);
+
+COMMIT;
+
+ANALYZE votes;
+ANALYZE open_responses;
+ANALYZE survey_likes;
@@ -0,0 +1,18 @@
+-- ============================================================================
+-- Migration 003: indice parziale sui sondaggi attivi (lista e scadenze)
+-- ============================================================================
+-- Lo scheduler (backend/expiry_scheduler.py) ricarica periodicamente le
+-- scadenze dei soli sondaggi attivi, e GET /surveys?is_active=true filtra gli
+-- attivi non scaduti con lo stesso predicato: l'indice parziale resta piccolo
+-- perché i sondaggi chiusi ne escono non appena is_active diventa false.
+--
+-- CREATE INDEX CONCURRENTLY non può girare in una transazione:
+--   psql "$DATABASE_URL" -f database/migrations/003_active_surveys_expiry_index.sql
+-- ============================================================================
+
+SET search_path TO webdemocracy, public;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_surveys_active_expiry
+    ON surveys(expires_at NULLS FIRST, id) WHERE is_active;
+
+ANALYZE surveys;
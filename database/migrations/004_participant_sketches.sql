@@ -0,0 +1,24 @@
+-- ============================================================================
+-- Migration 004: sketch HyperLogLog dei partecipanti unici
+-- ============================================================================
+-- Crea survey_participant_sketches (vedi backend/participants.py). I voti
+-- registrati dopo la migration aggiornano gli sketch; per i sondaggi esistenti
+-- ricostruirli con:
+--   python backend/participants.py backfill
+-- Fino al backfill i conteggi restano esatti (COUNT DISTINCT).
+--
+--   psql "$DATABASE_URL" -f database/migrations/004_participant_sketches.sql
+-- ============================================================================
+
+SET search_path TO webdemocracy, public;
+
+CREATE TABLE IF NOT EXISTS survey_participant_sketches (
+    survey_id INTEGER NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
+    granularity VARCHAR(10) NOT NULL,
+    bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    registers BYTEA NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (survey_id, granularity, bucket_start)
+);
+
+COMMENT ON TABLE survey_participant_sketches IS 'Sketch HyperLogLog dei partecipanti unici per sondaggio e bucket';